@@ -1,16 +1,19 @@
 import logging
-from typing import TYPE_CHECKING, Any, Optional
+from typing import TYPE_CHECKING, Any, Dict, Optional
 
+import httpx
 from aiogram import Bot
 from dotenv import load_dotenv
-from openai import OpenAI
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient, Timeout
 from pydantic import ConfigDict, SecretStr
 from pydantic_settings import BaseSettings
 
 if TYPE_CHECKING:
     from manager.admin_notifier import AdminNotifier
+    from manager.ai_jobs import AIJobQueue
     from manager.spam_service import SpamManager
     from utils.astro_manager import AstroManager
+    from utils.svg_converter import RasterService
 load_dotenv()
 
 logger = logging.getLogger(__name__)
@@ -45,6 +48,13 @@ class BotConfig(BaseSettings):
 
 class DatabaseConfig(BaseSettings):
     url: str
+    # Профиль движка SQLite
+    pool_size: int = 5
+    max_overflow: int = 10
+    pool_timeout: float = 30
+    busy_timeout_ms: int = 5000
+    mmap_size: int = 256 * 1024 * 1024
+    cache_size_kb: int = 64000
     # name: str
 
 
@@ -67,7 +77,7 @@ class Config(BaseSettings):
 
     bot: BotConfig
     openai_api_key: str = ""
-    open_ai_client: OpenAI | None = None
+    open_ai_client: AsyncOpenAI | None = None
     db: DatabaseConfig
     robokassa: RobokassaConfig
     admin_ids: list[int] = [
@@ -88,6 +98,74 @@ class Config(BaseSettings):
         "https://drive.google.com/file/d/1kH59RxQTTZwqsPX7h13NatmizvySg9uy/view?usp=sharing"
     )
     admin_notifier: Any = None
+    # Очередь входящих апдейтов вебхука: общий пул воркеров, апдейты
+    # одного пользователя выполняются последовательно
+    update_workers: int = 64
+    update_queue_size: int = 10000
+    # FSM-хранилище: "sqlite" (общее для процессов) или "memory"
+    fsm_storage: str = "sqlite"
+    fsm_cache_ttl: float = 0
+    fsm_cache_size: int = 10000
+    # Рассылки: глобальный лимит (сообщений/с), число отправителей,
+    # минимальный интервал между сообщениями в один чат
+    broadcast_rate: float = 25
+    broadcast_workers: int = 16
+    broadcast_chat_interval: float = 1.0
+    broadcast_max_retries: int = 3
+    # Статусы доставки пишутся пачками: по размеру или раз в интервал.
+    # Неудачная запись повторяется, в памяти держится не больше backlog
+    broadcast_flush_size: int = 500
+    broadcast_flush_interval: float = 2.0
+    broadcast_flush_backlog: int = 50000
+    # Сколько медиафайлов загружать/проверять одновременно при старте
+    media_preload_concurrency: int = 8
+    # Пул процессов для расчёта натальных карт
+    astro_workers: int = 2
+    astro_timeout: float = 30
+    # Размер дискового кэша натальных карт (charts/cache), МБ
+    chart_cache_mb: int = 200
+    # Сколько последних карт держать в памяти для отправки
+    chart_memory_count: int = 64
+    # Растеризация карты SVG -> PNG в пуле процессов (0 — отправлять SVG
+    # документом), ширина картинки в пикселях
+    raster_workers: int = 1
+    raster_timeout: float = 30
+    raster_width: int = 1200
+    # Общая таблица эфемерид (обновляется планировщиком раз в день)
+    ephemeris_path: str = "charts/ephemeris.npz"
+    ephemeris_days: int = 45
+    # OpenAI: пул HTTP-соединений, таймауты и число одновременных запросов
+    # к одной модели (если она не указана в AI_MODEL_LIMITS)
+    openai_concurrency: int = 32
+    openai_max_connections: int = 64
+    openai_keepalive_expiry: float = 60
+    openai_timeout: float = 180
+    openai_connect_timeout: float = 10
+    # Повторы делает AIScheduler, у самого клиента они выключены
+    openai_max_retries: int = 0
+    # Планировщик запросов к OpenAI: лимиты по моделям, повторы временных
+    # ошибок и автомат, отключающий модель после серии неудач
+    ai_model_limits: Dict[str, int] = {"dall-e-3": 2}
+    ai_max_retries: int = 3
+    ai_breaker_threshold: int = 5
+    ai_breaker_cooldown: float = 30
+    # Очередь AI-прогнозов в БД: число воркеров (0 — по
+    # openai_concurrency), аренда задания (с, воркер продлевает её, пока
+    # задание в работе), попытки и задержка перед повтором (удваивается)
+    ai_job_workers: int = 0
+    ai_job_lease: float = 120
+    ai_job_max_attempts: int = 3
+    ai_job_retry_delay: float = 10
+    # Потоковая выдача AI-прогноза: сообщение правится по мере генерации,
+    # не чаще раза в интервал (лимит Telegram на правки ~1 в секунду)
+    ai_streaming: bool = True
+    ai_stream_edit_interval: float = 1.5
+    # Кэш ответов на похожие вопросы по той же карте: "off", "draft"
+    # (черновик, пока генерируется свежий ответ) или "serve" (без запроса)
+    ai_cache_mode: str = "off"
+    ai_cache_size: int = 1000
+    ai_cache_ttl: float = 43200
+    ai_cache_threshold: float = 0.85
 
     def set_bot_id(self, bot_id: str):
         self.bot.id = bot_id
@@ -125,14 +203,44 @@ class Config(BaseSettings):
 
         return self.astro_manager or AstroManager(self.bot)
 
+    def set_raster_service(self, raster_service: "RasterService"):
+        self.raster_service = raster_service
+
+    def get_raster_service(self) -> Optional["RasterService"]:
+        return getattr(self, "raster_service", None)
+
+    def set_ai_jobs(self, ai_jobs: "AIJobQueue"):
+        self.ai_jobs = ai_jobs
+
+    def get_ai_jobs(self) -> Optional["AIJobQueue"]:
+        return getattr(self, "ai_jobs", None)
+
     def set_openai_client(self):
 
         if self.open_ai_client is None:
-            self.open_ai_client = OpenAI(api_key=self.openai_api_key)
+            self.open_ai_client = self._create_openai_client()
 
-    def get_openai_client(self) -> OpenAI:
+    def get_openai_client(self) -> AsyncOpenAI:
 
-        return self.open_ai_client or OpenAI(self.openai_api_key)
+        return self.open_ai_client or self._create_openai_client()
+
+    def _create_openai_client(self) -> AsyncOpenAI:
+        """Один асинхронный клиент на процесс: пул соединений и keep-alive"""
+        http_client = DefaultAsyncHttpxClient(
+            limits=httpx.Limits(
+                max_connections=self.openai_max_connections,
+                max_keepalive_connections=self.openai_max_connections,
+                keepalive_expiry=self.openai_keepalive_expiry,
+            ),
+        )
+        return AsyncOpenAI(
+            api_key=self.openai_api_key,
+            http_client=http_client,
+            timeout=Timeout(
+                self.openai_timeout, connect=self.openai_connect_timeout
+            ),
+            max_retries=self.openai_max_retries,
+        )
 
     def set_telethon_client(self, telethon_client: Any):
         self.bot.telethon_client = telethon_client
@@ -1,6 +1,13 @@
+import asyncio
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from typing import Optional
+
+from sqlalchemy import event
 from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import AsyncAdaptedQueuePool
 
 from config.config import get_config
 
@@ -11,12 +18,49 @@ _engine = None
 _AsyncSessionLocal = None
 
 
+def _sqlite_pragmas(db_config) -> dict:
+    return {
+        "journal_mode": "WAL",
+        "synchronous": "NORMAL",
+        "busy_timeout": db_config.busy_timeout_ms,
+        "mmap_size": db_config.mmap_size,
+        "cache_size": -db_config.cache_size_kb,
+        "temp_store": "MEMORY",
+    }
+
+
+def _create_sqlite_engine(db_config):
+    """Движок SQLite: WAL, synchronous=NORMAL, busy timeout, mmap и пул"""
+    pragmas = _sqlite_pragmas(db_config)
+    engine = create_async_engine(
+        db_config.url,
+        echo=False,
+        poolclass=AsyncAdaptedQueuePool,
+        pool_size=db_config.pool_size,
+        max_overflow=db_config.max_overflow,
+        pool_timeout=db_config.pool_timeout,
+        connect_args={"timeout": db_config.busy_timeout_ms / 1000},
+    )
+
+    @event.listens_for(engine.sync_engine, "connect")
+    def _set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute(f"PRAGMA {name}={value}")
+        cursor.close()
+
+    return engine
+
+
 def get_engine():
     global _engine
     if _engine is None:
         config = get_config()
         DATABASE_URL = config.db.url
-        _engine = create_async_engine(DATABASE_URL, echo=False)
+        if DATABASE_URL.startswith("sqlite"):
+            _engine = _create_sqlite_engine(config.db)
+        else:
+            _engine = create_async_engine(DATABASE_URL, echo=False)
     return _engine
 
 
@@ -29,9 +73,85 @@ def get_session_factory():
     return _AsyncSessionLocal
 
 
+class _SessionScope:
+    """Сессия, общая для всех хелперов в рамках обработки одного апдейта"""
+
+    def __init__(self, session: AsyncSession) -> None:
+        self.session = session
+        self.task = asyncio.current_task()
+        self.active = True
+
+
+_session_scope: ContextVar[Optional[_SessionScope]] = ContextVar(
+    "db_session_scope", default=None
+)
+
+
+def _current_scope() -> Optional[_SessionScope]:
+    scope = _session_scope.get()
+    # Задачи, созданные внутри апдейта, наследуют contextvar,
+    # но общую сессию может использовать только задача-владелец
+    if (
+        scope is not None
+        and scope.active
+        and scope.task is asyncio.current_task()
+    ):
+        return scope
+    return None
+
+
+class _SharedSession:
+    """
+    Обёртка для `async with AsyncSessionLocal()` внутри scope:
+    отдаёт общую сессию и не закрывает её на выходе.
+    """
+
+    def __init__(self, session: AsyncSession) -> None:
+        self.session = session
+
+    async def __aenter__(self) -> AsyncSession:
+        return self.session
+
+    async def __aexit__(self, exc_type, exc, tb) -> None:
+        session = self.session
+        if exc_type is not None:
+            await session.rollback()
+        elif session.in_transaction() and not (
+            session.new or session.dirty or session.deleted
+        ):
+            # Завершаем читающую транзакцию: иначе снимок WAL устареет
+            # и последующая запись в этой же сессии получит SQLITE_BUSY
+            await session.commit()
+
+
+@asynccontextmanager
+async def session_scope():
+    """
+    Открыть одну сессию на всю обработку апдейта.
+    Все вызовы AsyncSessionLocal() внутри будут переиспользовать её.
+    """
+    scope = _current_scope()
+    if scope is not None:
+        yield scope.session
+        return
+
+    async with get_session_factory()() as session:
+        scope = _SessionScope(session)
+        token = _session_scope.set(scope)
+        try:
+            yield session
+            await session.commit()
+        finally:
+            scope.active = False
+            _session_scope.reset(token)
+
+
 # Создаем класс-обертку для ленивого доступа
 class _AsyncSessionLocalProxy:
     def __call__(self):
+        scope = _current_scope()
+        if scope is not None:
+            return _SharedSession(scope.session)
         return get_session_factory()()
 
 
@@ -1,12 +1,19 @@
 from db.db import Base, get_engine
 
+from .ai_job import AIJob, ensure_ai_job_columns
 from .ai_promo import AiPromo
 from .asto_info import AstroInfo
 from .first_mes import FirstMes
+from .fsm_record import FsmRecord
+from .media_file import MediaFile, MediaPath
 from .old_workflow.ab_group import ABGroup
 from .old_workflow.abonement_promo import AbonementPromo
-from .old_workflow.big_mes import BigMes
-from .old_workflow.broadcast import Broadcast
+from .old_workflow.big_mes import BigMes, ensure_big_mes_columns
+from .old_workflow.broadcast import (
+    BroadcastDelivery,
+    BroadcastRun,
+    migrate_broadcast_columns,
+)
 from .old_workflow.certificate import Certificate
 from .old_workflow.coupons import Coupon
 from .old_workflow.links import BotLink
@@ -28,6 +35,9 @@ async def init_db():
     engine = get_engine()
     async with engine.begin() as conn:
         await conn.run_sync(Base.metadata.create_all)
+        await migrate_broadcast_columns(conn)
+        await ensure_big_mes_columns(conn)
+        await ensure_ai_job_columns(conn)
     try:
         await create_initial_order()
     except Exception as e:
@@ -0,0 +1,312 @@
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy import (
+    Column,
+    DateTime,
+    Index,
+    Integer,
+    String,
+    Text,
+    and_,
+    or_,
+    select,
+    text,
+    update,
+)
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+from db.db import AsyncSessionLocal, Base
+from db.models.base import TimestampMixin
+from db.models.user import increase_free_predictions_count_many
+
+# pending -> running -> done, либо failed после всех попыток.
+# Доставку пользователю отмечает delivered_at
+JOB_PENDING = "pending"
+JOB_RUNNING = "running"
+JOB_DONE = "done"
+JOB_FAILED = "failed"
+
+
+class AIJob(Base, TimestampMixin):
+    """Запрос AI-прогноза, переживающий рестарты бота"""
+
+    __tablename__ = "ai_jobs"
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    # Один и тот же запрос (повтор апдейта) не ставится в очередь дважды
+    idempotency_key = Column(String, unique=True, nullable=False)
+    user_id = Column(Integer, nullable=False)
+    chat_id = Column(Integer, nullable=False)
+    # Сообщение "прогноз готовится", которое воркер правит по мере
+    # генерации и удаляет перед отправкой ответа
+    message_id = Column(Integer, nullable=True)
+    query = Column(Text, nullable=False)
+    natal_json = Column(Text, nullable=True)
+    priority = Column(Integer, nullable=False, default=1)
+    status = Column(String, nullable=False, default=JOB_PENDING)
+    attempts = Column(Integer, nullable=False, default=0)
+    # Для running — срок аренды воркером, для pending — не раньше этого
+    # момента (задержка перед повтором)
+    lease_until = Column(DateTime, nullable=True)
+    result = Column(Text, nullable=True)
+    error = Column(String, nullable=True)
+    delivered_at = Column(DateTime, nullable=True)
+    # Прогнозы, списанные с пользователя при постановке в очередь. Если
+    # задание окончательно не удалось, они возвращаются (refunded_at)
+    reserved = Column(Integer, nullable=False, default=0)
+    refunded_at = Column(DateTime, nullable=True)
+
+    __table_args__ = (
+        Index("ix_ai_jobs_status_priority", "status", "priority", "id"),
+    )
+
+
+async def ensure_ai_job_columns(conn) -> None:
+    """Добавить в ai_jobs колонки, появившиеся после создания таблицы"""
+    result = await conn.execute(
+        text("SELECT name FROM pragma_table_info('ai_jobs')")
+    )
+    columns = {row[0] for row in result.all()}
+    if "message_id" not in columns:
+        await conn.execute(
+            text("ALTER TABLE ai_jobs ADD COLUMN message_id INTEGER")
+        )
+    if "reserved" not in columns:
+        await conn.execute(
+            text(
+                "ALTER TABLE ai_jobs "
+                "ADD COLUMN reserved INTEGER NOT NULL DEFAULT 0"
+            )
+        )
+    if "refunded_at" not in columns:
+        await conn.execute(
+            text("ALTER TABLE ai_jobs ADD COLUMN refunded_at DATETIME")
+        )
+
+
+def _now() -> datetime:
+    return datetime.now(TimestampMixin.MSK).replace(tzinfo=None)
+
+
+async def enqueue_ai_job(
+    idempotency_key: str,
+    user_id: int,
+    chat_id: int,
+    query: str,
+    natal_json: Optional[str],
+    priority: int,
+    message_id: Optional[int] = None,
+    reserved: int = 0,
+) -> Tuple[int, bool]:
+    """Поставить запрос в очередь, вернуть (id, создан ли новый)"""
+    async with AsyncSessionLocal() as session:
+        result = await session.execute(
+            sqlite_insert(AIJob)
+            .values(
+                idempotency_key=idempotency_key,
+                user_id=user_id,
+                chat_id=chat_id,
+                message_id=message_id,
+                reserved=reserved,
+                query=query,
+                natal_json=natal_json,
+                priority=priority,
+                status=JOB_PENDING,
+            )
+            .on_conflict_do_nothing(index_elements=[AIJob.idempotency_key])
+            .returning(AIJob.id)
+        )
+        job_id = result.scalar_one_or_none()
+        if job_id is not None:
+            await session.commit()
+            return job_id, True
+        result = await session.execute(
+            select(AIJob.id).where(AIJob.idempotency_key == idempotency_key)
+        )
+        return result.scalar_one(), False
+
+
+async def claim_ai_jobs(limit: int, lease_seconds: float) -> List[AIJob]:
+    """
+    Взять в работу до limit заданий: ожидающие (с наступившим сроком
+    повтора) и брошенные — running с истёкшей арендой
+    """
+    now = _now()
+    ready = or_(
+        and_(
+            AIJob.status == JOB_PENDING,
+            or_(AIJob.lease_until.is_(None), AIJob.lease_until <= now),
+        ),
+        and_(AIJob.status == JOB_RUNNING, AIJob.lease_until <= now),
+    )
+    ids = (
+        select(AIJob.id)
+        .where(ready)
+        .order_by(AIJob.priority, AIJob.id)
+        .limit(limit)
+        .scalar_subquery()
+    )
+    async with AsyncSessionLocal() as session:
+        result = await session.execute(
+            update(AIJob)
+            .where(AIJob.id.in_(ids), ready)
+            .values(
+                status=JOB_RUNNING,
+                attempts=AIJob.attempts + 1,
+                lease_until=now + timedelta(seconds=lease_seconds),
+            )
+            .returning(AIJob)
+        )
+        jobs = list(result.scalars().all())
+        await session.commit()
+        return jobs
+
+
+async def renew_ai_job_lease(job_id: int, lease_seconds: float) -> bool:
+    """Продлить аренду задания в работе. False — задание уже не running"""
+    async with AsyncSessionLocal() as session:
+        result = await session.execute(
+            update(AIJob)
+            .where(AIJob.id == job_id, AIJob.status == JOB_RUNNING)
+            .values(lease_until=_now() + timedelta(seconds=lease_seconds))
+            .returning(AIJob.id)
+        )
+        renewed = result.scalar_one_or_none() is not None
+        await session.commit()
+        return renewed
+
+
+async def complete_ai_job(job_id: int, result: str) -> None:
+    async with AsyncSessionLocal() as session:
+        await session.execute(
+            update(AIJob)
+            .where(AIJob.id == job_id)
+            .values(
+                status=JOB_DONE, result=result, error=None, lease_until=None
+            )
+        )
+        await session.commit()
+
+
+async def fail_ai_job(
+    job_id: int,
+    error: str,
+    retry_delay: Optional[float] = None,
+    result: Optional[str] = None,
+) -> None:
+    """
+    Неудачная попытка: с retry_delay задание вернётся в очередь через
+    столько секунд, без него — окончательно failed с текстом result
+    """
+    if retry_delay is not None:
+        values = {
+            "status": JOB_PENDING,
+            "lease_until": _now() + timedelta(seconds=retry_delay),
+        }
+    else:
+        values = {"status": JOB_FAILED, "lease_until": None, "result": result}
+    async with AsyncSessionLocal() as session:
+        await session.execute(
+            update(AIJob)
+            .where(AIJob.id == job_id)
+            .values(error=error[:500], **values)
+        )
+        await session.commit()
+
+
+async def refund_failed_ai_jobs() -> int:
+    """
+    Вернуть прогнозы, зарезервированные окончательно упавшими заданиями.
+    Отметка заданий и начисление пользователям — одна транзакция.
+    Возвращает число возвращённых прогнозов
+    """
+    async with AsyncSessionLocal() as session:
+        result = await session.execute(
+            update(AIJob)
+            .where(
+                AIJob.status == JOB_FAILED,
+                AIJob.reserved > 0,
+                AIJob.refunded_at.is_(None),
+            )
+            .values(refunded_at=_now())
+            .returning(AIJob.user_id, AIJob.reserved)
+        )
+        credits: Dict[int, int] = {}
+        for user_id, reserved in result.all():
+            credits[user_id] = credits.get(user_id, 0) + reserved
+        await increase_free_predictions_count_many(credits, session)
+        return sum(credits.values())
+
+
+async def mark_ai_job_delivered(job_id: int) -> bool:
+    """
+    Занять доставку до отправки. False — результат уже доставляет или
+    доставил кто-то другой
+    """
+    async with AsyncSessionLocal() as session:
+        result = await session.execute(
+            update(AIJob)
+            .where(
+                AIJob.id == job_id,
+                AIJob.status.in_((JOB_DONE, JOB_FAILED)),
+                AIJob.delivered_at.is_(None),
+            )
+            .values(delivered_at=_now())
+            .returning(AIJob.id)
+        )
+        delivered = result.scalar_one_or_none() is not None
+        await session.commit()
+        return delivered
+
+
+async def unmark_ai_job_delivered(job_id: int) -> None:
+    """Снять отметку после неудачной отправки: доставка повторится"""
+    async with AsyncSessionLocal() as session:
+        await session.execute(
+            update(AIJob).where(AIJob.id == job_id).values(delivered_at=None)
+        )
+        await session.commit()
+
+
+async def get_undelivered_ai_jobs() -> List[AIJob]:
+    """Готовые, но не доставленные (процесс упал между ответом и отправкой)"""
+    async with AsyncSessionLocal() as session:
+        result = await session.execute(
+            select(AIJob).where(
+                AIJob.status.in_((JOB_DONE, JOB_FAILED)),
+                AIJob.delivered_at.is_(None),
+            )
+        )
+        return list(result.scalars().all())
+
+
+async def release_ai_jobs(job_ids: List[int]) -> None:
+    """Вернуть задания в очередь (при остановке воркеров)"""
+    if not job_ids:
+        return
+    async with AsyncSessionLocal() as session:
+        await session.execute(
+            update(AIJob)
+            .where(AIJob.id.in_(job_ids), AIJob.status == JOB_RUNNING)
+            .values(
+                status=JOB_PENDING,
+                attempts=AIJob.attempts - 1,
+                lease_until=None,
+            )
+        )
+        await session.commit()
+
+
+async def reset_expired_ai_jobs() -> int:
+    """При старте вернуть в очередь задания с истёкшей арендой"""
+    async with AsyncSessionLocal() as session:
+        result = await session.execute(
+            update(AIJob)
+            .where(AIJob.status == JOB_RUNNING, AIJob.lease_until <= _now())
+            .values(status=JOB_PENDING, lease_until=None)
+            .returning(AIJob.id)
+        )
+        count = len(result.all())
+        await session.commit()
+        return count
@@ -74,21 +74,20 @@ async def use_ai_promo(promo_hash: str) -> tuple[bool, int]:
     Возвращает (успешно ли использован, количество прогнозов)
     """
     async with AsyncSessionLocal() as session:
-        promo = await get_ai_promo_by_hash(promo_hash, session)
-
-        if promo and promo.is_active:
-            # Отмечаем промокод как использованный
-            stmt = (
-                update(AiPromo)
-                .where(AiPromo.hash == promo_hash)
-                .values(is_active=False, used_at=func.now())
-            )
-            await session.execute(stmt)
-            await session.commit()
-
-            return True, promo.count_of_predict
+        # Одним запросом: погасить активный промокод и получить его номинал
+        stmt = (
+            update(AiPromo)
+            .where(AiPromo.hash == promo_hash, AiPromo.is_active.is_(True))
+            .values(is_active=False, used_at=func.now())
+            .returning(AiPromo.count_of_predict)
+        )
+        result = await session.execute(stmt)
+        count_of_predict = result.scalar_one_or_none()
+        await session.commit()
 
-        return False, 0
+        if count_of_predict is None:
+            return False, 0
+        return True, count_of_predict
 
 
 async def get_all_ai_promos():
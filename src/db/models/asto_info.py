@@ -123,6 +123,7 @@ async def get_natal_json(user_id: int) -> dict:
 
 
 async def set_natal_svg(user_id: int, natal_svg) -> None:
+    """natal_svg — ключ карты в ChartCache (раньше хранился путь к SVG)"""
     async with AsyncSessionLocal() as session:
         # Convert Path to string if needed
         svg_path = str(natal_svg) if isinstance(natal_svg, Path) else natal_svg
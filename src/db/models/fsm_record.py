@@ -0,0 +1,14 @@
+from sqlalchemy import Column, LargeBinary, String
+
+from db.db import Base
+from db.models.base import TimestampMixin
+
+
+class FsmRecord(Base, TimestampMixin):
+    """Состояние и данные FSM/aiogram_dialog для одного ключа хранилища"""
+
+    __tablename__ = "fsm_storage"
+
+    key = Column(String, primary_key=True)
+    state = Column(String, nullable=True)
+    data = Column(LargeBinary, nullable=True)
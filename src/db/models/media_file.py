@@ -0,0 +1,154 @@
+import asyncio
+import hashlib
+import os
+from typing import Dict, List, Optional, Set, Tuple
+
+from sqlalchemy import Column, Float, Integer, String, delete, select
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+from db.db import AsyncSessionLocal, Base
+from db.models.base import TimestampMixin
+
+
+class MediaFile(Base, TimestampMixin):
+    """file_id, выданный Telegram для содержимого файла (по хэшу)"""
+
+    __tablename__ = "media_files"
+
+    content_hash = Column(String, primary_key=True)
+    # Одни и те же байты как фото и как анимация — разные file_id
+    media_type = Column(String, primary_key=True)
+    file_id = Column(String, nullable=False)
+    file_unique_id = Column(String, nullable=True)
+
+
+class MediaPath(Base, TimestampMixin):
+    """Индекс путь -> хэш содержимого; mtime/size показывают изменения"""
+
+    __tablename__ = "media_paths"
+
+    path = Column(String, primary_key=True)
+    content_hash = Column(String, nullable=False)
+    mtime = Column(Float, nullable=False)
+    size = Column(Integer, nullable=False)
+
+
+# Обе таблицы целиком в памяти процесса, загружаются при старте
+# (load_media_files). В БД пишется только новое содержимое и изменения
+_files: Dict[Tuple[str, str], Tuple[str, Optional[str]]] = {}
+_paths: Dict[str, Tuple[str, float, int]] = {}
+
+
+def file_checksum(file_path: str) -> str:
+    """BLAKE2-хэш содержимого файла"""
+    digest = hashlib.blake2b(digest_size=16)
+    with open(file_path, "rb") as file:
+        for chunk in iter(lambda: file.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+async def load_media_files() -> int:
+    async with AsyncSessionLocal() as session:
+        files = (await session.execute(select(MediaFile))).scalars().all()
+        paths = (await session.execute(select(MediaPath))).scalars().all()
+    _files.clear()
+    _paths.clear()
+    for record in files:
+        _files[(record.content_hash, record.media_type)] = (
+            record.file_id,
+            record.file_unique_id,
+        )
+    for record in paths:
+        _paths[record.path] = (record.content_hash, record.mtime, record.size)
+    return len(_files)
+
+
+def cached_content_hash(path: str) -> Optional[str]:
+    """Хэш из индекса, если файл не менялся (только stat, без чтения)"""
+    indexed = _paths.get(path)
+    if indexed is None:
+        return None
+    stat = os.stat(path)
+    if (stat.st_mtime, stat.st_size) != indexed[1:]:
+        return None
+    return indexed[0]
+
+
+async def content_hash(path: str) -> str:
+    """Хэш содержимого; файл перечитывается, только если изменился"""
+    digest = cached_content_hash(path)
+    if digest is not None:
+        return digest
+    stat = os.stat(path)
+    digest = await asyncio.to_thread(file_checksum, path)
+    _paths[path] = (digest, stat.st_mtime, stat.st_size)
+    values = {
+        "content_hash": digest,
+        "mtime": stat.st_mtime,
+        "size": stat.st_size,
+    }
+    async with AsyncSessionLocal() as session:
+        await session.execute(
+            sqlite_insert(MediaPath)
+            .values(path=path, **values)
+            .on_conflict_do_update(
+                index_elements=[MediaPath.path], set_=values
+            )
+        )
+        await session.commit()
+    return digest
+
+
+def get_media_file(
+    digest: str, media_type: str
+) -> Optional[Tuple[str, Optional[str]]]:
+    """(file_id, file_unique_id) для содержимого или None"""
+    return _files.get((digest, media_type))
+
+
+async def save_media_file(
+    digest: str,
+    media_type: str,
+    file_id: str,
+    file_unique_id: Optional[str],
+) -> None:
+    values = {"file_id": file_id, "file_unique_id": file_unique_id}
+    async with AsyncSessionLocal() as session:
+        await session.execute(
+            sqlite_insert(MediaFile)
+            .values(content_hash=digest, media_type=media_type, **values)
+            .on_conflict_do_update(
+                index_elements=[MediaFile.content_hash, MediaFile.media_type],
+                set_=values,
+            )
+        )
+        await session.commit()
+    _files[(digest, media_type)] = (file_id, file_unique_id)
+
+
+def media_file_ids() -> Set[str]:
+    return {file_id for file_id, _ in _files.values()}
+
+
+async def delete_media_files(file_ids: Set[str]) -> List[str]:
+    """Забыть file_ids (протухли в Telegram), вернуть их хэши"""
+    keys = [key for key, (file_id, _) in _files.items() if file_id in file_ids]
+    if not keys:
+        return []
+    for key in keys:
+        del _files[key]
+    async with AsyncSessionLocal() as session:
+        await session.execute(
+            delete(MediaFile).where(MediaFile.file_id.in_(file_ids))
+        )
+        await session.commit()
+    return [digest for digest, _ in keys]
+
+
+def media_files_stats() -> dict:
+    return {
+        "files": len(_files),
+        "paths": len(_paths),
+        "unique_contents": len({digest for digest, _ in _files}),
+    }
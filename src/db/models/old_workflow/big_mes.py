@@ -1,18 +1,29 @@
+import asyncio
 import os
+from collections import defaultdict
 from enum import Enum
-from typing import List, Optional, Tuple
+from typing import Any, Dict, List, Optional, Set, Tuple
 
 from aiogram import Bot
 from aiogram.enums import ContentType
 from aiogram.types import FSInputFile, Message
 from aiogram.utils.media_group import MediaGroupBuilder
 from aiogram_dialog.api.entities import MediaAttachment, MediaId
-from sqlalchemy import Column, Integer, String, select
+from sqlalchemy import Column, Integer, String, select, text
 from sqlalchemy.ext.asyncio import AsyncSession
 
 from config.config import get_config
 from db.db import AsyncSessionLocal, Base
 from db.models.base import TimestampMixin
+from db.models.media_file import (
+    cached_content_hash,
+    content_hash,
+    delete_media_files,
+    get_media_file,
+    load_media_files,
+    media_file_ids,
+    save_media_file,
+)
 
 
 class MediaType(Enum):
@@ -34,6 +45,127 @@ class BigMes(Base, TimestampMixin):
     message_id = Column(Integer)
     message_name = Column(String)
     file_unique_id = Column(String, nullable=True, default=None)
+    # Хэш содержимого файла на момент загрузки: по нему запись переносится
+    # в реестр media_files без повторной загрузки
+    checksum = Column(String, nullable=True, default=None)
+
+
+async def ensure_big_mes_columns(conn) -> None:
+    """Добавить в big_mes колонки, появившиеся после создания таблицы"""
+    result = await conn.execute(
+        text("SELECT name FROM pragma_table_info('big_mes')")
+    )
+    columns = {row[0] for row in result.all()}
+    if "checksum" not in columns:
+        await conn.execute(
+            text("ALTER TABLE big_mes ADD COLUMN checksum VARCHAR")
+        )
+
+
+# Медиа из файлов хранятся по хэшу содержимого (db.models.media_file):
+# одинаковые файлы загружаются в Telegram один раз, а изменённый файл
+# получает новый file_id. Реестр загружается в память при старте, после
+# чего отрисовка меню не ходит ни в БД, ни в Telegram. file_id
+# проверяется только когда отправка упала с "wrong file identifier".
+#
+# Записи big_mes по имени остались от прежней схемы: имя ->
+# (file_id, file_unique_id) и checksum файла. Они переносятся в реестр,
+# если хэш файла совпал, а также хранят альбомы
+_media_registry: Dict[str, Tuple[str, Optional[str]]] = {}
+_media_checksums: Dict[str, Optional[str]] = {}
+# Одно и то же содержимое под разными путями загружается один раз
+_upload_locks: Dict[Tuple[str, str], asyncio.Lock] = defaultdict(asyncio.Lock)
+
+
+async def load_media_registry() -> int:
+    """Загрузить реестр медиа и записи big_mes в память"""
+    async with AsyncSessionLocal() as session:
+        result = await session.execute(select(BigMes))
+        records = result.scalars().all()
+    _media_registry.clear()
+    _media_checksums.clear()
+    for record in records:
+        if record.message_id:
+            _register_media(
+                record.message_name,
+                record.message_id,
+                record.file_unique_id,
+                record.checksum,
+            )
+    return await load_media_files()
+
+
+def _register_media(
+    name: str,
+    file_id: str,
+    file_unique_id: Optional[str],
+    checksum: Optional[str] = None,
+) -> None:
+    _media_registry[name] = (str(file_id), file_unique_id)
+    _media_checksums[name] = checksum
+
+
+def get_cached_file_id(
+    file_path: str, media_type: MediaType = MediaType.PHOTO
+) -> Optional[str]:
+    """file_id неизменённого файла без обращения к БД и Telegram"""
+    try:
+        digest = cached_content_hash(file_path)
+    except OSError:
+        return None
+    cached = get_media_file(digest, media_type.value) if digest else None
+    return cached[0] if cached else None
+
+
+async def invalidate_media(file_ids: Set[str]) -> List[str]:
+    """
+    Забыть протухшие file_id в реестре и big_mes, чтобы следующий запрос
+    загрузил файл заново. Возвращает хэши и имена забытых записей
+    """
+    forgotten = await delete_media_files(file_ids)
+    names = [
+        name
+        for name, (file_id, _) in _media_registry.items()
+        if file_id in file_ids
+    ]
+    async with AsyncSessionLocal() as session:
+        for name in names:
+            await _delete_records_by_name(session, name)
+    return forgotten + names
+
+
+def is_wrong_file_id_error(error: Exception) -> bool:
+    """Ошибка Telegram о недействительном file_id"""
+    return "wrong file identifier" in str(error).lower()
+
+
+def purge_media_attachments(data: Dict[str, Any], file_ids: Set[str]) -> int:
+    """Удалить из dialog_data сохранённые MediaAttachment с file_ids"""
+    stale = [
+        key
+        for key, value in data.items()
+        if isinstance(value, MediaAttachment)
+        and value.file_id is not None
+        and value.file_id.file_id in file_ids
+    ]
+    for key in stale:
+        del data[key]
+    return len(stale)
+
+
+async def find_stale_file_ids(bot: Bot, concurrency: int = 8) -> Set[str]:
+    """Проверить все file_id реестра через get_file (только после сбоя)"""
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def check(file_id: str) -> Optional[str]:
+        async with semaphore:
+            return None if await is_valid_file_id(bot, file_id) else file_id
+
+    file_ids = media_file_ids() | {
+        file_id for file_id, _ in _media_registry.values()
+    }
+    results = await asyncio.gather(*(check(f) for f in file_ids))
+    return {file_id for file_id in results if file_id}
 
 
 # Базовые функции для работы с БД
@@ -62,6 +194,7 @@ async def _save_or_update_record(
     name: str,
     message_id: str,
     file_unique_id: Optional[str] = None,
+    checksum: Optional[str] = None,
 ) -> None:
     """Сохранить или обновить запись в БД"""
     existing_record = await _get_record_by_name(session, name)
@@ -70,15 +203,18 @@ async def _save_or_update_record(
         existing_record.message_id = message_id
         if file_unique_id:
             existing_record.file_unique_id = file_unique_id
+        existing_record.checksum = checksum
     else:
         session.add(
             BigMes(
                 message_id=message_id,
                 message_name=name,
                 file_unique_id=file_unique_id,
+                checksum=checksum,
             )
         )
     await session.commit()
+    _register_media(name, message_id, file_unique_id, checksum)
 
 
 async def _delete_records_by_name(session: AsyncSession, name: str) -> None:
@@ -87,6 +223,8 @@ async def _delete_records_by_name(session: AsyncSession, name: str) -> None:
     for record in records:
         await session.delete(record)
     await session.commit()
+    _media_registry.pop(name, None)
+    _media_checksums.pop(name, None)
 
 
 # Базовые функции для отправки медиа
@@ -173,64 +311,90 @@ async def _create_or_get_media(
     media_type: MediaType,
     force: bool = False,
     filename: Optional[str] = None,
-    validate: bool = True,
     caption: Optional[str] = None,
 ) -> Tuple[Optional[str], Optional[str]]:
     """
-    Универсальная функция для создания или получения медиа из БД
+    Универсальная функция для создания или получения медиа.
+    file_id ищется в реестре по хэшу содержимого файла без проверки,
+    загрузка в Telegram — только для нового содержимого
 
     Args:
         bot: Экземпляр бота
-        name: Имя записи в БД
+        name: Имя записи big_mes прежней схемы
         file_path: Путь к файлу
         media_type: Тип медиа
         force: Принудительное обновление
         filename: Имя файла для отправки
-        validate: Проверять ли валидность file_id
 
     Returns:
         Tuple[file_id, file_unique_id]
     """
     try:
-        async with AsyncSessionLocal() as session:
-            # Попытка получить из БД
-            if not force:
-                existing_record = await _get_record_by_name(session, name)
-                if existing_record and existing_record.message_id:
-                    if not validate or await is_valid_file_id(
-                        bot, str(existing_record.message_id)
-                    ):
-                        return (
-                            str(existing_record.message_id),
-                            existing_record.file_unique_id,
-                        )
-                    else:
-                        force = True
-
-            # Создание нового
-            if force or not existing_record:
-                try:
-                    message = await _send_media(
-                        bot, file_path, media_type, filename, caption
-                    )
-                    file_id, file_unique_id = _extract_file_ids(
-                        message, media_type
-                    )
+        # Файл перечитывается, только если изменились mtime/size
+        digest = await content_hash(file_path)
 
-                    await _save_or_update_record(
-                        session, name, file_id, file_unique_id
-                    )
-                    return file_id, file_unique_id
+        if not force:
+            cached = get_media_file(digest, media_type.value)
+            if cached:
+                return cached
+            # Запись big_mes для того же содержимого — переносим в реестр
+            legacy = _media_registry.get(name)
+            if legacy and _media_checksums.get(name) == digest:
+                await save_media_file(digest, media_type.value, *legacy)
+                return legacy
+
+        # Создание нового
+        async with _upload_locks[(digest, media_type.value)]:
+            # Пока ждали, то же содержимое мог загрузить другой запрос
+            cached = get_media_file(digest, media_type.value)
+            if cached and not force:
+                return cached
+            try:
+                message = await _send_media(
+                    bot, file_path, media_type, filename, caption
+                )
+                file_id, file_unique_id = _extract_file_ids(
+                    message, media_type
+                )
+                await save_media_file(
+                    digest, media_type.value, file_id, file_unique_id
+                )
+                return file_id, file_unique_id
 
-                except Exception as e:
-                    print(f"Error creating media {name}: {e}")
-                    return None, None
+            except Exception as e:
+                print(f"Error creating media {name}: {e}")
+                return None, None
 
     except Exception as e:
         print(f"General error in _create_or_get_media for {name}: {e}")
         return None, None
 
 
+async def sync_media(bot: Bot, name: str, media_type: MediaType) -> str:
+    """
+    Актуализировать file_id файла при старте. Возвращает "skipped"
+    (содержимое уже загружено, в том числе под другим путём),
+    "validated" (перенесена запись big_mes), "uploaded" или "failed"
+    """
+    digest = await content_hash(name)
+    if get_media_file(digest, media_type.value):
+        return "skipped"
+    # Запись big_mes: с тем же checksum переносим сразу, без checksum
+    # (создана до его появления) — после проверки file_id
+    legacy = _media_registry.get(name)
+    checksum = _media_checksums.get(name)
+    if legacy and (
+        checksum == digest
+        or (checksum is None and await is_valid_file_id(bot, legacy[0]))
+    ):
+        await save_media_file(digest, media_type.value, *legacy)
+        return "validated"
+    file_id, _ = await _create_or_get_media(
+        bot, name, name, media_type, force=True
+    )
+    return "uploaded" if file_id else "failed"
+
+
 # Специализированные функции с использованием универсальной
 async def create_hello_mes(
     bot: Bot,
@@ -318,24 +482,9 @@ async def create_edu_mes(
 ) -> Tuple[Optional[str], Optional[str]]:
     """Создать или получить образовательное сообщение"""
     try:
-        async with AsyncSessionLocal() as session:
-            # Получаем все записи с таким именем
-            all_records = await _get_all_records_by_name(session, name)
-
-            # Если не форсируем и есть ровно одна запись - возвращаем её
-            if not forse and len(all_records) == 1:
-                record = all_records[0]
-                return str(record.message_id), record.file_unique_id
-
-            # Иначе удаляем все старые записи
-            if all_records:
-                await _delete_records_by_name(session, name)
-
-            # Создаём новую
-            return await _create_or_get_media(
-                bot, name, name, MediaType.AUDIO, True, filename, False
-            )
-
+        return await _create_or_get_media(
+            bot, name, name, MediaType.AUDIO, forse, filename
+        )
     except Exception as e:
         print(f"Error in create_edu_mes: {e}")
         return None, None
@@ -405,14 +554,8 @@ async def create_education_audio(
 async def get_pay_photo(
     bot: Bot, name: str, is_gif: bool = False
 ) -> Tuple[Optional[str], Optional[str]]:
-    """Получить платёжное фото с проверкой валидности"""
-    file_id, file_unique_id = await create_pay_photo(bot, False, name, is_gif)
-
-    if file_id and file_unique_id and await is_valid_file_id(bot, file_id):
-        return file_id, file_unique_id
-
-    # Если невалидно - пересоздаём
-    return await create_pay_photo(bot, True, name, is_gif)
+    """Получить платёжное фото (file_id проверяется только при сбое)"""
+    return await create_pay_photo(bot, False, name, is_gif)
 
 
 async def get_hello_message(
@@ -424,16 +567,9 @@ async def get_hello_message(
     filename: Optional[str] = None,
     caption: Optional[str] = None,
 ) -> Tuple[Optional[str], Optional[str]]:
-    """Получить приветственное сообщение с проверкой валидности"""
-    file_id, file_unique_id = await create_hello_mes(
-        bot, False, name, is_pdf, is_video_note, is_edu, filename, caption
-    )
-
-    if file_id and file_unique_id and await is_valid_file_id(bot, file_id):
-        return file_id, file_unique_id
-
+    """Получить приветственное сообщение (без проверки file_id)"""
     return await create_hello_mes(
-        bot, True, name, is_pdf, is_video_note, is_edu, filename, caption
+        bot, False, name, is_pdf, is_video_note, is_edu, filename, caption
     )
 
 
@@ -442,13 +578,8 @@ async def get_edu_message(
     name: str,
     filename: str = "Введение в моё обучение.mp3",
 ) -> Tuple[Optional[str], Optional[str]]:
-    """Получить образовательное сообщение с проверкой валидности"""
-    file_id, file_unique_id = await create_edu_mes(bot, False, name, filename)
-
-    if file_id and file_unique_id and await is_valid_file_id(bot, file_id):
-        return file_id, file_unique_id
-
-    return await create_edu_mes(bot, True, name, filename)
+    """Получить образовательное сообщение (без проверки file_id)"""
+    return await create_edu_mes(bot, False, name, filename)
 
 
 async def get_education_audio(
@@ -459,14 +590,6 @@ async def get_education_audio(
         bot, animal, False, as_file
     )
 
-    if not file_id or not file_unique_id:
-        return None
-
-    if not await is_valid_file_id(bot, str(file_id)):
-        file_id, file_unique_id = await create_education_audio(
-            bot, animal, True, as_file
-        )
-
     if file_id and file_unique_id:
         return MediaAttachment(
             file_id=MediaId(file_id, file_unique_id),
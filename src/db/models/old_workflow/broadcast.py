@@ -1,104 +1,223 @@
-from sqlalchemy import Column, Integer, text
-
-from db.db import AsyncSessionLocal, Base, get_engine
+from datetime import datetime, timedelta
+from typing import List, Optional
+
+from sqlalchemy import (
+    Column,
+    DateTime,
+    ForeignKey,
+    Index,
+    Integer,
+    String,
+    case,
+    func,
+    insert,
+    select,
+    text,
+)
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+from db.db import AsyncSessionLocal, Base
 from db.models.base import TimestampMixin
 
+LEGACY_COLUMNS = ("id", "user_id", "created_at", "updated_at")
 
-class Broadcast(Base, TimestampMixin):
-    __tablename__ = "broadcasts"
 
-    id = Column(Integer, primary_key=True, autoincrement=True)
-    user_id = Column(Integer, unique=True)
+class BroadcastRun(Base, TimestampMixin):
+    """Одна рассылка администратора"""
 
+    __tablename__ = "broadcast_runs"
 
-async def create_broadcast(broadcast_name: str):
-    async with get_engine().begin() as conn:
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    name = Column(String, unique=True, nullable=False)
+    broadcast_type = Column(String, nullable=False)
+    started_at = Column(
+        DateTime,
+        nullable=False,
+        default=lambda: datetime.now(TimestampMixin.MSK),
+    )
+
+    __table_args__ = (Index("ix_broadcast_runs_started_at", "started_at"),)
+
+
+class BroadcastDelivery(Base):
+    """Результат доставки рассылки одному пользователю"""
+
+    __tablename__ = "broadcast_deliveries"
+
+    broadcast_id = Column(
+        Integer, ForeignKey("broadcast_runs.id"), primary_key=True
+    )
+    user_id = Column(Integer, primary_key=True)
+    status = Column(String, nullable=False)  # delivered/failed
+    error_code = Column(String, nullable=True)
+    ts = Column(
+        DateTime,
+        nullable=False,
+        default=lambda: datetime.now(TimestampMixin.MSK),
+    )
+
+    __table_args__ = (
+        Index("ix_broadcast_deliveries_status", "broadcast_id", "status"),
+        Index("ix_broadcast_deliveries_user_id", "user_id"),
+    )
+
+
+def _parse_broadcast_name(broadcast_name: str):
+    """broadcast_<кому>_<YYYYmmdd_HHMMSS> -> (тип, дата запуска)"""
+    parts = broadcast_name.split("_")
+    try:
+        started_at = datetime.strptime(
+            "_".join(parts[-2:]), "%Y%m%d_%H%M%S"
+        )
+    except ValueError:
+        return broadcast_name, None
+    return "_".join(parts[:-2]), started_at
+
+
+async def migrate_broadcast_columns(conn) -> None:
+    """
+    Перенести старые рассылки (по колонке на рассылку в таблице broadcasts)
+    в broadcast_runs/broadcast_deliveries и удалить старую таблицу.
+    Выполняется в транзакции init_db: при ошибке старая таблица остаётся
+    """
+    result = await conn.execute(
+        text(
+            "SELECT name FROM sqlite_master "
+            "WHERE type = 'table' AND name = 'broadcasts'"
+        )
+    )
+    if result.scalar_one_or_none() is None:
+        return
+
+    result = await conn.execute(
+        text("SELECT name FROM pragma_table_info('broadcasts')")
+    )
+    columns = [
+        row[0] for row in result.all() if row[0] not in LEGACY_COLUMNS
+    ]
+    for column in columns:
+        broadcast_type, started_at = _parse_broadcast_name(column)
         await conn.execute(
-            text(f"ALTER TABLE broadcasts ADD COLUMN {broadcast_name} BOOLEAN")
+            sqlite_insert(BroadcastRun)
+            .values(
+                name=column,
+                broadcast_type=broadcast_type,
+                started_at=started_at or datetime.now(TimestampMixin.MSK),
+            )
+            .on_conflict_do_nothing(index_elements=[BroadcastRun.name])
         )
-
-
-async def mark_broadcast_delivered(user_id: int, broadcast_name: str):
-    async with AsyncSessionLocal() as session:
-        await session.execute(
+        broadcast_id = (
+            await conn.execute(
+                select(BroadcastRun.id).where(BroadcastRun.name == column)
+            )
+        ).scalar_one()
+        await conn.execute(
             text(
                 f"""
-            INSERT INTO broadcasts (user_id, {broadcast_name}, created_at, updated_at)
-            VALUES (:user_id, TRUE, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP)
-            ON CONFLICT (user_id) DO UPDATE SET {broadcast_name} = TRUE, updated_at = CURRENT_TIMESTAMP
+            INSERT OR IGNORE INTO broadcast_deliveries
+                (broadcast_id, user_id, status, ts)
+            SELECT :broadcast_id, user_id,
+                CASE WHEN "{column}" THEN 'delivered' ELSE 'failed' END,
+                updated_at
+            FROM broadcasts WHERE "{column}" IS NOT NULL
             """
             ),
-            {"user_id": user_id},
+            {"broadcast_id": broadcast_id},
         )
-        await session.commit()
 
+    await conn.execute(text("DROP TABLE broadcasts"))
+    print(f"Migrated {len(columns)} broadcasts to broadcast_deliveries")
 
-async def mark_broadcast_failed(user_id: int, broadcast_name: str):
+
+async def create_broadcast(
+    broadcast_name: str, broadcast_type: Optional[str] = None
+) -> int:
+    """Зарегистрировать рассылку, вернуть её id"""
+    if broadcast_type is None:
+        broadcast_type, _ = _parse_broadcast_name(broadcast_name)
     async with AsyncSessionLocal() as session:
-        await session.execute(
-            text(
-                f"""
-            INSERT INTO broadcasts (user_id, {broadcast_name}, created_at, updated_at)
-            VALUES (:user_id, FALSE, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP)
-            ON CONFLICT (user_id) DO UPDATE SET {broadcast_name} = FALSE, updated_at = CURRENT_TIMESTAMP
-            """
-            ),
-            {"user_id": user_id},
+        result = await session.execute(
+            insert(BroadcastRun)
+            .values(name=broadcast_name, broadcast_type=broadcast_type)
+            .returning(BroadcastRun.id)
         )
+        broadcast_id = result.scalar_one()
+        await session.commit()
+        return broadcast_id
+
+
+async def save_broadcast_statuses(rows: List[dict]) -> None:
+    """Записать пачку статусов (broadcast_id, user_id, status, error_code)"""
+    now = datetime.now(TimestampMixin.MSK)
+    rows = [{"error_code": None, **row, "ts": now} for row in rows]
+    stmt = sqlite_insert(BroadcastDelivery)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[
+            BroadcastDelivery.broadcast_id,
+            BroadcastDelivery.user_id,
+        ],
+        set_={
+            "status": stmt.excluded.status,
+            "error_code": stmt.excluded.error_code,
+            "ts": stmt.excluded.ts,
+        },
+    )
+    async with AsyncSessionLocal() as session:
+        await session.execute(stmt, rows)
         await session.commit()
 
 
+async def get_broadcast_delivered_users(broadcast_id: int) -> set:
+    """Пользователи, которым рассылка уже доставлена (для продолжения)"""
+    async with AsyncSessionLocal() as session:
+        result = await session.execute(
+            select(BroadcastDelivery.user_id).where(
+                BroadcastDelivery.broadcast_id == broadcast_id,
+                BroadcastDelivery.status == "delivered",
+            )
+        )
+        return set(result.scalars().all())
+
+
 async def get_broadcast_statistics(
     start_date: str = None, end_date: str = None
 ):
+    """Статистика всех рассылок за период (даты в формате YYYYmmdd)"""
+    stmt = (
+        select(
+            BroadcastRun.broadcast_type,
+            BroadcastRun.started_at,
+            func.count(
+                case((BroadcastDelivery.status == "delivered", 1))
+            ).label("successful"),
+            func.count(case((BroadcastDelivery.status == "failed", 1))).label(
+                "failed"
+            ),
+            func.count(BroadcastDelivery.user_id).label("total"),
+        )
+        .outerjoin(
+            BroadcastDelivery,
+            BroadcastDelivery.broadcast_id == BroadcastRun.id,
+        )
+        .group_by(BroadcastRun.id)
+        .order_by(BroadcastRun.started_at)
+    )
+    if start_date and end_date:
+        start = datetime.strptime(start_date, "%Y%m%d")
+        end = datetime.strptime(end_date, "%Y%m%d") + timedelta(days=1)
+        stmt = stmt.where(
+            BroadcastRun.started_at >= start, BroadcastRun.started_at < end
+        )
+
     async with AsyncSessionLocal() as session:
-        columns_query = """
-            SELECT name FROM pragma_table_info('broadcasts')
-            WHERE name NOT IN ('id', 'user_id', 'created_at', 'updated_at')
-        """
-        result = await session.execute(text(columns_query))
-        broadcast_columns = [row[0] for row in result.fetchall()]
-
-        statistics = []
-        for broadcast_name in broadcast_columns:
-            try:
-                # Извлекаем дату из конца названия бродкаста
-                # Ищем последнее вхождение '_' и берем всё после него
-                date_str = (
-                    broadcast_name.split("_")[-2]
-                    + "_"
-                    + broadcast_name.split("_")[-1]
-                )
-
-                # Фильтруем по датам если они указаны
-                if start_date and end_date:
-                    if not (start_date <= date_str <= end_date):
-                        continue
-
-                stats_query = f"""
-                    SELECT 
-                        '{broadcast_name}' as broadcast_name,
-                        SUM(CASE WHEN {broadcast_name} = TRUE THEN 1 ELSE 0 END) as successful,
-                        SUM(CASE WHEN {broadcast_name} = FALSE OR {broadcast_name} IS NULL THEN 1 ELSE 0 END) as failed,
-                        COUNT(*) as total
-                    FROM broadcasts 
-                """
-                result = await session.execute(text(stats_query))
-                stats = result.fetchone()
-
-                if stats:
-                    statistics.append(
-                        {
-                            "date": date_str,
-                            "broadcast_type": "_".join(
-                                broadcast_name.split("_")[:-2]
-                            ),  # Добавляем тип бродкаста
-                            "successful": int(stats.successful or 0),
-                            "failed": int(stats.failed or 0),
-                            "total": int(stats.total or 0),
-                        }
-                    )
-            except (IndexError, ValueError):
-                continue
-
-        return sorted(statistics, key=lambda x: x["date"])
+        result = await session.execute(stmt)
+        return [
+            {
+                "date": row.started_at.strftime("%Y%m%d_%H%M%S"),
+                "broadcast_type": row.broadcast_type,
+                "successful": row.successful,
+                "failed": row.failed,
+                "total": row.total,
+            }
+            for row in result.all()
+        ]
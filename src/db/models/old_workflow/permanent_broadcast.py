@@ -1,8 +1,15 @@
-import asyncio
-from typing import Dict
+from typing import Dict, List
 
 from aiogram.types import Message
-from sqlalchemy import Column, ForeignKey, Integer, String, delete, select
+from sqlalchemy import (
+    Column,
+    ForeignKey,
+    Integer,
+    String,
+    delete,
+    insert,
+    select,
+)
 from sqlalchemy.orm import relationship
 
 from db.db import AsyncSessionLocal, Base
@@ -87,21 +94,10 @@ async def delete_permanent_broadcast(broadcast_id: int):
         await session.commit()
 
 
-async def mark_broadcast_delivered(user_id: int, broadcast_id: int):
+async def save_permanent_broadcast_statuses(rows: List[dict]) -> None:
+    """Записать пачку статусов (broadcast_id, user_id, status)"""
     async with AsyncSessionLocal() as session:
-        status = PermanentBroadcastStatus(
-            broadcast_id=broadcast_id, user_id=user_id, status="delivered"
-        )
-        session.add(status)
-        await session.commit()
-
-
-async def mark_broadcast_failed(user_id: int, broadcast_id: int):
-    async with AsyncSessionLocal() as session:
-        status = PermanentBroadcastStatus(
-            broadcast_id=broadcast_id, user_id=user_id, status="failed"
-        )
-        session.add(status)
+        await session.execute(insert(PermanentBroadcastStatus), rows)
         await session.commit()
 
 
@@ -131,40 +127,38 @@ async def get_users_with_status(broadcast_id: int, status: str):
 async def broadcast_permanent(
     message: Message, users, broadcast_id: int
 ) -> Dict[str, int]:
-    success_count = 0
-    fail_count = 0
-    skipped_count = 0
+    from config.config import get_config
+    from manager.broadcaster import Broadcaster, StatusWriter
 
-    async with AsyncSessionLocal() as session:
-        # Получаем список пользователей, которые уже получили это сообщение
-        delivered_users = select(PermanentBroadcastStatus.user_id).where(
-            PermanentBroadcastStatus.broadcast_id == broadcast_id,
-            PermanentBroadcastStatus.status == "delivered",
+    config = get_config()
+    # Отправляем только тем, кто еще не получал
+    already_received = set(
+        await get_users_with_status(broadcast_id, "delivered")
+    )
+
+    async with StatusWriter.from_config(
+        save_permanent_broadcast_statuses, config
+    ) as writer:
+
+        async def on_failed(user_id: int, error: Exception):
+            await writer.add(
+                broadcast_id=broadcast_id, user_id=user_id, status="failed"
+            )
+
+        async def on_delivered(user_id: int):
+            await writer.add(
+                broadcast_id=broadcast_id,
+                user_id=user_id,
+                status="delivered",
+            )
+
+        return await Broadcaster.from_config(config).run(
+            message.copy_to,
+            users,
+            on_delivered=on_delivered,
+            on_failed=on_failed,
+            skip=already_received,
         )
-        result = await session.execute(delivered_users)
-        already_received = {r[0] for r in result.all()}
-
-        # Отправляем только тем, кто еще не получал
-        for user in users:
-            if user in already_received:
-                skipped_count += 1
-                continue
-
-            try:
-                await message.copy_to(user)
-                await mark_broadcast_delivered(user, broadcast_id)
-                success_count += 1
-            except Exception:
-                await mark_broadcast_failed(user, broadcast_id)
-                fail_count += 1
-
-            await asyncio.sleep(0.05)
-
-    return {
-        "success": success_count,
-        "fail": fail_count,
-        "skipped": skipped_count,
-    }
 
 
 async def permanent_broadcast_for_everybody(
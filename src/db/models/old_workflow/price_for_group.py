@@ -1,3 +1,5 @@
+from typing import Dict, Iterable
+
 from sqlalchemy import ForeignKey, String, select
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Mapped, mapped_column
@@ -18,6 +20,47 @@ class PriceForGroup(Base, TimestampMixin):
     amount: Mapped[int]  # Цена для группы
 
 
+# Матрица цен {group_number: {service_name: amount}}, группа 0 — базовые цены.
+# Строится целиком из БД и пересобирается после каждого изменения цен.
+_price_matrix: Dict[int, Dict[str, int]] = {}
+
+
+async def load_price_matrix(session: AsyncSession | None = None) -> None:
+    """Загрузить все цены (базовые и групповые) одной парой запросов"""
+    from db.models.price import Price
+
+    global _price_matrix
+
+    if session is None:
+        async with AsyncSessionLocal() as session:
+            await load_price_matrix(session)
+        return
+
+    base_prices = dict(BASE_PRICES)
+    result = await session.execute(select(Price.name, Price.amount))
+    base_prices.update(dict(result.all()))
+
+    matrix = {0: base_prices}
+    result = await session.execute(
+        select(
+            PriceForGroup.group_number,
+            PriceForGroup.service_name,
+            PriceForGroup.amount,
+        )
+    )
+    for group_number, service_name, amount in result.all():
+        if group_number not in matrix:
+            matrix[group_number] = dict(base_prices)
+        matrix[group_number][service_name] = amount
+
+    _price_matrix = matrix
+
+
+def _lookup_price(group_number: int, service_name: str) -> int:
+    prices = _price_matrix.get(group_number) or _price_matrix[0]
+    return prices[service_name]
+
+
 async def set_group_price(
     group_number: int, service_name: str, amount: int
 ) -> None:
@@ -41,6 +84,7 @@ async def set_group_price(
             price.amount = amount
 
         await session.commit()
+    await load_price_matrix()
 
 
 async def get_price_for_user(user_id: int, service_name: str) -> int:
@@ -52,24 +96,36 @@ async def get_price_for_user(user_id: int, service_name: str) -> int:
 
 async def get_price_for_group(group_number: int, service_name: str) -> int:
     """Получает цену для конкретной группы и сервиса"""
-    from db.models.price import get_price
+    if not _price_matrix:
+        await load_price_matrix()
+    # Если специальной цены нет, в матрице лежит базовая
+    return _lookup_price(group_number, service_name)
 
-    if group_number == 0:
-        return await get_price(service_name)
 
-    async with AsyncSessionLocal() as session:
-        stmt = select(PriceForGroup).where(
-            PriceForGroup.group_number == group_number,
-            PriceForGroup.service_name == service_name,
-        )
-        result = await session.execute(stmt)
-        price = result.scalar_one_or_none()
+async def get_prices_for_users(
+    user_ids: Iterable[int], service_name: str
+) -> Dict[int, int]:
+    """Цены сервиса для многих пользователей (например, для рассылок)"""
+    from db.models.user import User
 
-        # Если специальной цены нет, возвращаем базовую
-        if price is None:
-            return await get_price(service_name, session)
+    if not _price_matrix:
+        await load_price_matrix()
 
-        return price.amount
+    user_ids = list(user_ids)
+    prices = {}
+    async with AsyncSessionLocal() as session:
+        # Ограничение SQLite на число параметров в запросе
+        for i in range(0, len(user_ids), 500):
+            result = await session.execute(
+                select(User.user_id, User.ab_test_group).where(
+                    User.user_id.in_(user_ids[i : i + 500])
+                )
+            )
+            for user_id, group_number in result.all():
+                prices[user_id] = _lookup_price(
+                    group_number or 0, service_name
+                )
+    return prices
 
 
 async def init_group_prices(
@@ -91,6 +147,7 @@ async def init_group_prices(
                 )
                 session.add(price)
             await session.commit()
+            await load_price_matrix(session)
     else:
         for service_name, base_price in BASE_PRICES.items():
             # print(f"ELSEEEEEE = {service_name}")
@@ -102,6 +159,7 @@ async def init_group_prices(
             )
             session.add(price)
         await session.commit()
+        await load_price_matrix(session)
 
 
 async def delete_all_group_prices(session=None) -> int:
@@ -114,6 +172,7 @@ async def delete_all_group_prices(session=None) -> int:
             for price in prices:
                 await session.delete(price)
             await session.commit()
+            await load_price_matrix(session)
             return count
     else:
         result = await session.execute(select(PriceForGroup))
@@ -122,4 +181,5 @@ async def delete_all_group_prices(session=None) -> int:
         for price in prices:
             await session.delete(price)
         await session.commit()
+        await load_price_matrix(session)
         return count
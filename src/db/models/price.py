@@ -168,3 +168,7 @@ async def set_price(service_name: str, amount: int) -> None:
             price.amount = amount
 
         await session.commit()
+
+    from db.models.old_workflow.price_for_group import load_price_matrix
+
+    await load_price_matrix()
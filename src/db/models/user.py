@@ -1,11 +1,14 @@
 from datetime import datetime
+from typing import Dict, Optional
 
+from cachetools import TTLCache
 from sqlalchemy import (
     Boolean,
     Column,
     Float,
     Integer,
     String,
+    case,
     func,
     select,
     update,
@@ -59,11 +62,30 @@ class User(Base, TimestampMixin):
     language = Column(String, nullable=True)
 
 
+# Кэш профилей пользователей (LRU + TTL). Сеттеры ниже сбрасывают запись
+# пользователя после коммита, TTL ограничивает устаревание между процессами.
+USER_CACHE_SIZE = 10000
+USER_CACHE_TTL = 30
+
+_user_cache: TTLCache = TTLCache(maxsize=USER_CACHE_SIZE, ttl=USER_CACHE_TTL)
+_user_cache_stats = {"hits": 0, "misses": 0}
+
+
+def invalidate_user_cache(user_id: Optional[int] = None) -> None:
+    """Сбросить профиль пользователя в кэше (без user_id — весь кэш)"""
+    if user_id is None:
+        _user_cache.clear()
+    else:
+        _user_cache.pop(user_id, None)
+
+
+def get_user_cache_stats() -> dict:
+    return {**_user_cache_stats, "size": len(_user_cache)}
+
+
 async def get_user_language(user_id: int):
-    async with AsyncSessionLocal() as session:
-        stmt = select(User.language).where(User.user_id == user_id)
-        result = await session.execute(stmt)
-        return result.scalar_one_or_none()
+    user = await get_user(user_id)
+    return user.language if user else None
 
 
 async def set_language(user_id: int, language: str):
@@ -75,13 +97,11 @@ async def set_language(user_id: int, language: str):
         )
         await session.execute(stmt)
         await session.commit()
+        invalidate_user_cache(user_id)
 
 
 async def do_we_know_user_language(user_id: int):
-    async with AsyncSessionLocal() as session:
-        stmt = select(User.language).where(User.user_id == user_id)
-        result = await session.execute(stmt)
-        return result.scalar_one_or_none() is not None
+    return await get_user_language(user_id) is not None
 
 
 async def get_all_users_ids():
@@ -110,6 +130,7 @@ async def set_recived_inactive_spam(
         )
         await session.execute(stmt)
         await session.commit()
+        invalidate_user_cache(user_id)
 
 
 async def set_name(user_id: int, name: str) -> None:
@@ -117,20 +138,17 @@ async def set_name(user_id: int, name: str) -> None:
         stmt = update(User).where(User.user_id == user_id).values(name=name)
         await session.execute(stmt)
         await session.commit()
+        invalidate_user_cache(user_id)
 
 
 async def get_name(user_id: int) -> str:
-    async with AsyncSessionLocal() as session:
-        stmt = select(User.name).where(User.user_id == user_id)
-        result = await session.execute(stmt)
-        return result.scalar_one_or_none()
+    user = await get_user(user_id)
+    return user.name if user else None
 
 
 async def get_phone(user_id: int) -> str:
-    async with AsyncSessionLocal() as session:
-        stmt = select(User.phone).where(User.user_id == user_id)
-        result = await session.execute(stmt)
-        return result.scalar_one_or_none()
+    user = await get_user(user_id)
+    return user.phone if user else None
 
 
 async def set_phone(user_id: int, phone: str) -> None:
@@ -138,6 +156,7 @@ async def set_phone(user_id: int, phone: str) -> None:
         stmt = update(User).where(User.user_id == user_id).values(phone=phone)
         await session.execute(stmt)
         await session.commit()
+        invalidate_user_cache(user_id)
 
 
 async def create_user(user_id: int, username: str = "") -> User:
@@ -152,23 +171,32 @@ async def create_user(user_id: int, username: str = "") -> User:
             user = User(user_id=user_id, username=username)
             session.add(user)
         await session.commit()
+        invalidate_user_cache(user_id)
         await session.refresh(user)
     return user
 
 
 async def get_user(user_id: int) -> User:
+    user = _user_cache.get(user_id)
+    if user is not None:
+        _user_cache_stats["hits"] += 1
+        return user
+
+    _user_cache_stats["misses"] += 1
     async with AsyncSessionLocal() as session:
         stmt = select(User).where(User.user_id == user_id)
         result = await session.execute(stmt)
         user = result.scalar_one_or_none()
+        if user is not None:
+            # Отвязываем от сессии: объект живёт в кэше дольше неё
+            session.expunge(user)
+            _user_cache[user_id] = user
     return user
 
 
 async def get_user_balance(user_id: int) -> float:
-    async with AsyncSessionLocal() as session:
-        stmt = select(User.balance).where(User.user_id == user_id)
-        result = await session.execute(stmt)
-        return result.scalar_one_or_none()
+    user = await get_user(user_id)
+    return user.balance if user else None
 
 
 async def get_user_group(user_id: int) -> int:
@@ -176,39 +204,9 @@ async def get_user_group(user_id: int) -> int:
     return user.ab_test_group
 
 
-async def update_user_balance(
-    user_id: int,
-    new_balance: float,
-    froze: bool = False,
-    froze_value: float = 0,
-) -> None:
-
-    async with AsyncSessionLocal() as session:
-        if froze:
-            stmt = (
-                update(User)
-                .where(User.user_id == user_id)
-                .values(frozen_balance=froze_value, balance=new_balance)
-            )
-        else:
-            stmt = (
-                update(User)
-                .where(User.user_id == user_id)
-                .values(balance=new_balance)
-            )
-
-        await session.execute(stmt)
-        await session.commit()
-
-
 async def get_user_balance_to_use_this_month(user_id: int) -> float:
-
-    async with AsyncSessionLocal() as session:
-        stmt = select(User.balance_to_use_this_month).where(
-            User.user_id == user_id
-        )
-        result = await session.execute(stmt)
-        return result.scalar_one_or_none()
+    user = await get_user(user_id)
+    return user.balance_to_use_this_month if user else None
 
 
 async def update_user_balance_to_use_this_month(
@@ -222,6 +220,7 @@ async def update_user_balance_to_use_this_month(
         )
         await session.execute(stmt)
         await session.commit()
+        invalidate_user_cache(user_id)
 
 
 async def update_user_frozen_balance(user_id: int, sub_balance: float) -> None:
@@ -229,10 +228,55 @@ async def update_user_frozen_balance(user_id: int, sub_balance: float) -> None:
         stmt = (
             update(User)
             .where(User.user_id == user_id)
-            .values(frozen_balance=User.frozen_balance - sub_balance)
+            .values(
+                frozen_balance=func.max(User.frozen_balance - sub_balance, 0)
+            )
         )
         await session.execute(stmt)
         await session.commit()
+        invalidate_user_cache(user_id)
+
+
+async def add_user_balance(user_id: int, amount: float) -> Optional[float]:
+    """
+    Атомарно изменить баланс на amount (может быть отрицательным),
+    не опуская его ниже нуля. Возвращает новый баланс.
+    """
+    async with AsyncSessionLocal() as session:
+        stmt = (
+            update(User)
+            .where(User.user_id == user_id)
+            .values(balance=func.max(User.balance + amount, 0))
+            .returning(User.balance)
+        )
+        result = await session.execute(stmt)
+        new_balance = result.scalar_one_or_none()
+        await session.commit()
+        invalidate_user_cache(user_id)
+        return new_balance
+
+
+async def freeze_user_balance(user_id: int, amount: float) -> Optional[float]:
+    """
+    Атомарно списать amount с баланса в замороженный баланс.
+    Если на балансе меньше amount, ничего не меняет и возвращает None,
+    иначе возвращает новый баланс.
+    """
+    async with AsyncSessionLocal() as session:
+        stmt = (
+            update(User)
+            .where(User.user_id == user_id, User.balance >= amount)
+            .values(
+                balance=User.balance - amount,
+                frozen_balance=func.coalesce(User.frozen_balance, 0) + amount,
+            )
+            .returning(User.balance)
+        )
+        result = await session.execute(stmt)
+        new_balance = result.scalar_one_or_none()
+        await session.commit()
+        invalidate_user_cache(user_id)
+        return new_balance
 
 
 async def get_all_users():
@@ -336,32 +380,24 @@ async def update_user_refer_id(user_id: int, refer_id: int) -> None:
         )
         await session.execute(stmt)
         await session.commit()
+        invalidate_user_cache(user_id)
 
 
 async def get_ab_group(user_id: int):
-    async with AsyncSessionLocal() as session:
-        stmt = select(User.ab_test_group).where(User.user_id == user_id)
-        result = await session.execute(stmt)
-        return result.scalar_one_or_none()
+    user = await get_user(user_id)
+    return user.ab_test_group if user else None
 
 
 async def get_user_created_at(user_id: int):
-    async with AsyncSessionLocal() as session:
-        stmt = select(User.created_at).where(User.user_id == user_id)
-        result = await session.execute(stmt)
-        created_at = result.scalar_one_or_none()
-        if created_at:
-            return created_at.strftime("%d.%m.%y")
-        return None
+    user = await get_user(user_id)
+    if user and user.created_at:
+        return user.created_at.strftime("%d.%m.%y")
+    return None
 
 
 async def get_free_predictions_count(user_id: int):
-    async with AsyncSessionLocal() as session:
-        stmt = select(User.free_predictions_count).where(
-            User.user_id == user_id
-        )
-        result = await session.execute(stmt)
-        return result.scalar_one_or_none()
+    user = await get_user(user_id)
+    return user.free_predictions_count if user else None
 
 
 async def set_user_free_predictions_count(user_id: int, count: int):
@@ -373,38 +409,84 @@ async def set_user_free_predictions_count(user_id: int, count: int):
         )
         await session.execute(stmt)
         await session.commit()
+        invalidate_user_cache(user_id)
 
 
-async def increase_free_predictions_count(user_id: int):
+async def increase_free_predictions_count(
+    user_id: int, count: int = 1
+) -> Optional[int]:
+    """Атомарно добавить прогнозы. Возвращает новое количество"""
     async with AsyncSessionLocal() as session:
-        stmt = select(User.free_predictions_count).where(
-            User.user_id == user_id
+        stmt = (
+            update(User)
+            .where(User.user_id == user_id)
+            .values(
+                free_predictions_count=User.free_predictions_count + count
+            )
+            .returning(User.free_predictions_count)
         )
         result = await session.execute(stmt)
-        current_count = result.scalar_one_or_none()
-        if current_count is not None:
-            stmt = (
-                update(User)
-                .where(User.user_id == user_id)
-                .values(free_predictions_count=current_count + 1)
-            )
-            await session.execute(stmt)
-            await session.commit()
+        new_count = result.scalar_one_or_none()
+        await session.commit()
+        invalidate_user_cache(user_id)
+        return new_count
 
 
-async def decrease_free_predictions_count(user_id: int):
+async def decrease_free_predictions_count(
+    user_id: int, count: int = 1
+) -> Optional[int]:
+    """
+    Атомарно списать прогнозы, не опуская счётчик ниже нуля.
+    Возвращает новое количество или None, если списывать было нечего.
+    """
     async with AsyncSessionLocal() as session:
-        stmt = select(User.free_predictions_count).where(
-            User.user_id == user_id
+        stmt = (
+            update(User)
+            .where(
+                User.user_id == user_id,
+                User.free_predictions_count > 0,
+            )
+            .values(
+                free_predictions_count=func.max(
+                    User.free_predictions_count - count, 0
+                )
+            )
+            .returning(User.free_predictions_count)
         )
         result = await session.execute(stmt)
-        current_count = result.scalar_one_or_none()
-
-        if current_count is not None and current_count > 0:
-            stmt = (
-                update(User)
-                .where(User.user_id == user_id)
-                .values(free_predictions_count=current_count - 1)
-            )
-            await session.execute(stmt)
-            await session.commit()
+        new_count = result.scalar_one_or_none()
+        await session.commit()
+        invalidate_user_cache(user_id)
+        return new_count
+
+
+async def increase_free_predictions_count_many(
+    credits: Dict[int, int], session=None
+) -> Dict[int, int]:
+    """
+    Атомарно начислить прогнозы многим пользователям ({user_id: сколько})
+    одним UPDATE ... WHERE user_id IN (...) RETURNING.
+    Возвращает новые количества {user_id: count}
+    """
+    if not credits:
+        return {}
+    if session is None:
+        async with AsyncSessionLocal() as session:
+            return await increase_free_predictions_count_many(credits, session)
+
+    stmt = (
+        update(User)
+        .where(User.user_id.in_(list(credits)))
+        .values(
+            free_predictions_count=User.free_predictions_count
+            + case(credits, value=User.user_id, else_=0)
+        )
+        .returning(User.user_id, User.free_predictions_count)
+        .execution_options(synchronize_session=False)
+    )
+    result = await session.execute(stmt)
+    new_counts = dict(result.all())
+    await session.commit()
+    for user_id in new_counts:
+        invalidate_user_cache(user_id)
+    return new_counts
@@ -4,7 +4,7 @@
 # from sqlalchemy import func, select, update
 
 # from db.db import AsyncSessionLocal
-# from db.models.user import User
+# from db.models.user import User, invalidate_user_cache
 
 
 # async def get_existing_groups() -> Set[int]:
@@ -108,7 +108,7 @@ from db.models.old_workflow.price_for_group import (
     delete_all_group_prices,
     init_group_prices,
 )
-from db.models.user import User
+from db.models.user import User, invalidate_user_cache
 
 
 async def reset_all_groups() -> Dict[str, int]:
@@ -124,6 +124,7 @@ async def reset_all_groups() -> Dict[str, int]:
         groups_deleted = await delete_all_ab_groups(session)
         await delete_all_group_prices(session)
         await session.commit()
+        invalidate_user_cache()
 
         return {"users_reset": users_reset, "groups_deleted": groups_deleted}
 
@@ -198,6 +199,7 @@ async def split_users_into_groups(
             start_idx += group_size
 
         await session.commit()
+        invalidate_user_cache()
 
     return group_distribution
 
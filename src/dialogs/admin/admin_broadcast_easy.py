@@ -10,11 +10,12 @@ from aiogram_dialog.widgets.input import MessageInput
 from aiogram_dialog.widgets.kbd import Button, Group, Select, SwitchTo
 from aiogram_dialog.widgets.text import Const, Format
 
+from config.config import get_config
 from db.models.old_workflow.ab_group import get_ab_groups
 from db.models.old_workflow.broadcast import (
     create_broadcast,
-    mark_broadcast_delivered,
-    mark_broadcast_failed,
+    get_broadcast_delivered_users,
+    save_broadcast_statuses,
 )
 from db.models.user import (
     get_all_user_ids,
@@ -26,6 +27,7 @@ from db.models.user import (
     get_users_today,
 )
 from dialogs.states import AdminStates
+from manager.broadcaster import Broadcaster, StatusWriter
 
 
 async def whom_to_broadcast(
@@ -42,28 +44,43 @@ async def whom_to_broadcast(
 
 
 async def broadcast(
-    message: Message, users, column_name: str
+    message: Message, users, broadcast_id: int
 ) -> Dict[str, int]:
-    success_count = 0
-    fail_count = 0
-
-    for user in users:
-        try:
-            await message.copy_to(user)
-            await mark_broadcast_delivered(user, column_name)
-            success_count += 1
-        except Exception:
-            await mark_broadcast_failed(user, column_name)
-            fail_count += 1
+    config = get_config()
+    # При повторном запуске той же рассылки доставленным не отправляем
+    delivered = await get_broadcast_delivered_users(broadcast_id)
+
+    async with StatusWriter.from_config(
+        save_broadcast_statuses, config
+    ) as writer:
+
+        async def on_failed(user_id: int, error: Exception):
+            await writer.add(
+                broadcast_id=broadcast_id,
+                user_id=user_id,
+                status="failed",
+                error_code=type(error).__name__,
+            )
 
-        await asyncio.sleep(0.01)  # Уменьшенная задержка для оптимизации
+        async def on_delivered(user_id: int):
+            await writer.add(
+                broadcast_id=broadcast_id,
+                user_id=user_id,
+                status="delivered",
+            )
 
-    return {"success": success_count, "fail": fail_count}
+        return await Broadcaster.from_config(config).run(
+            message.copy_to,
+            users,
+            on_delivered=on_delivered,
+            on_failed=on_failed,
+            skip=delivered,
+        )
 
 
-async def broadcast_for_everybody(message: Message, users, column_name: str):
+async def broadcast_for_everybody(message: Message, users, broadcast_id: int):
     try:
-        results = await broadcast(message, users, column_name)
+        results = await broadcast(message, users, broadcast_id)
     except Exception as e:
         print(f"Error: {e}")
         # await message.bot.send_message(
@@ -85,9 +102,8 @@ async def process_broadcast_message(
     message: Message, dialog: Dialog, manager: DialogManager
 ):
     whom_to_broadcast = manager.dialog_data["whom_to_broadcast"]
-    column_name = f"broadcast_{whom_to_broadcast}_{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}"
-    # column_name = generate_unique_column_name()
-    await create_broadcast(column_name)
+    broadcast_name = f"broadcast_{whom_to_broadcast}_{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}"
+    broadcast_id = await create_broadcast(broadcast_name)
     # print("\n\ncolumn_name\n\n", column_name)
     try:
         if whom_to_broadcast.startswith("ab_group_"):
@@ -118,7 +134,7 @@ async def process_broadcast_message(
     #     print(f"Error: {e}")
     #     await message.reply(f"Произошла ошибка при отправке рассылки. {e}")
     # return
-    asyncio.create_task(broadcast_for_everybody(message, users, column_name))
+    asyncio.create_task(broadcast_for_everybody(message, users, broadcast_id))
 
     await message.reply(
         "<i>Рассылка запущена в фоновом режиме. Вам придет уведомление когда она будет завершена.</i>"
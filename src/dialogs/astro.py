@@ -1,10 +1,8 @@
-import asyncio
-import re
 from datetime import datetime
 from pathlib import Path
 
 from aiogram import Bot, F
-from aiogram.types import ContentType, FSInputFile, Message
+from aiogram.types import BufferedInputFile, ContentType, Message
 from aiogram_dialog import Dialog, DialogManager, ShowMode, Window
 from aiogram_dialog.widgets.input import MessageInput, TextInput
 from aiogram_dialog.widgets.kbd import Button, Row
@@ -20,6 +18,7 @@ from db.models.user import (
     decrease_free_predictions_count,
     get_free_predictions_count,
     get_user_balance,
+    increase_free_predictions_count,
 )
 
 # from dialogs.payment import start_payment
@@ -30,106 +29,14 @@ from dialogs.states import (
     format_price,
     get_price_for_user,
 )
+from utils.ai_scheduler import Priority
 from utils.geocoding import GeocodingService
-from utils.openai_helper import generate_numerology_prediction
 from widgets.date_picker import DatePicker
 from widgets.time_picker import TimePicker
 
 ADMIN_IDS = load_config().admin_ids
 
 
-def fix_html_tags_simple(text: str) -> str:
-    """
-    Простое исправление HTML тегов - закрывает все незакрытые теги в конце текста.
-    """
-    if not text.strip():
-        return text
-
-    # Поддерживаемые HTML теги в Telegram
-    supported_tags = ["b", "i", "u", "s", "code", "pre", "a"]
-
-    # Стек для отслеживания открытых тегов
-    tag_stack = []
-
-    # Паттерн для поиска HTML тегов
-    tag_pattern = r"<(/?)(\w+)(?:\s[^>]*)?>"
-
-    for match in re.finditer(tag_pattern, text):
-        is_closing = bool(match.group(1))
-        tag_name = match.group(2).lower()
-
-        if tag_name not in supported_tags:
-            continue
-
-        if is_closing:
-            # Закрывающий тег - убираем из стека если есть
-            if tag_name in tag_stack:
-                tag_stack.remove(tag_name)
-        else:
-            # Открывающий тег - добавляем в стек
-            tag_stack.append(tag_name)
-
-    # Просто закрываем все незакрытые теги в конце
-    result = text
-    for tag in reversed(tag_stack):
-        result += f"</{tag}>"
-
-    return result
-
-
-def split_text_simple(text: str, max_length: int = 4000) -> list:
-    """
-    Простая разбивка текста на страницы с исправлением HTML.
-    """
-    if len(text) <= max_length:
-        return [fix_html_tags_simple(text)]
-
-    pages = []
-    # Разбиваем текст по абзацам
-    paragraphs = text.split("\n\n")
-    current_page = ""
-
-    for paragraph in paragraphs:
-        # Проверяем, поместится ли абзац
-        test_text = current_page + ("\n\n" if current_page else "") + paragraph
-
-        if len(test_text) <= max_length:
-            current_page = test_text
-        else:
-            # Сохраняем текущую страницу если она не пустая
-            if current_page:
-                pages.append(fix_html_tags_simple(current_page))
-                current_page = paragraph
-            else:
-                # Абзац слишком длинный - разбиваем по предложениям
-                sentences = paragraph.split(". ")
-                for i, sentence in enumerate(sentences):
-                    if i < len(sentences) - 1:
-                        sentence += ". "
-
-                    test_sentence = (
-                        current_page + (" " if current_page else "") + sentence
-                    )
-
-                    if len(test_sentence) <= max_length:
-                        current_page += (
-                            " " if current_page else ""
-                        ) + sentence
-                    else:
-                        if current_page:
-                            pages.append(fix_html_tags_simple(current_page))
-                            current_page = sentence
-                        else:
-                            # Предложение слишком длинное - просто добавляем
-                            pages.append(fix_html_tags_simple(sentence))
-
-    # Добавляем последнюю страницу
-    if current_page:
-        pages.append(fix_html_tags_simple(current_page))
-
-    return pages if pages else [fix_html_tags_simple(text)]
-
-
 async def process_name(
     message: Message, widget, dialog_manager: DialogManager, name: str
 ):
@@ -369,7 +276,7 @@ async def confirm_location(callback, button, dialog_manager: DialogManager):
         astro_manager = config.get_astro_manager()
 
         location_info = data.get("location_info", {})
-        subject = astro_manager.get_subject(
+        subject_kwargs = dict(
             name=name,
             year=birth_date.year,
             month=birth_date.month,
@@ -379,45 +286,25 @@ async def confirm_location(callback, button, dialog_manager: DialogManager):
             lng=lng,
             lat=lat,
             city=location_info.get("city"),
-            # country=location_info.country,
         )
-
-        # Генерируем SVG
-        svg_path = astro_manager.get_svg(
-            theme="dark",
-            # file_name=f"{name}.svg",
-            user_id=dialog_manager.event.from_user.id,
-            subject=subject,
+        # Карта из кэша или расчёт в пуле процессов, без временных файлов
+        _, natal_json = await astro_manager.build_natal_chart_async(
+            theme="dark", **subject_kwargs
         )
+        chart_key = astro_manager.chart_key(theme="dark", **subject_kwargs)
         await set_natal_svg(
             user_id=dialog_manager.event.from_user.id,
-            natal_svg=svg_path,
+            natal_svg=chart_key,
         )
-        natal_json = astro_manager.get_natal_json(subject=subject)
         await set_natal_json(
             user_id=dialog_manager.event.from_user.id,
             natal_json=natal_json,
         )
         # print("NATAL JSON", natal_json)
 
-        # # Пытаемся конвертировать в PNG
-        # print("BURDAAA 5", svg_path)
-        # png_path = SVGConverter.convert(
-        #     svg_path, png_path=svg_path.with_suffix(".png")
-        # )
-
-        # Сохраняем путь к файлу для следующего окна
-        # if png_path and png_path.exists():
-        #     dialog_manager.dialog_data["chart_path"] = str(png_path)
-        #     dialog_manager.dialog_data["is_png"] = True
-        #     # Удаляем SVG если успешно конвертировали
-        #     svg_path.unlink(missing_ok=True)
-        # else:
-        # Если не удалось конвертировать, используем SVG
+        # SVG остаётся в памяти AstroManager, окну передаём только ключ
         dialog_manager.dialog_data["natal_json"] = natal_json
-        dialog_manager.dialog_data["chart_path"] = str(svg_path)
-        dialog_manager.dialog_data["is_png"] = False
-
+        dialog_manager.dialog_data["chart_key"] = chart_key
         await dialog_manager.switch_to(
             AstroStates.ai_prediction_input, show_mode=ShowMode.EDIT
         )
@@ -428,50 +315,79 @@ async def confirm_location(callback, button, dialog_manager: DialogManager):
         )
 
 
+def _chart_file_id(chart_cache, chart_key, kind: str):
+    if chart_cache and chart_key:
+        return chart_cache.get_file_id(chart_key, kind)
+    return None
+
+
 async def send_chart(dialog_manager: DialogManager, **kwargs):
     """Отправка натальной карты"""
-    chart_path = dialog_manager.dialog_data.get("chart_path")
-    is_png = dialog_manager.dialog_data.get("is_png", False)
-
-    if chart_path and Path(chart_path).exists():
+    chart_key = dialog_manager.dialog_data.get("chart_key")
+    if not chart_key:
+        return {}
+    astro_manager = get_config().get_astro_manager()
+    raster_service = get_config().get_raster_service()
+    # SVG растеризуется в пуле процессов и уходит фото
+    kind = "png" if raster_service else "svg"
+    chart_cache = astro_manager.chart_cache
+
+    # Карта уже загружалась в Telegram — отправляем по file_id
+    file_id = _chart_file_id(chart_cache, chart_key, kind)
+    svg = None if file_id else astro_manager.get_chart_svg(chart_key)
+
+    if file_id or svg:
         bot: Bot = dialog_manager.middleware_data["bot"]
         user_id = dialog_manager.event.from_user.id
 
-        if is_png:
+        photo = file_id if kind == "png" else None
+        if kind == "png" and not file_id:
+            try:
+                png = await raster_service.render(svg.encode("utf-8"))
+                photo = BufferedInputFile(png, "natal_chart.png")
+            except Exception as e:
+                print(f"Error rendering natal chart: {e}")
+                kind = "svg"
+                file_id = _chart_file_id(chart_cache, chart_key, kind)
+
+        if photo:
             # Отправляем как фото если это PNG
-            await bot.send_photo(
+            message = await bot.send_photo(
                 chat_id=user_id,
-                photo=FSInputFile(chart_path),
+                photo=photo,
                 caption="🌟 Ваша натальная карта готова!",
             )
+            sent_file_id = message.photo[-1].file_id
         else:
             # Отправляем как документ если это SVG
-            await bot.send_document(
+            message = await bot.send_document(
                 chat_id=user_id,
-                document=FSInputFile(chart_path),
+                document=file_id
+                or BufferedInputFile(svg.encode("utf-8"), "natal_chart.svg"),
                 caption="🌟 Ваша натальная карта готова!\n\n"
                 "📎 Файл в формате SVG можно открыть в браузере.",
             )
+            sent_file_id = message.document.file_id
 
-        # Удаляем временный файл
-        Path(chart_path).unlink(missing_ok=True)
+        # Повторные отправки той же карты идут по file_id
+        if chart_cache and not file_id:
+            chart_cache.set_file_id(chart_key, sent_file_id, kind)
 
     return {}
 
 
-async def ai_prediction_loading_getter(
-    dialog_manager: DialogManager, **kwargs
-):
-    """Getter for AI prediction loading screen"""
-    loading_text = dialog_manager.dialog_data.get(
-        "loading_text", "Анализирую числовые вибрации..."
-    )
-    ai_pred_photo = dialog_manager.dialog_data.get("ai_pred_photo")
-
-    return {
-        "loading_text": loading_text,
-        "ai_pred_photo": ai_pred_photo,
-    }
+LOADING_MESSAGES = [
+    "🌙 <i>Настраиваюсь на потоки космической энергии...</i>",
+    "🌙 <i>Погружаюсь в тайны вашей натальной карты...</i>",
+    "🌙 <i>Собираю картину вашей судьбы через звёзды...</i>",
+    "🌙 <i>Раскрываю послания, зашифрованные в планетах...</i>",
+    "🌙 <i>Исследую гармонию небесных тел в вашем гороскопе...</i>",
+    "🌙 <i>Анализирую влияние планет на ваш жизненный путь...</i>",
+    "🌙 <i>Изучаю аспекты между планетами в момент рождения...</i>",
+    "🌙 <i>Расшифровываю символы астрологических домов...</i>",
+    "🌙 <i>Считываю энергетические потоки созвездий...</i>",
+    "🌙 <i>Формирую персональный астрологический прогноз...</i>",
+]
 
 
 async def on_submit_query(
@@ -501,7 +417,10 @@ async def on_submit_query(
     """Handle user query submission for AI prediction"""
     user_id = message.from_user.id
 
-    free_predictions = await get_free_predictions_count(user_id)
+    # Прогноз списывается сразу, условным UPDATE: пока задание ждёт в
+    # очереди, следующий запрос уже не пройдёт по тому же прогнозу. Если
+    # задание окончательно не удастся, очередь вернёт его пользователю
+    reserved = await decrease_free_predictions_count(user_id) is not None
 
     dialog_manager.dialog_data["ai_query"] = message.text
 
@@ -509,7 +428,7 @@ async def on_submit_query(
     # print("FREE PREDICTIONS", free_predictions)
     if paid_prediction:
         dialog_manager.dialog_data["paid_prediction"] = False
-    elif free_predictions <= 0:
+    elif not reserved:
         try:
             await message.delete()
         except Exception as e:
@@ -539,89 +458,47 @@ async def on_submit_query(
         pass
     except Exception as e:
         print(e)
-    await dialog_manager.switch_to(
-        AstroStates.ai_prediction_loading,
-        show_mode=ShowMode.EDIT,
-    )
-
+    submitted = False
     try:
         natal_json = dialog_manager.dialog_data.get("natal_json")
-        task = asyncio.create_task(
-            generate_numerology_prediction(message.text, natal_json)
-        )
-        loading_messages = [
-            "🌙 <i>Настраиваюсь на потоки космической энергии...</i>",
-            "🌙 <i>Погружаюсь в тайны вашей натальной карты...</i>",
-            "🌙 <i>Собираю картину вашей судьбы через звёзды...</i>",
-            "🌙 <i>Раскрываю послания, зашифрованные в планетах...</i>",
-            "🌙 <i>Исследую гармонию небесных тел в вашем гороскопе...</i>",
-            "🌙 <i>Анализирую влияние планет на ваш жизненный путь...</i>",
-            "🌙 <i>Изучаю аспекты между планетами в момент рождения...</i>",
-            "🌙 <i>Расшифровываю символы астрологических домов...</i>",
-            "🌙 <i>Считываю энергетические потоки созвездий...</i>",
-            "🌙 <i>Формирую персональный астрологический прогноз...</i>",
-        ]
-
-        for i in range(len(loading_messages)):
-            dialog_manager.dialog_data["loading_text"] = loading_messages[i]
-            await dialog_manager.update({"loading_text": loading_messages[i]})
-            if (
-                i < len(loading_messages) - 1
-            ):  # Don't delay after the last message
-                await asyncio.sleep(1.5)
-
-        await dialog_manager.event.bot.send_chat_action(
-            user_id, "find_location"
-        )
-        # try:
-        #     await dialog_manager.event.bot.send_chat_action(user_id, "playing")
-        #     await asyncio.sleep(2)
-        # except Exception as er:
-        #     print(er)
-        #     pass
-        # try:
-        #     await dialog_manager.event.bot.send_chat_action(user_id, "typing")
-        #     await asyncio.sleep(1.5)
-        # except Exception:
-        #     pass
-        # try:
-        #     await dialog_manager.event.bot.send_chat_action(
-        #         user_id, "choose_sticker"
-        #     )
-        #     await asyncio.sleep(1.5)
-        # except Exception:
-        #     pass
-        try:
-            prediction = await task
-        except Exception as e:
-            print(f"\n\nError generating numerology prediction: {e}\n\n")
-            prediction = "Произошла ошибка при получении предсказания. Пожалуйста, попробуйте ещё раз чуть позже!"
-
-        dialog_manager.dialog_data["ai_prediction"] = prediction
-
-        try:
-            await decrease_free_predictions_count(user_id)
-        except Exception as e:
-            print(f"\n\nError decreasing free predictions count: {e}\n\n")
-
-        await dialog_manager.switch_to(
-            AstroStates.ai_prediction_result,
-            show_mode=ShowMode.DELETE_AND_SEND,
+        priority = Priority.PAID if paid_prediction else Priority.FREE
+        progress = await message.answer(LOADING_MESSAGES[0])
+        await dialog_manager.event.bot.send_chat_action(user_id, "typing")
+
+        # Прогноз генерирует воркер очереди: правит сообщение progress по
+        # мере генерации и присылает ответ. Обработчик не ждёт генерацию
+        _, created = await get_config().get_ai_jobs().submit(
+            f"{message.chat.id}:{message.message_id}",
+            user_id,
+            message.chat.id,
+            message.text,
+            natal_json,
+            priority,
+            progress.message_id,
+            reserved=int(reserved),
         )
+        submitted = True
+        if not created:
+            # Повтор того же апдейта попал на уже созданное задание, а
+            # прогноз за него уже зарезервирован
+            if reserved:
+                await increase_free_predictions_count(user_id)
+            await progress.delete()
 
     except Exception as e:
+        if reserved and not submitted:
+            await increase_free_predictions_count(user_id)
 
         print(f"\n\nError generating numerology prediction: {e}\n\n")
 
         error_message = """<i><u>Произошла ошибка</u> при получении предсказания.</i> 
 
 <b><i>Пожалуйста, попробуйте ещё раз чуть позже!</i></b>"""
-        dialog_manager.dialog_data["ai_prediction"] = error_message
+        await message.answer(error_message)
 
-        await dialog_manager.switch_to(
-            AstroStates.ai_prediction_result,
-            show_mode=ShowMode.DELETE_AND_SEND,
-        )
+    await dialog_manager.start(
+        YogaClubStates.main, show_mode=ShowMode.DELETE_AND_SEND
+    )
 
 
 async def ai_prediction_getter(dialog_manager: DialogManager, **kwargs):
@@ -642,76 +519,6 @@ async def restart_location(callback, button, dialog_manager: DialogManager):
     await dialog_manager.switch_to(AstroStates.natal_place)
 
 
-async def next_page(callback, button, dialog_manager: DialogManager):
-    """Переход на следующую страницу"""
-    current_page = dialog_manager.dialog_data.get("current_page", 0)
-    dialog_manager.dialog_data["current_page"] = current_page + 1
-    await dialog_manager.update({})
-
-
-async def prev_page(callback, button, dialog_manager: DialogManager):
-    """Переход на предыдущую страницу"""
-    current_page = dialog_manager.dialog_data.get("current_page", 0)
-    dialog_manager.dialog_data["current_page"] = current_page - 1
-    await dialog_manager.update({})
-
-
-async def ai_prediction_result_getter(dialog_manager: DialogManager, **kwargs):
-    """Getter for AI prediction result screen"""
-    try:
-        prediction = dialog_manager.dialog_data.get("ai_prediction", "")
-        # print("PREDICTION", prediction)
-        current_page = dialog_manager.dialog_data.get("current_page", 0)
-
-        # Максимальная длина сообщения в Telegram (оставляем запас для кнопок)
-        MAX_MESSAGE_LENGTH = 4000
-
-        # Используем простую функцию для разбиения текста с исправлением HTML
-        pages = split_text_simple(prediction, MAX_MESSAGE_LENGTH)
-
-        total_pages = len(pages)
-        # print("CURRENT PAGE", current_page)
-        # print("TOTAL PAGES", total_pages)
-
-        if current_page >= total_pages:
-            current_page = total_pages - 1
-            dialog_manager.dialog_data["current_page"] = current_page
-        elif current_page < 0:
-            current_page = 0
-            dialog_manager.dialog_data["current_page"] = current_page
-
-        has_next = current_page < total_pages - 1
-        has_prev = current_page > 0
-
-        current_page_text = (
-            pages[current_page] if 0 <= current_page < len(pages) else ""
-        )
-
-        return {
-            "ai_prediction": current_page_text,
-            "current_page": current_page,
-            "total_pages": total_pages,
-            "show_pagination": total_pages > 1,
-            "has_next": has_next,
-            "has_prev": has_prev,
-            # "page_info": f"Страница {current_page + 1} из {total_pages}",
-        }
-    except Exception as e:
-        print(f"Error in ai_prediction_result_getter: {e}")
-        # В случае ошибки возвращаем безопасные значения
-        prediction = dialog_manager.dialog_data.get(
-            "ai_prediction", "Произошла ошибка при отображении прогноза."
-        )
-        return {
-            "ai_prediction": prediction,
-            "current_page": 0,
-            "total_pages": 1,
-            "show_pagination": False,
-            "has_next": False,
-            "has_prev": False,
-        }
-
-
 async def back_to_main(callback, button, dialog_manager: DialogManager):
     """Вернуться в главное меню"""
     await dialog_manager.start(
@@ -719,28 +526,6 @@ async def back_to_main(callback, button, dialog_manager: DialogManager):
     )
 
 
-async def back_to_main_save(callback, button, dialog_manager: DialogManager):
-    """Вернуться в главное меню"""
-    prediction = dialog_manager.dialog_data.get("ai_prediction", "")
-    # print("PREDICTION", prediction)
-    current_page = 0
-
-    MAX_MESSAGE_LENGTH = 4000
-
-    pages = split_text_simple(prediction, MAX_MESSAGE_LENGTH)
-
-    for page in pages:
-        await dialog_manager.event.bot.send_message(
-            dialog_manager.event.from_user.id,
-            page,
-            parse_mode="HTML",
-        )
-
-    await dialog_manager.start(
-        YogaClubStates.main, show_mode=ShowMode.DELETE_AND_SEND
-    )
-
-
 async def ai_photo_getter(dialog_manager: DialogManager, **kwargs):
     """Getter for AI photo"""
     if dialog_manager.dialog_data.get("ai_pred_photo") is None:
@@ -1014,37 +799,6 @@ astro_dialog = Dialog(
         # getter=ai_photo_getter,
         getter=ai_question_getter,
     ),
-    Window(
-        # DynamicMedia("ai_pred_photo", when="ai_pred_photo"),
-        Format("{loading_text}"),
-        state=AstroStates.ai_prediction_loading,
-        getter=ai_prediction_loading_getter,
-    ),
-    Window(
-        Format("{ai_prediction}"),
-        Row(
-            Button(
-                Const("<< Назад"),
-                id="prev_page",
-                on_click=prev_page,
-                when=F["has_prev"],
-            ),
-            Button(
-                Const("Вперед >>"),
-                id="next_page",
-                on_click=next_page,
-                when=F["has_next"],
-            ),
-        ),
-        Button(
-            # Const("Вернуться в главное меню"),
-            Const("[ Принимаю и благодарю ]"),
-            id="back_to_main_2",
-            on_click=back_to_main_save,
-        ),
-        state=AstroStates.ai_prediction_result,
-        getter=ai_prediction_result_getter,
-    ),
 )
 
 # if len(prediction) <= MAX_MESSAGE_LENGTH:
@@ -6,7 +6,7 @@ from aiogram_dialog.widgets.text import Const, Format, Jinja
 from config import config
 from db.models.asto_info import get_astro_info
 from db.models.order import create_order, update_order_status
-from db.models.user import get_user, update_user_balance
+from db.models.user import freeze_user_balance, get_user
 from utils.robokassa import do_robocassa
 
 from .states import PaymentStates, YogaClubStates, format_price_and_balance
@@ -90,6 +90,20 @@ async def on_use_balance(
     start_data = manager.start_data
     user_id = c.from_user.id
 
+    # Списываем баланс до создания заказа: если его успели потратить
+    # в другом месте, заказ не создаётся
+    if dialog_data["balance_to_use"] > 0 and not dialog_data.get(
+        "was_balance"
+    ):
+        new_balance = await freeze_user_balance(
+            user_id, dialog_data["balance_to_use"]
+        )
+        if new_balance is None:
+            await c.answer(
+                "Баланс изменился, попробуйте ещё раз.", show_alert=True
+            )
+            return
+
     dialog_data["was_balance"] = True
 
     order = await create_order(
@@ -119,15 +133,6 @@ async def on_use_balance(
         # await on_back(None, None, manager)
         # return
 
-    new_balance = dialog_data["user_balance"] - dialog_data["balance_to_use"]
-
-    await update_user_balance(
-        user_id,
-        new_balance,
-        froze=True,
-        froze_value=dialog_data["balance_to_use"],
-    )
-
     manager.dialog_data.update(dialog_data)
     if dialog_data["amount_to_pay"] > 0:
         await manager.switch_to(PaymentStates.payment)
@@ -174,8 +174,6 @@ class AstroStates(StatesGroup):
     confirm_location = State()
     show_result = State()
     ai_prediction_input = State()
-    ai_prediction_result = State()
-    ai_prediction_loading = State()
 
 
 class AboutMeStates(StatesGroup):
@@ -12,7 +12,7 @@ from aiogram_dialog import DialogManager, ShowMode, StartMode
 from config.config import get_config
 from db.models.first_mes import try_to_del_and_add_new_first_mes
 from db.models.old_workflow.links import increment_link_clicks
-from db.models.old_workflow.price_for_group import get_price_for_user
+from db.models.old_workflow.price_for_group import get_prices_for_users
 from db.models.user import (
     create_user,
     do_we_know_user_language,
@@ -204,6 +204,8 @@ async def send_all_spam(message: Message):
 
     users_ids = await get_all_user_ids()
     print(f"users_ids: {users_ids}")
+    # Цены всех получателей сразу, а не запрос группы на каждое сообщение
+    prices = await get_prices_for_users(users_ids, "subscription_start")
     config = get_config()
     spam_manager = config.get_spam_manager()
     try:
@@ -217,9 +219,7 @@ async def send_all_spam(message: Message):
                         name=await get_name(user_id),
                         date=datetime.now().strftime("%d.%m.%Y"),
                         balance=user.balance,
-                        price=await get_price_for_user(
-                            user_id, "subscription_start"
-                        ),
+                        price=prices.get(user_id),
                     )
                 except Exception as e:
                     print(f"Error sending spam to user {user_id}: {e}")
@@ -3,49 +3,44 @@ import logging
 import os
 from contextlib import asynccontextmanager
 from datetime import datetime
-from pathlib import Path
 
 import uvicorn
 from aiogram import Bot, Dispatcher, types
 from aiogram.client.default import DefaultBotProperties
-from aiogram.fsm.storage.memory import MemoryStorage
 from aiogram_dialog import setup_dialogs
 from fastapi import FastAPI
 from fastapi.responses import Response
 
 from config.config import get_config, load_config, logger
 from db.models.__init__ import init_db
-from db.models.old_workflow.big_mes import get_pay_photo_attachment
+from db.models.media_file import media_files_stats
+from db.models.old_workflow.big_mes import load_media_registry
+from db.models.old_workflow.price_for_group import load_price_matrix
+from db.models.user import get_user_cache_stats
 from dialogs import register_dialogs
 from handlers.payment_handler import PaymentHandler
+from manager.ai_jobs import AIJobQueue
+from manager.broadcaster import flush_status_writers
 from manager.spam_service import SpamManager
+from manager.update_queue import UpdateQueue
 from sheduler.sheduler import setup_scheduler
+from utils.ai_scheduler import get_ai_scheduler
 from utils.astro_manager import AstroManager
-from utils.midlwares import get_error_handler
+from utils.fsm_storage import create_fsm_storage
+from utils.media_preloader import preload_media
+from utils.midlwares import DbSessionMiddleware, get_error_handler
+from utils.svg_converter import RasterService
+from utils.transit_engine import load_ephemeris_table
 
 bot: Bot | None = None
 dp: Dispatcher | None = None
 scheduler = None
+update_queue: UpdateQueue | None = None
 
 
 async def set_commands(bot: Bot):
     # Preload media to cache file_ids inside Telegram
-    base_dir = Path(__file__).resolve().parent
-    await get_pay_photo_attachment(
-        bot, str(base_dir / "misk" / "navigation" / "main.png")
-    )
-    await get_pay_photo_attachment(
-        bot, str(base_dir / "misk" / "publication" / "1.png")
-    )
-    await get_pay_photo_attachment(
-        bot, str(base_dir / "misk" / "publication" / "2.png")
-    )
-    await get_pay_photo_attachment(
-        bot, str(base_dir / "misk" / "publication" / "3.png")
-    )
-    await get_pay_photo_attachment(
-        bot, str(base_dir / "misk" / "publication" / "4.png")
-    )
+    await preload_media(bot, get_config().media_preload_concurrency)
 
     try:
         await bot.delete_my_commands()
@@ -65,23 +60,31 @@ async def lifespan(app: FastAPI):
 
 
 async def startup():
-    global bot, dp, scheduler
+    global bot, dp, scheduler, update_queue
 
     try:
         # Init DB
         await init_db()
+        await load_price_matrix()
+        media_count = await load_media_registry()
+        logger.info(f"Loaded {media_count} media file_ids")
 
         # Init config and clients
         config = load_config()
         config.set_openai_client()
+        # Таблица эфемерид с прошлого запуска: первые sky_summary не
+        # считают swisseph, планировщик только досчитает окно
+        ephemeris_days = load_ephemeris_table(config.ephemeris_path)
+        logger.info(f"Loaded ephemeris table for {ephemeris_days} days")
 
         # Init bot/dispatcher
         bot = Bot(
             token=config.bot.token.get_secret_value(),
             default=DefaultBotProperties(parse_mode="HTML"),
         )
-        storage = MemoryStorage()
+        storage = create_fsm_storage(config, bot)
         dp = Dispatcher(storage=storage)
+        dp.update.outer_middleware(DbSessionMiddleware())
         dp.errors.register(get_error_handler(dp, bot))
 
         # Bot info and services
@@ -92,8 +95,22 @@ async def startup():
         config.set_payment_handler(payment_handler)
         spam_manager = SpamManager(bot)
         config.set_spam_manager(spam_manager)
-        astro_manager = AstroManager(bot)
+        astro_manager = AstroManager(
+            bot,
+            workers=config.astro_workers,
+            timeout=config.astro_timeout,
+            chart_cache_size=config.chart_cache_mb * 1024 * 1024,
+            memory_charts=config.chart_memory_count,
+        )
         config.set_astro_manager(astro_manager)
+        asyncio.create_task(astro_manager.warm_up())
+        if config.raster_workers > 0:
+            raster_service = RasterService.from_config(config)
+            config.set_raster_service(raster_service)
+            asyncio.create_task(raster_service.warm_up())
+        ai_jobs = AIJobQueue.from_config(bot, config)
+        config.set_ai_jobs(ai_jobs)
+        await ai_jobs.start()
 
         # Dialogs
         register_dialogs(dp)
@@ -102,6 +119,15 @@ async def startup():
         # Commands / preload media
         await set_commands(bot)
 
+        # Update queue
+        update_queue = UpdateQueue(
+            dp,
+            bot,
+            workers=config.update_workers,
+            max_size=config.update_queue_size,
+        )
+        update_queue.start()
+
         # Scheduler
         scheduler = setup_scheduler(bot)
         scheduler.start()
@@ -124,8 +150,16 @@ async def startup():
 
 
 async def shutdown():
-    global bot, scheduler
+    global bot, scheduler, update_queue
     try:
+        if update_queue:
+            await update_queue.stop()
+        # Дописываем статусы рассылок, прерванных остановкой
+        await flush_status_writers()
+        # Незавершённые AI-прогнозы возвращаются в очередь
+        ai_jobs = get_config().get_ai_jobs()
+        if ai_jobs:
+            await ai_jobs.stop()
         if bot:
             try:
                 await bot.delete_webhook(drop_pending_updates=True)
@@ -134,6 +168,16 @@ async def shutdown():
             await bot.session.close()
         if scheduler:
             scheduler.shutdown()
+        astro_manager = getattr(get_config(), "astro_manager", None)
+        if astro_manager:
+            astro_manager.shutdown()
+        raster_service = get_config().get_raster_service()
+        if raster_service:
+            raster_service.shutdown()
+        if get_config().open_ai_client:
+            await get_config().open_ai_client.close()
+        if dp:
+            await dp.storage.close()
     except Exception as e:
         logging.error(f"Shutdown error: {e}")
 
@@ -151,15 +195,56 @@ async def root():
     return {"status": "ok", "service": "timeai_bot"}
 
 
+@app.get("/queue")
+async def queue_stats():
+    if update_queue is None:
+        return Response(status_code=503)
+    return update_queue.stats()
+
+
+@app.get("/astro")
+async def astro_stats():
+    astro_manager = getattr(get_config(), "astro_manager", None)
+    if astro_manager is None:
+        return Response(status_code=503)
+    raster_service = get_config().get_raster_service()
+    return {
+        **astro_manager.stats(),
+        "raster": raster_service.stats() if raster_service else None,
+    }
+
+
+@app.get("/media")
+async def media_stats():
+    return media_files_stats()
+
+
+@app.get("/ai")
+async def ai_stats():
+    ai_jobs = get_config().get_ai_jobs()
+    return {
+        "scheduler": get_ai_scheduler().stats(),
+        "jobs": ai_jobs.stats() if ai_jobs else None,
+    }
+
+
+@app.get("/cache")
+async def cache_stats():
+    return {"users": get_user_cache_stats()}
+
+
 @app.post("/webhook")
 async def telegram_webhook(update: dict):
-    global bot, dp
+    global bot, dp, update_queue
     try:
-        if bot is None or dp is None:
+        if bot is None or dp is None or update_queue is None:
             return Response(status_code=503)
         telegram_update = types.Update(**update)
         # Process in background to respond fast
-        asyncio.create_task(dp.feed_update(bot=bot, update=telegram_update))
+        if not update_queue.put(telegram_update):
+            # Очередь переполнена — Telegram повторит доставку позже
+            logger.warning(f"Update queue is full: {update_queue.stats()}")
+            return Response(status_code=503)
         return {"status": "ok"}
     except Exception as e:
         logging.error(f"Webhook error: {e}")
@@ -0,0 +1,294 @@
+import asyncio
+import json
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+from aiogram import Bot
+
+from config.config import logger
+from db.models.ai_job import (
+    AIJob,
+    claim_ai_jobs,
+    complete_ai_job,
+    enqueue_ai_job,
+    fail_ai_job,
+    get_undelivered_ai_jobs,
+    mark_ai_job_delivered,
+    refund_failed_ai_jobs,
+    release_ai_jobs,
+    renew_ai_job_lease,
+    reset_expired_ai_jobs,
+    unmark_ai_job_delivered,
+)
+from utils.ai_scheduler import Priority
+from utils.html_text import split_text_simple, stream_preview
+from utils.openai_helper import (
+    request_numerology_prediction,
+    stream_numerology_prediction,
+)
+
+PREDICTION_ERROR_TEXT = (
+    "Произошла ошибка при получении предсказания. "
+    "Пожалуйста, попробуйте ещё раз чуть позже!"
+)
+
+
+class AIJobQueue:
+    """
+    Очередь AI-прогнозов в БД (таблица ai_jobs) и пул воркеров.
+
+    Обработчик диалога только ставит задание в очередь и сразу
+    возвращается, поэтому пропускную способность задаёт число воркеров,
+    а не обработчики апдейтов. Воркер берёт задание с арендой (lease) и
+    продлевает её, пока задание в работе; по мере генерации правит
+    сообщение "прогноз готовится" (message_id задания) и отправляет
+    ответ через bot.send_message. Задания с истёкшей арендой (воркер
+    умер) подбираются снова, неудачные попытки повторяются с
+    задержкой до max_attempts раз. Обработка выполняется хотя бы один
+    раз, повтор апдейта отсекается ключом идемпотентности. Прогноз
+    списывается при постановке в очередь (reserved) и возвращается
+    пользователю, если задание окончательно не удалось.
+    """
+
+    def __init__(
+        self,
+        bot: Bot,
+        *,
+        workers: int = 4,
+        lease: float = 120,
+        max_attempts: int = 3,
+        retry_delay: float = 10,
+        poll_interval: float = 5,
+        streaming: bool = True,
+        edit_interval: float = 1.5,
+    ) -> None:
+        self.bot = bot
+        self.workers = max(1, workers)
+        self.lease = lease
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.poll_interval = poll_interval
+        self.streaming = streaming
+        self.edit_interval = edit_interval
+        self._tasks: List[asyncio.Task] = []
+        self._in_flight: Dict[int, AIJob] = {}
+        self._wakeup = asyncio.Event()
+
+        # Метрики
+        self.processed = 0
+        self.failed = 0
+        self.retried = 0
+        self.sent = 0
+        self.refunded = 0
+        self._run_total = 0.0
+
+    @classmethod
+    def from_config(cls, bot: Bot, config) -> "AIJobQueue":
+        return cls(
+            bot,
+            # Столько генераций, сколько AIScheduler пропускает к модели
+            workers=config.ai_job_workers or config.openai_concurrency,
+            lease=config.ai_job_lease,
+            max_attempts=config.ai_job_max_attempts,
+            retry_delay=config.ai_job_retry_delay,
+            streaming=config.ai_streaming,
+            edit_interval=config.ai_stream_edit_interval,
+        )
+
+    async def start(self) -> None:
+        reset = await reset_expired_ai_jobs()
+        if reset:
+            logger.info(f"Requeued {reset} AI jobs with expired lease")
+        # Возвраты, прерванные остановкой между отказом и начислением
+        await self._refund()
+        for job in await get_undelivered_ai_jobs():
+            await self._deliver(job, job.result)
+        self._tasks = [
+            asyncio.create_task(self._worker(), name=f"ai-job-{i}")
+            for i in range(self.workers)
+        ]
+        logger.info(f"AI job queue started with {self.workers} workers")
+
+    async def stop(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        # Прерванные задания сразу возвращаем в очередь, не дожидаясь
+        # окончания аренды
+        await release_ai_jobs(list(self._in_flight))
+        self._in_flight.clear()
+
+    async def submit(
+        self,
+        idempotency_key: str,
+        user_id: int,
+        chat_id: int,
+        query: str,
+        natal_json: Any,
+        priority: Priority = Priority.FREE,
+        message_id: Optional[int] = None,
+        reserved: int = 0,
+    ) -> Tuple[int, bool]:
+        """
+        Поставить прогноз в очередь, вернуть (id, новое ли задание).
+        message_id — сообщение, в котором воркер показывает ход генерации,
+        reserved — сколько прогнозов уже списано за это задание
+        """
+        if natal_json is not None and not isinstance(natal_json, str):
+            natal_json = json.dumps(natal_json, ensure_ascii=False)
+        job_id, created = await enqueue_ai_job(
+            idempotency_key,
+            user_id,
+            chat_id,
+            query,
+            natal_json,
+            priority,
+            message_id,
+            reserved,
+        )
+        if created:
+            self._wakeup.set()
+        return job_id, created
+
+    async def _worker(self) -> None:
+        while True:
+            self._wakeup.clear()
+            try:
+                jobs = await claim_ai_jobs(1, self.lease)
+            except Exception as e:
+                logger.error(f"AI job claim error: {e}")
+                jobs = []
+            if not jobs:
+                try:
+                    await asyncio.wait_for(
+                        self._wakeup.wait(), self.poll_interval
+                    )
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            job = jobs[0]
+            self._in_flight[job.id] = job
+            # Генерация с повторами запросов может идти дольше аренды —
+            # без продления задание забрал бы второй воркер
+            heartbeat = asyncio.create_task(self._keep_lease(job.id))
+            try:
+                await self._process(job)
+            except Exception as e:
+                logger.error(f"AI job {job.id} error: {e}")
+            finally:
+                heartbeat.cancel()
+                self._in_flight.pop(job.id, None)
+
+    async def _keep_lease(self, job_id: int) -> None:
+        while True:
+            await asyncio.sleep(self.lease / 3)
+            try:
+                if not await renew_ai_job_lease(job_id, self.lease):
+                    return
+            except Exception as e:
+                logger.error(f"AI job {job_id} lease renewal error: {e}")
+
+    async def _generate(self, job: AIJob) -> str:
+        if not self.streaming or job.message_id is None:
+            return await request_numerology_prediction(
+                job.query, job.natal_json, job.user_id, Priority(job.priority)
+            )
+
+        loop = asyncio.get_running_loop()
+        # Первую готовую строку показываем сразу
+        edited_at = loop.time() - self.edit_interval
+        prediction = ""
+        async for prediction in stream_numerology_prediction(
+            job.query, job.natal_json, job.user_id, Priority(job.priority)
+        ):
+            if loop.time() - edited_at < self.edit_interval:
+                continue
+            preview = stream_preview(prediction)
+            if not preview:
+                continue
+            try:
+                await self.bot.edit_message_text(
+                    preview, chat_id=job.chat_id, message_id=job.message_id
+                )
+            except Exception as e:
+                # Сообщение могли удалить — ответ всё равно дочитываем
+                logger.error(f"AI job {job.id} progress error: {e}")
+            edited_at = loop.time()
+        return prediction
+
+    async def _process(self, job: AIJob) -> None:
+        started = time.monotonic()
+        try:
+            result = await self._generate(job)
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+            if job.attempts < self.max_attempts:
+                delay = self.retry_delay * 2 ** (job.attempts - 1)
+                await fail_ai_job(job.id, error, retry_delay=delay)
+                self.retried += 1
+                logger.warning(
+                    f"AI job {job.id} attempt {job.attempts} failed, "
+                    f"retry in {delay:.0f}s: {error}"
+                )
+                return
+            result = PREDICTION_ERROR_TEXT
+            await fail_ai_job(job.id, error, result=result)
+            self.failed += 1
+            logger.error(f"AI job {job.id} failed: {error}")
+            await self._refund()
+        else:
+            await complete_ai_job(job.id, result)
+            self.processed += 1
+            self._run_total += time.monotonic() - started
+        await self._deliver(job, result)
+
+    async def _refund(self) -> None:
+        """Вернуть прогнозы всех окончательно упавших заданий разом"""
+        try:
+            refunded = await refund_failed_ai_jobs()
+        except Exception as e:
+            logger.error(f"AI job refund error: {e}")
+            return
+        if refunded:
+            self.refunded += refunded
+            logger.info(f"Refunded {refunded} AI predictions")
+
+    async def _deliver(self, job: AIJob, text: str) -> None:
+        """
+        Отправить ответ сообщениями и убрать сообщение о ходе генерации.
+        Доставка занимается отметкой до отправки, поэтому ответ уходит
+        один раз; при ошибке отметка снимается, и доставку повторит
+        следующий запуск очереди
+        """
+        if not await mark_ai_job_delivered(job.id):
+            return
+        try:
+            for page in split_text_simple(text):
+                await self.bot.send_message(job.chat_id, page)
+        except Exception as e:
+            logger.error(f"AI job {job.id} delivery error: {e}")
+            await unmark_ai_job_delivered(job.id)
+            return
+        self.sent += 1
+        if job.message_id is not None:
+            try:
+                await self.bot.delete_message(job.chat_id, job.message_id)
+            except Exception as e:
+                logger.warning(f"AI job {job.id} progress cleanup: {e}")
+
+    def stats(self) -> dict:
+        return {
+            "workers": len(self._tasks),
+            "in_flight": len(self._in_flight),
+            "processed": self.processed,
+            "failed": self.failed,
+            "retried": self.retried,
+            "sent": self.sent,
+            "refunded": self.refunded,
+            "avg_run": (
+                round(self._run_total / self.processed, 2)
+                if self.processed
+                else 0.0
+            ),
+        }
@@ -0,0 +1,297 @@
+import asyncio
+import time
+import weakref
+from typing import Awaitable, Callable, Dict, Iterable, List, Optional, Set
+
+from aiogram.exceptions import (
+    TelegramBadRequest,
+    TelegramForbiddenError,
+    TelegramNetworkError,
+    TelegramNotFound,
+    TelegramRetryAfter,
+    TelegramServerError,
+)
+
+from config.config import logger
+
+# Ошибки, после которых повтор бессмысленен (бот заблокирован, чат удалён)
+PERMANENT_ERRORS = (
+    TelegramForbiddenError,
+    TelegramBadRequest,
+    TelegramNotFound,
+)
+# Временные ошибки, которые повторяем с экспоненциальной задержкой
+TRANSIENT_ERRORS = (
+    TelegramNetworkError,
+    TelegramServerError,
+    asyncio.TimeoutError,
+)
+
+SendFunc = Callable[[int], Awaitable]
+DeliveredCallback = Callable[[int], Awaitable]
+FailedCallback = Callable[[int, Exception], Awaitable]
+FlushFunc = Callable[[List[dict]], Awaitable]
+
+# Открытые писатели статусов, чтобы сбросить их буферы при остановке
+_active_writers: "weakref.WeakSet[StatusWriter]" = weakref.WeakSet()
+
+
+class TokenBucket:
+    """Ведро токенов: не больше rate отправок в секунду, всплеск до capacity"""
+
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self) -> None:
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(
+                    self.capacity,
+                    self.tokens + (now - self.updated_at) * self.rate,
+                )
+                self.updated_at = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class Broadcaster:
+    """
+    Движок массовых рассылок.
+
+    Отправляет через пул из workers корутин с общим ведром токенов
+    (глобальный лимит Telegram ~30 сообщений в секунду) и минимальным
+    интервалом между сообщениями в один чат. TelegramRetryAfter ставит
+    на паузу всю рассылку, временные ошибки повторяются с backoff.
+    Уже доставленные пользователи (skip) пропускаются, поэтому рассылку
+    можно перезапустить после падения.
+    """
+
+    def __init__(
+        self,
+        *,
+        rate: float = 25,
+        workers: int = 16,
+        chat_interval: float = 1.0,
+        max_retries: int = 3,
+        base_delay: float = 1.0,
+    ) -> None:
+        self.bucket = TokenBucket(rate)
+        self.workers = max(1, workers)
+        self.chat_interval = chat_interval
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self._last_sent: Dict[int, float] = {}
+        self._resume_at = 0.0
+
+    @classmethod
+    def from_config(cls, config) -> "Broadcaster":
+        return cls(
+            rate=config.broadcast_rate,
+            workers=config.broadcast_workers,
+            chat_interval=config.broadcast_chat_interval,
+            max_retries=config.broadcast_max_retries,
+        )
+
+    async def _wait_turn(self, chat_id: int) -> None:
+        # Глобальная пауза после flood control
+        while (delay := self._resume_at - time.monotonic()) > 0:
+            await asyncio.sleep(delay)
+        # Лимит на один чат
+        last = self._last_sent.get(chat_id)
+        if last is not None:
+            delay = last + self.chat_interval - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        await self.bucket.acquire()
+        self._last_sent[chat_id] = time.monotonic()
+
+    async def _send_one(self, send: SendFunc, chat_id: int) -> None:
+        attempt = 0
+        while True:
+            await self._wait_turn(chat_id)
+            try:
+                await send(chat_id)
+                return
+            except TelegramRetryAfter as e:
+                # Не считаем попыткой: Telegram сам сказал, сколько ждать
+                self._resume_at = max(
+                    self._resume_at, time.monotonic() + e.retry_after
+                )
+                logger.warning(
+                    f"Broadcast flood control, pause {e.retry_after}s"
+                )
+            except PERMANENT_ERRORS:
+                raise
+            except TRANSIENT_ERRORS:
+                attempt += 1
+                if attempt > self.max_retries:
+                    raise
+                await asyncio.sleep(self.base_delay * 2 ** (attempt - 1))
+
+    async def run(
+        self,
+        send: SendFunc,
+        user_ids: Iterable[int],
+        *,
+        on_delivered: Optional[DeliveredCallback] = None,
+        on_failed: Optional[FailedCallback] = None,
+        skip: Optional[Set[int]] = None,
+    ) -> Dict[str, int]:
+        """Разослать send(user_id) всем пользователям, вернуть счётчики"""
+        skip = skip or set()
+        results = {"success": 0, "fail": 0, "skipped": 0}
+        queue: asyncio.Queue = asyncio.Queue()
+        for user_id in dict.fromkeys(user_ids):
+            if user_id in skip:
+                results["skipped"] += 1
+            else:
+                queue.put_nowait(user_id)
+
+        async def worker() -> None:
+            while True:
+                try:
+                    user_id = queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    return
+                try:
+                    await self._send_one(send, user_id)
+                except Exception as e:
+                    results["fail"] += 1
+                    callback = on_failed and on_failed(user_id, e)
+                else:
+                    results["success"] += 1
+                    callback = on_delivered and on_delivered(user_id)
+                if callback:
+                    try:
+                        await callback
+                    except Exception as e:
+                        logger.error(f"Broadcast status error: {e}")
+
+        started_at = time.monotonic()
+        await asyncio.gather(
+            *(worker() for _ in range(min(self.workers, queue.qsize())))
+        )
+        self._last_sent.clear()
+
+        elapsed = time.monotonic() - started_at
+        logger.info(
+            f"Broadcast finished in {elapsed:.1f}s: {results}, "
+            f"{results['success'] / elapsed if elapsed else 0:.1f} msg/s"
+        )
+        return results
+
+
+class StatusWriter:
+    """
+    Буфер статусов доставки. Строки копятся в памяти и пишутся одним
+    executemany, когда набирается batch_size строк или проходит interval
+    секунд, а остаток — при закрытии. Вместо коммита на каждого получателя
+    получается один коммит на пачку.
+
+    Если запись не удалась, строки возвращаются в буфер и пишутся при
+    следующем сбросе (не раньше чем через interval). Буфер ограничен
+    max_backlog строками: при переполнении теряются самые старые статусы.
+    """
+
+    def __init__(
+        self,
+        flush: FlushFunc,
+        *,
+        batch_size: int = 500,
+        interval: float = 2.0,
+        max_backlog: int = 50000,
+        close_attempts: int = 3,
+    ) -> None:
+        self._flush = flush
+        self.batch_size = max(1, batch_size)
+        self.interval = interval
+        self.max_backlog = max(self.batch_size, max_backlog)
+        self.close_attempts = max(1, close_attempts)
+        self._rows: List[dict] = []
+        self._lock = asyncio.Lock()
+        self._timer: Optional[asyncio.Task] = None
+        self._retry_at = 0.0
+        self.dropped = 0
+
+    @classmethod
+    def from_config(cls, flush: FlushFunc, config) -> "StatusWriter":
+        return cls(
+            flush,
+            batch_size=config.broadcast_flush_size,
+            interval=config.broadcast_flush_interval,
+            max_backlog=config.broadcast_flush_backlog,
+        )
+
+    async def __aenter__(self) -> "StatusWriter":
+        self._timer = asyncio.create_task(self._flush_periodically())
+        _active_writers.add(self)
+        return self
+
+    async def __aexit__(self, *exc) -> None:
+        await self.close()
+
+    async def add(self, **row) -> None:
+        self._rows.append(row)
+        if (
+            len(self._rows) >= self.batch_size
+            and time.monotonic() >= self._retry_at
+        ):
+            await self.flush()
+
+    async def flush(self) -> bool:
+        """Записать буфер. False — запись не удалась, строки остались"""
+        async with self._lock:
+            rows, self._rows = self._rows, []
+            if not rows:
+                return True
+            try:
+                await self._flush(rows)
+            except Exception as e:
+                # Доставленные статусы нельзя терять: иначе продолженная
+                # рассылка отправит эти сообщения ещё раз
+                self._rows = rows + self._rows
+                self._retry_at = time.monotonic() + self.interval
+                overflow = len(self._rows) - self.max_backlog
+                if overflow > 0:
+                    del self._rows[:overflow]
+                    self.dropped += overflow
+                    logger.error(
+                        f"Status backlog is full, dropped {overflow} "
+                        "oldest statuses"
+                    )
+                logger.error(
+                    f"Failed to write {len(rows)} statuses, "
+                    f"{len(self._rows)} pending: {e}"
+                )
+                return False
+            return True
+
+    async def _flush_periodically(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            await self.flush()
+
+    async def close(self) -> None:
+        if self._timer:
+            self._timer.cancel()
+            self._timer = None
+        _active_writers.discard(self)
+        for attempt in range(self.close_attempts):
+            if attempt:
+                await asyncio.sleep(self.interval)
+            if await self.flush():
+                return
+        logger.error(f"Lost {len(self._rows)} statuses on close")
+
+
+async def flush_status_writers() -> None:
+    """Сбросить буферы всех незавершённых рассылок (при остановке бота)"""
+    for writer in list(_active_writers):
+        await writer.flush()
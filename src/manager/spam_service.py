@@ -8,6 +8,11 @@ from aiogram.types import (
 )
 
 from config.config import get_config
+from db.models.old_workflow.big_mes import (
+    get_cached_file_id,
+    invalidate_media,
+    is_wrong_file_id_error,
+)
 from dialogs.states import format_price_and_balance
 
 spam_types = {
@@ -537,7 +542,7 @@ class SpamManager:
 
             if photo_path:
                 try:
-                    # Используем FSInputFile для отправки файла
+                    # file_id, загруженный при старте, иначе сам файл
                     print("TYPE OF SPAM", type_of_spam)
                     base_dir = Path(__file__).resolve().parent.parent
                     abs_path = (
@@ -545,13 +550,24 @@ class SpamManager:
                         if Path(photo_path).is_absolute()
                         else str(base_dir / photo_path)
                     )
-                    photo = FSInputFile(abs_path)
-                    await self.bot.send_photo(
-                        user_id,
-                        photo=photo,
-                        caption=formatted_message,
-                        reply_markup=keyboard,
-                    )
+                    file_id = get_cached_file_id(abs_path)
+                    try:
+                        await self.bot.send_photo(
+                            user_id,
+                            photo=file_id or FSInputFile(abs_path),
+                            caption=formatted_message,
+                            reply_markup=keyboard,
+                        )
+                    except Exception as e:
+                        if not file_id or not is_wrong_file_id_error(e):
+                            raise
+                        await invalidate_media({file_id})
+                        await self.bot.send_photo(
+                            user_id,
+                            photo=FSInputFile(abs_path),
+                            caption=formatted_message,
+                            reply_markup=keyboard,
+                        )
                 except FileNotFoundError:
                     # Если файл не найден, отправляем только текст
                     await self.bot.send_message(
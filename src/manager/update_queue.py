@@ -0,0 +1,160 @@
+import asyncio
+import time
+from collections import deque
+from typing import Deque, Dict, Hashable, Optional, Tuple
+
+from aiogram import Bot, Dispatcher
+from aiogram.types import Update
+
+from config.config import logger
+
+
+def get_update_key(update: Update) -> Optional[int]:
+    """Ключ упорядочивания апдейта: id пользователя (или чата), если есть"""
+    try:
+        event = update.event
+    except Exception:
+        return None
+    from_user = getattr(event, "from_user", None)
+    if from_user is not None:
+        return from_user.id
+    chat = getattr(event, "chat", None)
+    if chat is None:
+        message = getattr(event, "message", None)
+        chat = getattr(message, "chat", None)
+    if chat is not None:
+        return chat.id
+    return None
+
+
+class UpdateQueue:
+    """
+    Очередь входящих апдейтов: цепочки по пользователю поверх общего пула.
+
+    У каждого пользователя (from_user.id) своя цепочка ожидающих апдейтов.
+    Воркеры общего пула берут из очереди готовых ключей пользователя, чей
+    апдейт можно выполнять, и обрабатывают его следующий апдейт. Пока
+    апдейт пользователя выполняется, его ключа нет среди готовых, поэтому
+    апдейты одного пользователя идут строго последовательно (без гонок
+    в FSM и повторных списаний). Медленный обработчик занимает один
+    воркер и не задерживает других пользователей, а воркеры никогда не
+    ждут на блокировке.
+    """
+
+    def __init__(
+        self,
+        dp: Dispatcher,
+        bot: Bot,
+        *,
+        workers: int = 64,
+        max_size: int = 10000,
+    ) -> None:
+        self.dp = dp
+        self.bot = bot
+        self.workers = max(1, workers)
+        self.max_size = max(1, max_size)
+        # Ключ присутствует, пока у пользователя есть ожидающие или
+        # выполняющийся апдейт; в _ready он стоит не более одного раза
+        self._chains: Dict[Hashable, Deque[Tuple[float, Update]]] = {}
+        self._ready: asyncio.Queue = asyncio.Queue()
+        self._tasks: list[asyncio.Task] = []
+        self._depth = 0
+        self._closing = False
+
+        # Метрики
+        self.accepted = 0
+        self.rejected = 0
+        self.processed = 0
+        self.failed = 0
+        self.max_depth = 0
+        self.max_wait = 0.0
+        self._wait_total = 0.0
+
+    def start(self) -> None:
+        for i in range(self.workers):
+            self._tasks.append(
+                asyncio.create_task(self._worker(), name=f"update-worker-{i}")
+            )
+        logger.info(f"Update queue started with {self.workers} workers")
+
+    def put(self, update: Update) -> bool:
+        """
+        Положить апдейт в цепочку его пользователя.
+        Возвращает False, если очередь переполнена или закрывается.
+        """
+        if self._closing or self._depth >= self.max_size:
+            self.rejected += 1
+            return False
+        key = get_update_key(update)
+        if key is None:
+            # Без пользователя упорядочивать не с чем
+            key = ("update", update.update_id)
+        item = (time.monotonic(), update)
+        chain = self._chains.get(key)
+        if chain is None:
+            self._chains[key] = deque([item])
+            self._ready.put_nowait(key)
+        else:
+            chain.append(item)
+        self._depth += 1
+        self.accepted += 1
+        self.max_depth = max(self.max_depth, self._depth)
+        return True
+
+    async def _worker(self) -> None:
+        while True:
+            key = await self._ready.get()
+            chain = self._chains[key]
+            enqueued_at, update = chain.popleft()
+            self._depth -= 1
+            try:
+                wait = time.monotonic() - enqueued_at
+                self._wait_total += wait
+                self.max_wait = max(self.max_wait, wait)
+                await self.dp.feed_update(bot=self.bot, update=update)
+                self.processed += 1
+            except Exception as e:
+                self.failed += 1
+                logger.error(
+                    f"Update {update.update_id} processing error: {e}"
+                )
+            finally:
+                # Следующий апдейт пользователя — в конец очереди готовых,
+                # чтобы активный пользователь не занимал воркер подряд
+                if chain:
+                    self._ready.put_nowait(key)
+                else:
+                    del self._chains[key]
+                self._ready.task_done()
+
+    def stats(self) -> dict:
+        finished = self.processed + self.failed
+        avg_wait = self._wait_total / finished if finished else 0.0
+        return {
+            "workers": self.workers,
+            "depth": self._depth,
+            "max_depth": self.max_depth,
+            "active_users": len(self._chains),
+            "longest_chain": max(map(len, self._chains.values()), default=0),
+            "accepted": self.accepted,
+            "rejected": self.rejected,
+            "processed": self.processed,
+            "failed": self.failed,
+            "avg_wait": round(avg_wait, 4),
+            "max_wait": round(self.max_wait, 4),
+        }
+
+    async def stop(self, timeout: float = 30.0) -> None:
+        """Перестать принимать апдейты и дождаться обработки всех цепочек"""
+        self._closing = True
+        try:
+            await asyncio.wait_for(self._ready.join(), timeout=timeout)
+        except asyncio.TimeoutError:
+            logger.warning(
+                f"Update queue drain timed out, {self._depth} updates left"
+            )
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks.clear()
+        logger.info(f"Update queue stopped: {self.stats()}")
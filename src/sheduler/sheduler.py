@@ -1,8 +1,15 @@
+import asyncio
+from datetime import datetime
+
 from aiogram import Bot
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from apscheduler.triggers.cron import CronTrigger
 from apscheduler.triggers.interval import IntervalTrigger
 
+from config.config import get_config, logger
+from db.models.old_workflow.price_for_group import load_price_matrix
+from utils.transit_engine import transit_engine, update_ephemeris_table
+
 # from utils.get_pay_photo_attachment import get_pay_photo_attachment
 
 
@@ -67,6 +74,24 @@ from apscheduler.triggers.interval import IntervalTrigger
 #             pass
 
 
+async def refresh_ephemeris_table():
+    """Пересчитать общую таблицу эфемерид на скользящее окно дней"""
+    config = get_config()
+    try:
+        table = await asyncio.to_thread(
+            update_ephemeris_table,
+            config.ephemeris_path,
+            config.ephemeris_days,
+        )
+    except Exception as e:
+        logger.error(f"Ephemeris table update error: {e}")
+        return
+    # Кэш transit_engine читают обработчики, поэтому меняется он только
+    # здесь, в event loop
+    if table is not None:
+        transit_engine.preload(*table)
+
+
 def setup_scheduler(bot: Bot):
     scheduler = AsyncIOScheduler()
 
@@ -94,4 +119,14 @@ def setup_scheduler(bot: Bot):
     # scheduler.add_job(send_daily_message, trigger, args=[bot])
     # scheduler.add_job(send_daily_message, daily_at_9, args=[bot])
 
+    # Подтягиваем изменения цен, сделанные в других процессах
+    scheduler.add_job(load_price_matrix, five_min)
+    # Эфемериды на окно дней: при старте (если таблица на диске не
+    # покрывает окно) и каждую ночь
+    scheduler.add_job(
+        refresh_ephemeris_table,
+        CronTrigger(hour=0, minute=5, timezone="Europe/Moscow"),
+        next_run_time=datetime.now(),
+    )
+
     return scheduler
@@ -0,0 +1,260 @@
+import asyncio
+import heapq
+import itertools
+import time
+from contextlib import asynccontextmanager
+from enum import IntEnum
+from typing import Awaitable, Callable, Dict, List, Optional, TypeVar
+
+from openai import (
+    APIConnectionError,
+    APITimeoutError,
+    InternalServerError,
+    RateLimitError,
+)
+
+from config.config import get_config, logger
+
+T = TypeVar("T")
+
+# Временные ошибки OpenAI, которые повторяем с экспоненциальной задержкой.
+# Остальные (400, 401, ...) пробрасываются сразу и автомат не трогают
+TRANSIENT_ERRORS = (
+    RateLimitError,
+    APIConnectionError,
+    APITimeoutError,
+    InternalServerError,
+)
+
+
+class Priority(IntEnum):
+    """Классы запросов: меньшее значение обслуживается раньше"""
+
+    PAID = 0
+    FREE = 1
+    ADMIN = 2
+
+
+class AIUnavailableError(Exception):
+    """Автомат разомкнут: OpenAI недавно подряд отвечал ошибками"""
+
+
+def _retry_after(error: Exception) -> Optional[float]:
+    """Задержка из заголовков Retry-After / retry-after-ms ответа"""
+    response = getattr(error, "response", None)
+    if response is None:
+        return None
+    headers = response.headers
+    try:
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000
+        if headers.get("retry-after"):
+            return float(headers["retry-after"])
+    except ValueError:
+        return None
+    return None
+
+
+class _ModelLane:
+    """Очередь к одной модели: лимит параллельных запросов и пауза"""
+
+    def __init__(self, limit: int) -> None:
+        self.limit = max(1, limit)
+        self.active = 0
+        self.waiters: List[tuple] = []
+        self.resume_at = 0.0
+        # Автомат: подряд идущие неудачи и до какого момента он разомкнут
+        self.failures = 0
+        self.open_until = 0.0
+
+    def release(self) -> None:
+        # Слот передаётся ожидающему с наивысшим приоритетом
+        while self.waiters:
+            _, _, future = heapq.heappop(self.waiters)
+            if not future.done():
+                future.set_result(None)
+                return
+        self.active -= 1
+
+
+class AIScheduler:
+    """
+    Планировщик запросов к OpenAI.
+
+    Для каждой модели свой лимит одновременных запросов, ожидающие
+    обслуживаются по приоритету (платный прогноз > бесплатный > админка),
+    внутри приоритета — по очереди. Временные ошибки повторяются с
+    экспоненциальной задержкой, Retry-After из 429 ставит на паузу всю
+    модель. После breaker_threshold неудач подряд модель отключается на
+    breaker_cooldown секунд, запросы сразу получают AIUnavailableError.
+    """
+
+    def __init__(
+        self,
+        *,
+        default_limit: int = 32,
+        model_limits: Optional[Dict[str, int]] = None,
+        max_retries: int = 3,
+        base_delay: float = 1.0,
+        max_delay: float = 30.0,
+        breaker_threshold: int = 5,
+        breaker_cooldown: float = 30.0,
+    ) -> None:
+        self.default_limit = default_limit
+        self.model_limits = model_limits or {}
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.breaker_threshold = breaker_threshold
+        self.breaker_cooldown = breaker_cooldown
+        self._lanes: Dict[str, _ModelLane] = {}
+        self._order = itertools.count()
+        self._waits: Dict[Priority, List[float]] = {
+            priority: [0, 0.0, 0.0] for priority in Priority
+        }
+
+    @classmethod
+    def from_config(cls, config) -> "AIScheduler":
+        return cls(
+            default_limit=config.openai_concurrency,
+            model_limits=config.ai_model_limits,
+            max_retries=config.ai_max_retries,
+            breaker_threshold=config.ai_breaker_threshold,
+            breaker_cooldown=config.ai_breaker_cooldown,
+        )
+
+    def _lane(self, model: str) -> _ModelLane:
+        lane = self._lanes.get(model)
+        if lane is None:
+            lane = _ModelLane(self.model_limits.get(model, self.default_limit))
+            self._lanes[model] = lane
+        return lane
+
+    def _check_breaker(self, model: str, lane: _ModelLane) -> None:
+        if lane.open_until > time.monotonic():
+            raise AIUnavailableError(f"OpenAI {model} temporarily disabled")
+
+    @asynccontextmanager
+    async def slot(self, model: str, priority: Priority = Priority.FREE):
+        """Занять слот модели (с учётом приоритета, паузы и автомата)"""
+        lane = self._lane(model)
+        self._check_breaker(model, lane)
+        queued_at = time.monotonic()
+        if lane.active < lane.limit and not lane.waiters:
+            lane.active += 1
+        else:
+            future = asyncio.get_running_loop().create_future()
+            heapq.heappush(lane.waiters, (priority, next(self._order), future))
+            try:
+                await future
+            except asyncio.CancelledError:
+                # Слот мог быть уже передан — возвращаем его следующему
+                if future.done() and not future.cancelled():
+                    lane.release()
+                raise
+
+        try:
+            while (delay := lane.resume_at - time.monotonic()) > 0:
+                await asyncio.sleep(delay)
+            self._check_breaker(model, lane)
+            self._record_wait(priority, time.monotonic() - queued_at)
+            yield
+        finally:
+            lane.release()
+
+    def _record_wait(self, priority: Priority, wait: float) -> None:
+        stats = self._waits[priority]
+        stats[0] += 1
+        stats[1] += wait
+        stats[2] = max(stats[2], wait)
+
+    def _on_failure(self, model: str, lane: _ModelLane) -> None:
+        lane.failures += 1
+        if lane.failures >= self.breaker_threshold:
+            lane.open_until = time.monotonic() + self.breaker_cooldown
+            logger.error(
+                f"OpenAI {model}: {lane.failures} failures in a row, "
+                f"disabled for {self.breaker_cooldown}s"
+            )
+
+    async def call(self, model: str, func: Callable[[], Awaitable[T]]) -> T:
+        """
+        Выполнить func() с повторами временных ошибок.
+        Вызывать внутри slot(): слот удерживается и на время задержек.
+        """
+        lane = self._lane(model)
+        attempt = 0
+        while True:
+            try:
+                result = await func()
+            except TRANSIENT_ERRORS as e:
+                if getattr(e, "code", None) == "insufficient_quota":
+                    # Закончились деньги на счёте — повторять бесполезно
+                    self._on_failure(model, lane)
+                    raise
+                attempt += 1
+                if attempt > self.max_retries:
+                    self._on_failure(model, lane)
+                    raise
+                delay = _retry_after(e)
+                if delay is not None:
+                    lane.resume_at = max(
+                        lane.resume_at, time.monotonic() + delay
+                    )
+                else:
+                    delay = min(
+                        self.max_delay, self.base_delay * 2 ** (attempt - 1)
+                    )
+                logger.warning(
+                    f"OpenAI {model}: {type(e).__name__}, "
+                    f"retry {attempt}/{self.max_retries} in {delay:.1f}s"
+                )
+                await asyncio.sleep(delay)
+            else:
+                lane.failures = 0
+                return result
+
+    async def run(
+        self,
+        model: str,
+        func: Callable[[], Awaitable[T]],
+        priority: Priority = Priority.FREE,
+    ) -> T:
+        """Дождаться слота модели и выполнить func() с повторами"""
+        async with self.slot(model, priority):
+            return await self.call(model, func)
+
+    def stats(self) -> dict:
+        now = time.monotonic()
+        return {
+            "models": {
+                model: {
+                    "limit": lane.limit,
+                    "active": lane.active,
+                    "queued": len(lane.waiters),
+                    "paused": max(0.0, round(lane.resume_at - now, 1)),
+                    "failures": lane.failures,
+                    "open": lane.open_until > now,
+                }
+                for model, lane in self._lanes.items()
+            },
+            "wait": {
+                priority.name.lower(): {
+                    "count": count,
+                    "avg": round(total / count, 3) if count else 0.0,
+                    "max": round(longest, 3),
+                }
+                for priority, (count, total, longest) in self._waits.items()
+            },
+        }
+
+
+_scheduler: Optional[AIScheduler] = None
+
+
+def get_ai_scheduler() -> AIScheduler:
+    """Общий планировщик запросов к OpenAI (настройки из конфига)"""
+    global _scheduler
+    if _scheduler is None:
+        _scheduler = AIScheduler.from_config(get_config())
+    return _scheduler
@@ -1,16 +1,21 @@
 from __future__ import annotations
 
+import asyncio
+import hashlib
+import json
+import multiprocessing
+import os
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime, timedelta
 from pathlib import Path
-from typing import Any, Dict, Optional
+from typing import Any, Dict, Optional, Tuple
 
 from aiogram import Bot
-from kerykeion import (
-    AstrologicalSubject,
-    EphemerisDataFactory,
-    KerykeionChartSVG,
-    TransitsTimeRangeFactory,
-)
+from cachetools import LRUCache
+from kerykeion import AstrologicalSubject, KerykeionChartSVG
+
+from utils.transit_engine import transit_engine
 
 try:
     import pytz
@@ -22,6 +27,148 @@ except ImportError:
     TimezoneFinder = None
 
 
+class ChartCache:
+    """
+    Content-addressed кэш натальных карт на диске.
+
+    Ключ — хэш входных данных субъекта (имя, дата/время, координаты,
+    система домов, тема), значение — SVG, JSON радикса и file_id,
+    выданные Telegram. Одни и те же данные рождения всегда дают ту же
+    карту, поэтому повторные входы не пересчитывают её. Размер каталога
+    ограничен max_bytes, при переполнении удаляются давно не читавшиеся
+    карты (LRU, порядок восстанавливается по mtime после рестарта).
+    """
+
+    def __init__(self, root: Path | str, max_bytes: int) -> None:
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        # key -> суммарный размер файлов, от давних к свежим
+        self._entries: OrderedDict[str, int] = OrderedDict()
+        self._load()
+
+    def _load(self) -> None:
+        entries: Dict[str, list] = {}
+        for path in self.root.iterdir():
+            key = path.name.split(".", 1)[0]
+            stat = path.stat()
+            entry = entries.setdefault(key, [0, 0.0])
+            entry[0] += stat.st_size
+            entry[1] = max(entry[1], stat.st_mtime)
+        for key, (size, _) in sorted(
+            entries.items(), key=lambda item: item[1][1]
+        ):
+            self._entries[key] = size
+
+    @staticmethod
+    def make_key(**inputs: Any) -> str:
+        payload = json.dumps(inputs, sort_keys=True, default=str)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()[:32]
+
+    def _path(self, key: str, suffix: str) -> Path:
+        return self.root / f"{key}.{suffix}"
+
+    @staticmethod
+    def _write(path: Path, content: str) -> None:
+        tmp_path = path.with_name(path.name + ".tmp")
+        tmp_path.write_text(content, encoding="utf-8")
+        os.replace(tmp_path, path)
+
+    def get(self, key: str) -> Optional[Tuple[str, str]]:
+        """(SVG, JSON радикса) или None"""
+        svg_path = self._path(key, "svg")
+        json_path = self._path(key, "json")
+        if key not in self._entries or not (
+            svg_path.exists() and json_path.exists()
+        ):
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._entries.move_to_end(key)
+        os.utime(svg_path)
+        return (
+            svg_path.read_text(encoding="utf-8"),
+            json_path.read_text(encoding="utf-8"),
+        )
+
+    def put(self, key: str, svg: str, natal_json: Any) -> None:
+        if not isinstance(natal_json, str):
+            natal_json = json.dumps(natal_json, ensure_ascii=False)
+        svg_path = self._path(key, "svg")
+        self._write(svg_path, svg)
+        self._write(self._path(key, "json"), natal_json)
+        self._entries[key] = sum(
+            path.stat().st_size for path in self.root.glob(f"{key}.*")
+        )
+        self._entries.move_to_end(key)
+        self._evict()
+
+    def get_file_id(self, key: str, kind: str = "svg") -> Optional[str]:
+        path = self._path(key, f"{kind}.file_id")
+        return path.read_text() if path.exists() else None
+
+    def set_file_id(self, key: str, file_id: str, kind: str = "svg") -> None:
+        if key in self._entries:
+            self._write(self._path(key, f"{kind}.file_id"), file_id)
+
+    def _evict(self) -> None:
+        total = sum(self._entries.values())
+        # Самую свежую карту не трогаем, даже если она больше лимита
+        while total > self.max_bytes and len(self._entries) > 1:
+            key, size = self._entries.popitem(last=False)
+            total -= size
+            for path in self.root.glob(f"{key}.*"):
+                path.unlink(missing_ok=True)
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self._entries),
+            "bytes": sum(self._entries.values()),
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
+# Экземпляр AstroManager внутри процесса пула (создаётся инициализатором)
+_worker_manager: Optional["AstroManager"] = None
+
+
+def _init_worker(options: Dict[str, Any]) -> None:
+    """
+    Прогрев процесса пула: импорт kerykeion/swisseph, загрузка эфемерид
+    и TimezoneFinder один раз на процесс, а не на каждый запрос
+    """
+    global _worker_manager
+    _worker_manager = AstroManager(None, **options)
+    _worker_manager.get_subject(
+        name="warmup",
+        year=2000,
+        month=1,
+        day=1,
+        hour=12,
+        minute=0,
+        lng=37.62,
+        lat=55.75,
+        city="Moscow",
+    )
+
+
+def _ping() -> None:
+    return None
+
+
+def _build_natal_chart(
+    subject_kwargs: Dict[str, Any], theme: str
+) -> Tuple[str, Any]:
+    """Выполняется в процессе пула: субъект -> (SVG, JSON радикса)"""
+    subject = _worker_manager.get_subject(**subject_kwargs)
+    svg = _worker_manager.get_svg_content(theme=theme, subject=subject)
+    return svg, _worker_manager.get_natal_json(subject=subject)
+
+
 class AstroManager:
     """
     Класс-обёртка над Kerykeion.
@@ -38,6 +185,10 @@ class AstroManager:
         perspective_type: str = "Apparent Geocentric",
         zodiac_type: str = "Tropic",
         output_dir: Path | str | None = None,
+        workers: int = 2,
+        timeout: float = 30,
+        chart_cache_size: int = 200 * 1024 * 1024,
+        memory_charts: int = 64,
     ) -> None:
         self.bot = bot
 
@@ -53,6 +204,136 @@ class AstroManager:
         # Инициализируем TimezoneFinder если доступен
         self.tf = TimezoneFinder() if TIMEZONEFINDER_AVAILABLE else None
 
+        # Кэш готовых карт (в процессах пула не нужен)
+        self.chart_cache = (
+            ChartCache(self.output_dir / "cache", chart_cache_size)
+            if chart_cache_size > 0
+            else None
+        )
+        # Недавно построенные SVG в памяти: карта отправляется сразу после
+        # расчёта, без записи и чтения файла
+        self._charts: LRUCache = LRUCache(maxsize=max(1, memory_charts))
+
+        # Пул процессов для тяжёлых расчётов (создаётся при первом запросе)
+        self.workers = max(1, workers)
+        self.timeout = timeout
+        self._executor: ProcessPoolExecutor | None = None
+        self.in_flight = 0
+        self.completed = 0
+        self.failed = 0
+        self.timeouts = 0
+
+    # ---------- PROCESS POOL ----------
+    def _get_executor(self) -> ProcessPoolExecutor:
+        if self._executor is None:
+            options = {
+                "tz_str": self.tz_str,
+                "houses_system": self.houses_system,
+                "perspective_type": self.perspective_type,
+                "zodiac_type": self.zodiac_type,
+                "output_dir": self.output_dir,
+                "chart_cache_size": 0,
+            }
+            # spawn, а не fork: в родителе уже работают потоки (aiosqlite)
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_init_worker,
+                initargs=(options,),
+            )
+        return self._executor
+
+    async def _run_in_pool(self, func, *args):
+        loop = asyncio.get_running_loop()
+        self.in_flight += 1
+        try:
+            result = await asyncio.wait_for(
+                loop.run_in_executor(self._get_executor(), func, *args),
+                timeout=self.timeout,
+            )
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            raise
+        except Exception:
+            self.failed += 1
+            raise
+        finally:
+            self.in_flight -= 1
+        self.completed += 1
+        return result
+
+    async def warm_up(self) -> None:
+        """Заранее запустить и прогреть все процессы пула"""
+        loop = asyncio.get_running_loop()
+        executor = self._get_executor()
+        await asyncio.gather(
+            *(
+                loop.run_in_executor(executor, _ping)
+                for _ in range(self.workers)
+            )
+        )
+
+    def stats(self) -> dict:
+        return {
+            "workers": self.workers,
+            "in_flight": self.in_flight,
+            "completed": self.completed,
+            "failed": self.failed,
+            "timeouts": self.timeouts,
+            "chart_cache": (
+                self.chart_cache.stats() if self.chart_cache else None
+            ),
+        }
+
+    def shutdown(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    def chart_key(self, *, theme: str = "dark", **subject_kwargs) -> str:
+        """Ключ карты в ChartCache: все входные данные, влияющие на неё"""
+        return ChartCache.make_key(
+            theme=theme,
+            houses_system=self.houses_system,
+            perspective_type=self.perspective_type,
+            zodiac_type=self.zodiac_type,
+            **subject_kwargs,
+        )
+
+    async def build_natal_chart_async(
+        self, *, theme: str = "dark", **subject_kwargs
+    ) -> Tuple[str, Any]:
+        """
+        Асинхронный аналог get_subject + get_svg_content + get_natal_json.
+        Берёт карту из ChartCache, иначе считает в пуле процессов,
+        не блокируя event loop. Аргументы субъекта — как у get_subject.
+        Возвращает (SVG строкой, JSON радикса), на диск пишет только
+        ChartCache.
+        """
+        key = self.chart_key(theme=theme, **subject_kwargs)
+        if self.chart_cache is not None:
+            cached = self.chart_cache.get(key)
+            if cached is not None:
+                self._charts[key] = cached[0]
+                return cached
+
+        svg, natal_json = await self._run_in_pool(
+            _build_natal_chart, subject_kwargs, theme
+        )
+        self._charts[key] = svg
+        if self.chart_cache is not None:
+            self.chart_cache.put(key, svg, natal_json)
+        return svg, natal_json
+
+    def get_chart_svg(self, key: str) -> Optional[str]:
+        """SVG построенной карты по ключу chart_key (память, затем кэш)"""
+        svg = self._charts.get(key)
+        if svg is None and self.chart_cache is not None:
+            cached = self.chart_cache.get(key)
+            if cached is not None:
+                svg = self._charts[key] = cached[0]
+        return svg
+
     # self.subject = AstrologicalSubject(
     # self.name=name,
     # self.year=year,
@@ -154,19 +435,26 @@ class AstroManager:
         file_name = file_name or f"{user_id}.svg"
         output_path = self.output_dir / file_name
 
+        svg_content = self.get_svg_content(theme=theme, subject=subject)
+        with output_path.open("w", encoding="utf-8") as fp:
+            fp.write(svg_content)
+
+        return output_path
+
+    def get_svg_content(
+        self,
+        theme: str = "dark",
+        subject: AstrologicalSubject | None = None,
+    ) -> str:
+        """SVG натальной карты строкой, без записи на диск"""
         chart_svg = KerykeionChartSVG(
             subject,
             new_output_directory=str(self.output_dir),
             theme=theme,
             chart_language="RU",
         )
-
-        svg_content = chart_svg.makeTemplate()
-        # svg_content = chart_svg.makeTemplate(remove_css_variables=True)
-        with output_path.open("w", encoding="utf-8") as fp:
-            fp.write(svg_content)
-
-        return output_path
+        # return chart_svg.makeTemplate(remove_css_variables=True)
+        return chart_svg.makeTemplate()
 
     # ---------- JSON (radix) ----------
     def get_natal_json(
@@ -199,29 +487,21 @@ class AstroManager:
         Вычисляет транзиты к натальной карте
         за указанный период (по умолчанию 30 дней, начиная
         с сегодня) и возвращает их в формате dict.
+        Эфемериды берутся из общего кэша transit_engine.
         """
         start_datetime = start_datetime or datetime.now()
         end_datetime = end_datetime or (start_datetime + timedelta(days=30))
+        days = (end_datetime.date() - start_datetime.date()).days + 1
 
-        ephemeris_factory = EphemerisDataFactory(
-            start_datetime=start_datetime,
-            end_datetime=end_datetime,
-            step_type="days",
-            step=step_days,
-            lat=subject.lat,
-            lng=subject.lng,
+        transits = transit_engine.transits(
+            {subject.name: subject},
+            start_datetime.date(),
+            days,
             tz_str=subject.tz_str,
-        )
-        ephemeris_points = (
-            ephemeris_factory.get_ephemeris_data_as_astrological_subjects()
-        )
-
-        trx_factory = TransitsTimeRangeFactory(
-            natal_subject=subject,
-            transit_subjects=ephemeris_points,
-        )
-        trx_model = trx_factory.get_transits_time_range_model()
-        return trx_model.json(dump=False, indent=indent)
+            step_days=step_days,
+        )[subject.name]
+        transits["name"] = subject.name
+        return transits
 
     # ---------- JSON (full) ----------
     def get_full_json(
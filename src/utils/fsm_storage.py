@@ -0,0 +1,190 @@
+import io
+import pickle
+from datetime import datetime
+from typing import Any, Dict, Optional
+
+from aiogram import Bot
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import (
+    BaseStorage,
+    DefaultKeyBuilder,
+    KeyBuilder,
+    StateType,
+    StorageKey,
+)
+from aiogram.fsm.storage.memory import MemoryStorage
+from cachetools import TTLCache
+from sqlalchemy import select
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+from db.db import AsyncSessionLocal
+from db.models.base import TimestampMixin
+from db.models.fsm_record import FsmRecord
+
+_BOT_REF = "bot"
+
+
+class _DataPickler(pickle.Pickler):
+    """
+    В dialog_data лежат Message и MediaAttachment. Сам Bot (с HTTP-сессией)
+    не сериализуем, вместо него пишем ссылку и подставляем бота при чтении.
+    """
+
+    def persistent_id(self, obj):
+        if isinstance(obj, Bot):
+            return _BOT_REF
+        return None
+
+
+class _DataUnpickler(pickle.Unpickler):
+    def __init__(self, file, bot: Optional[Bot]):
+        super().__init__(file)
+        self.bot = bot
+
+    def persistent_load(self, pid):
+        if pid == _BOT_REF:
+            return self.bot
+        raise pickle.UnpicklingError(f"Unknown persistent id: {pid}")
+
+
+def _state_name(state: StateType) -> Optional[str]:
+    return state.state if isinstance(state, State) else state
+
+
+class SQLiteStorage(BaseStorage):
+    """
+    FSM-хранилище в основной БД (таблица fsm_storage).
+    Переживает рестарты и общее для всех процессов, работающих с одной БД.
+    """
+
+    def __init__(
+        self,
+        bot: Optional[Bot] = None,
+        key_builder: Optional[KeyBuilder] = None,
+    ) -> None:
+        self.bot = bot
+        self.key_builder = key_builder or DefaultKeyBuilder(
+            with_bot_id=True, with_destiny=True
+        )
+
+    def _dump(self, data: Dict[str, Any]) -> Optional[bytes]:
+        if not data:
+            return None
+        buffer = io.BytesIO()
+        _DataPickler(buffer, protocol=pickle.HIGHEST_PROTOCOL).dump(data)
+        return buffer.getvalue()
+
+    def _load(self, raw: Optional[bytes]) -> Dict[str, Any]:
+        if not raw:
+            return {}
+        try:
+            return _DataUnpickler(io.BytesIO(raw), self.bot).load()
+        except Exception as e:
+            print(f"Error loading FSM data: {e}")
+            return {}
+
+    async def _upsert(self, key: str, **values) -> None:
+        now = datetime.now(TimestampMixin.MSK)
+        stmt = sqlite_insert(FsmRecord).values(key=key, **values)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[FsmRecord.key],
+            set_={**values, "updated_at": now},
+        )
+        async with AsyncSessionLocal() as session:
+            await session.execute(stmt)
+            await session.commit()
+
+    async def set_state(self, key: StorageKey, state: StateType = None):
+        await self._upsert(
+            self.key_builder.build(key), state=_state_name(state)
+        )
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        async with AsyncSessionLocal() as session:
+            result = await session.execute(
+                select(FsmRecord.state).where(
+                    FsmRecord.key == self.key_builder.build(key)
+                )
+            )
+            return result.scalar_one_or_none()
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]):
+        await self._upsert(
+            self.key_builder.build(key), data=self._dump(data)
+        )
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        async with AsyncSessionLocal() as session:
+            result = await session.execute(
+                select(FsmRecord.data).where(
+                    FsmRecord.key == self.key_builder.build(key)
+                )
+            )
+            return self._load(result.scalar_one_or_none())
+
+    async def close(self) -> None:
+        pass
+
+
+class CachedStorage(BaseStorage):
+    """
+    Write-through кэш поверх другого хранилища с вытеснением по TTL.
+    Запись всегда идёт в основное хранилище, чтение — из кэша, пока
+    запись не устарела. Включать только если апдейты одного пользователя
+    приходят в один процесс, иначе кэш может отдать чужую устаревшую копию.
+    """
+
+    def __init__(
+        self,
+        storage: BaseStorage,
+        ttl: float = 60,
+        max_size: int = 10000,
+    ) -> None:
+        self.storage = storage
+        self.key_builder = DefaultKeyBuilder(
+            with_bot_id=True, with_destiny=True
+        )
+        self._states: TTLCache = TTLCache(maxsize=max_size, ttl=ttl)
+        self._data: TTLCache = TTLCache(maxsize=max_size, ttl=ttl)
+
+    async def set_state(self, key: StorageKey, state: StateType = None):
+        await self.storage.set_state(key, state)
+        self._states[self.key_builder.build(key)] = _state_name(state)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        cache_key = self.key_builder.build(key)
+        if cache_key in self._states:
+            return self._states[cache_key]
+        state = await self.storage.get_state(key)
+        self._states[cache_key] = state
+        return state
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]):
+        await self.storage.set_data(key, data)
+        self._data[self.key_builder.build(key)] = data.copy()
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        cache_key = self.key_builder.build(key)
+        if cache_key not in self._data:
+            self._data[cache_key] = await self.storage.get_data(key)
+        return self._data[cache_key].copy()
+
+    async def close(self) -> None:
+        await self.storage.close()
+
+
+def create_fsm_storage(config, bot: Optional[Bot] = None) -> BaseStorage:
+    """Создать FSM-хранилище по настройкам (FSM_STORAGE, FSM_CACHE_TTL)"""
+    if config.fsm_storage == "memory":
+        return MemoryStorage()
+    if config.fsm_storage != "sqlite":
+        raise ValueError(f"Unknown FSM storage: {config.fsm_storage}")
+
+    storage: BaseStorage = SQLiteStorage(bot)
+    if config.fsm_cache_ttl > 0:
+        storage = CachedStorage(
+            storage,
+            ttl=config.fsm_cache_ttl,
+            max_size=config.fsm_cache_size,
+        )
+    return storage
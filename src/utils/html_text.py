@@ -0,0 +1,114 @@
+import re
+
+
+def fix_html_tags_simple(text: str) -> str:
+    """
+    Простое исправление HTML тегов - закрывает все незакрытые теги в конце текста.
+    """
+    if not text.strip():
+        return text
+
+    # Просто закрываем все незакрытые теги в конце
+    result = text
+    for tag in reversed(open_html_tags(text)):
+        result += f"</{tag}>"
+
+    return result
+
+
+def open_html_tags(text: str) -> list:
+    """Теги Telegram, оставшиеся открытыми к концу текста (по порядку)"""
+    # Поддерживаемые HTML теги в Telegram
+    supported_tags = ["b", "i", "u", "s", "code", "pre", "a"]
+
+    # Стек для отслеживания открытых тегов
+    tag_stack = []
+
+    # Паттерн для поиска HTML тегов
+    tag_pattern = r"<(/?)(\w+)(?:\s[^>]*)?>"
+
+    for match in re.finditer(tag_pattern, text):
+        is_closing = bool(match.group(1))
+        tag_name = match.group(2).lower()
+
+        if tag_name not in supported_tags:
+            continue
+
+        if is_closing:
+            # Закрывающий тег - убираем из стека если есть
+            if tag_name in tag_stack:
+                tag_stack.remove(tag_name)
+        else:
+            # Открывающий тег - добавляем в стек
+            tag_stack.append(tag_name)
+
+    return tag_stack
+
+
+def split_text_simple(text: str, max_length: int = 4000) -> list:
+    """
+    Простая разбивка текста на страницы с исправлением HTML.
+    """
+    if len(text) <= max_length:
+        return [fix_html_tags_simple(text)]
+
+    pages = []
+    # Разбиваем текст по абзацам
+    paragraphs = text.split("\n\n")
+    current_page = ""
+
+    for paragraph in paragraphs:
+        # Проверяем, поместится ли абзац
+        test_text = current_page + ("\n\n" if current_page else "") + paragraph
+
+        if len(test_text) <= max_length:
+            current_page = test_text
+        else:
+            # Сохраняем текущую страницу если она не пустая
+            if current_page:
+                pages.append(fix_html_tags_simple(current_page))
+                current_page = paragraph
+            else:
+                # Абзац слишком длинный - разбиваем по предложениям
+                sentences = paragraph.split(". ")
+                for i, sentence in enumerate(sentences):
+                    if i < len(sentences) - 1:
+                        sentence += ". "
+
+                    test_sentence = (
+                        current_page + (" " if current_page else "") + sentence
+                    )
+
+                    if len(test_sentence) <= max_length:
+                        current_page += (
+                            " " if current_page else ""
+                        ) + sentence
+                    else:
+                        if current_page:
+                            pages.append(fix_html_tags_simple(current_page))
+                            current_page = sentence
+                        else:
+                            # Предложение слишком длинное - просто добавляем
+                            pages.append(fix_html_tags_simple(sentence))
+
+    # Добавляем последнюю страницу
+    if current_page:
+        pages.append(fix_html_tags_simple(current_page))
+
+    return pages if pages else [fix_html_tags_simple(text)]
+
+
+def stream_preview(text: str, max_length: int = 4000):
+    """
+    Промежуточный текст потокового ответа: хвост не длиннее max_length,
+    обрезанный по границе строки, с заново открытыми тегами.
+    None, если обрезать негде.
+    """
+    if len(text) <= max_length:
+        return fix_html_tags_simple(text)
+
+    start = text.find("\n", len(text) - max_length + 100)
+    if start == -1:
+        return None
+    reopened = "".join(f"<{tag}>" for tag in open_html_tags(text[:start]))
+    return fix_html_tags_simple("…\n" + reopened + text[start + 1 :])
@@ -0,0 +1,117 @@
+import asyncio
+import time
+from pathlib import Path
+from typing import List, NamedTuple
+
+from aiogram import Bot
+
+from config.config import logger
+from db.models.old_workflow.big_mes import MediaType, sync_media
+from manager.spam_service import spam_types
+from texts.text import get_prompts_buttons, get_publications_texts
+
+BASE_DIR = Path(__file__).resolve().parent.parent
+MISK_DIR = BASE_DIR / "misk"
+
+
+class MediaAsset(NamedTuple):
+    """Файл, file_id которого нужен диалогам (имя в big_mes — путь)"""
+
+    path: str
+    media_type: MediaType = MediaType.PHOTO
+
+
+def media_manifest() -> List[MediaAsset]:
+    """
+    Все медиа, которые показывают main_menu, astro, публикации и
+    рассылки spam_types. Пути совпадают с теми, что передают геттеры
+    в get_pay_photo_attachment
+    """
+    navigation = MISK_DIR / "navigation"
+    paths = [
+        # main_menu
+        navigation / "main.png",
+        navigation / "mam.png",
+        MISK_DIR / "prompts" / "main.png",
+        MISK_DIR / "minimal.png",
+        MISK_DIR / "vintaaj.png",
+        # astro
+        navigation / "ai_predict.png",
+    ]
+    # Публикации и промпты: картинка на каждый пункт
+    paths += [
+        MISK_DIR / "publication" / f"{i}.png"
+        for i in range(1, len(get_publications_texts()) + 1)
+    ]
+    paths.append(MISK_DIR / "publication" / "5.jpg")
+    paths += [
+        MISK_DIR / "prompts" / f"{i}.png"
+        for i in range(1, len(get_prompts_buttons()) + 1)
+    ]
+    # spam_types
+    paths += [
+        BASE_DIR / spam["photo_path"]
+        for spam in spam_types.values()
+        if spam.get("photo_path")
+    ]
+
+    assets = [MediaAsset(str(path)) for path in dict.fromkeys(paths)]
+    assets.append(
+        MediaAsset(
+            str(MISK_DIR / "person_interior" / "time.MP4"),
+            MediaType.ANIMATION,
+        )
+    )
+    return assets
+
+
+async def preload_media(bot: Bot, concurrency: int = 8) -> dict:
+    """
+    Загрузить или проверить все файлы манифеста параллельно (не более
+    concurrency одновременно). Неизменённые файлы пропускаются по
+    checksum. Возвращает отчёт с числом файлов по исходам и временем
+    """
+    started = time.monotonic()
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+    report = {
+        "skipped": 0,
+        "validated": 0,
+        "uploaded": 0,
+        "failed": 0,
+        "missing": [],
+    }
+    slowest = []
+
+    async def preload(asset: MediaAsset) -> None:
+        async with semaphore:
+            asset_started = time.monotonic()
+            try:
+                outcome = await sync_media(bot, asset.path, asset.media_type)
+            except Exception as e:
+                logger.error(f"Media preload error for {asset.path}: {e}")
+                outcome = "failed"
+            report[outcome] += 1
+            slowest.append((time.monotonic() - asset_started, asset.path))
+
+    assets = []
+    for asset in media_manifest():
+        if Path(asset.path).exists():
+            assets.append(asset)
+        else:
+            report["missing"].append(
+                str(Path(asset.path).relative_to(BASE_DIR))
+            )
+    await asyncio.gather(*(preload(asset) for asset in assets))
+
+    report["elapsed"] = round(time.monotonic() - started, 2)
+    report["slowest"] = [
+        {"path": str(Path(path).relative_to(BASE_DIR)), "time": round(t, 2)}
+        for t, path in sorted(slowest, reverse=True)[:3]
+    ]
+    logger.info(
+        f"Media preload: {len(assets)} files in {report['elapsed']}s, "
+        f"uploaded {report['uploaded']}, validated {report['validated']}, "
+        f"skipped {report['skipped']}, failed {report['failed']}, "
+        f"missing {len(report['missing'])}"
+    )
+    return report
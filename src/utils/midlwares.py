@@ -1,8 +1,17 @@
-from aiogram import Bot, Dispatcher
-from aiogram.types import ErrorEvent
+from typing import Any, Awaitable, Callable, Dict
+
+from aiogram import BaseMiddleware, Bot, Dispatcher
+from aiogram.types import ErrorEvent, TelegramObject
 from aiogram_dialog import ShowMode, StartMode
 from aiogram_dialog.api.exceptions import UnknownIntent
 
+from db.db import session_scope
+from db.models.old_workflow.big_mes import (
+    find_stale_file_ids,
+    invalidate_media,
+    is_wrong_file_id_error,
+    purge_media_attachments,
+)
 from db.models.user import get_user_language
 from dialogs.states import YogaClubStates
 
@@ -50,6 +59,44 @@ def get_error_handler(dp: Dispatcher, bot: Bot):
                         },
                     )
                 return True
+        if dialog_manager is not None and is_wrong_file_id_error(
+            error.exception
+        ):
+            return await _recover_stale_media(bot, dialog_manager)
         return False
 
     return error_handler
+
+
+async def _recover_stale_media(bot: Bot, dialog_manager) -> bool:
+    """
+    Отправка упала из-за протухшего file_id: находим такие file_id,
+    забываем их, чистим MediaAttachment в dialog_data и показываем окно
+    заново — геттеры загрузят файлы повторно
+    """
+    stale = await find_stale_file_ids(bot)
+    if not stale:
+        return False
+    names = await invalidate_media(stale)
+    print(f"Stale file_ids for {names}, re-uploading")
+    try:
+        purge_media_attachments(dialog_manager.dialog_data, stale)
+        await dialog_manager.show(ShowMode.DELETE_AND_SEND)
+    except Exception as e:
+        print(f"Error re-showing dialog after stale media: {e}")
+        return False
+    return True
+
+
+class DbSessionMiddleware(BaseMiddleware):
+    """Одна сессия БД на апдейт, доступна хэндлерам как data["session"]"""
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        async with session_scope() as session:
+            data["session"] = session
+            return await handler(event, data)
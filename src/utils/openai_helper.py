@@ -1,10 +1,38 @@
-import asyncio
+import hashlib
+import json
+import re
+import time
 import traceback
+import zlib
+from collections import OrderedDict
 from datetime import datetime
-
-from openai import OpenAI
-
-from config.config import get_config
+from typing import Any, AsyncIterator, Dict, Optional, Tuple
+
+import numpy as np
+from cachetools import LRUCache
+from openai import AsyncOpenAI
+
+from config.config import get_config, logger
+from utils.ai_scheduler import Priority, get_ai_scheduler
+from utils.transit_engine import natal_summary, sky_summary
+
+
+def log_usage(
+    model: str, usage, started: float, first_token: float | None = None
+) -> None:
+    """Токены (в т.ч. взятые из кэша промптов) и время ответа OpenAI"""
+    if usage is None:
+        return
+    details = getattr(usage, "prompt_tokens_details", None)
+    cached = getattr(details, "cached_tokens", None) or 0
+    message = (
+        f"OpenAI {model}: prompt {usage.prompt_tokens} "
+        f"(cached {cached}), completion {usage.completion_tokens}, "
+        f"{time.perf_counter() - started:.2f}s"
+    )
+    if first_token is not None:
+        message += f", first token {first_token:.2f}s"
+    logger.info(message)
 
 
 class OpenAIAPI:
@@ -15,7 +43,7 @@ class OpenAIAPI:
 
     def __init__(
         self,
-        client: OpenAI,
+        client: AsyncOpenAI,
         model: str,
         temperature: float,
         max_tokens: int,
@@ -28,6 +56,7 @@ class OpenAIAPI:
         
         Используй дату рождения пользователя и не забывай, что сейчас уже 2025 год)
         """,
+        priority: Priority = Priority.FREE,
     ):
         # Клиент OpenAI теперь определяется из конфигурации и сохраняется как свойство класса.
         self.client = client
@@ -35,6 +64,8 @@ class OpenAIAPI:
         self.temperature = temperature
         self.max_tokens = max_tokens
         self.system_prompt = system_prompt
+        # Приоритет запросов в планировщике (платные обслуживаются раньше)
+        self.priority = priority
         self.stories_prompt = ""
         self.text_prompt = ""
 
@@ -73,61 +104,82 @@ class OpenAIAPI:
 
         return instance
 
-    def chat_completion(
+    async def chat_completion_async(
         self, messages: list, temperature: float = None, max_tokens: int = None
     ) -> object:
         """
-        Отправляет запрос к OpenAI Chat Completion API.
+        Отправляет запрос к OpenAI Chat Completion API через общий
+        асинхронный клиент, не блокируя событийный цикл.
 
         :param messages: список сообщений в формате [{"role": "user/system/assistant", "content": "..."}]
-        :param temperature: температура генерации; если не указана, берется из настроек
-        :param max_tokens: максимальное количество токенов; если не указано, берется из настроек
+        :param temperature: температура генерации (если None, берется из настроек)
+        :param max_tokens: максимальное количество токенов (если None, берется из настроек)
         :return: объект ответа от OpenAI API
         """
         temperature = (
             temperature if temperature is not None else self.temperature
         )
         max_tokens = max_tokens if max_tokens is not None else self.max_tokens
-        try:
-            # Используем синхронный метод create() согласно новому API.
-            response = self.client.chat.completions.create(
+
+        async def request():
+            return await self.client.chat.completions.create(
                 model=self.model,
                 messages=messages,
                 temperature=temperature,
                 max_tokens=max_tokens,
             )
+
+        scheduler = get_ai_scheduler()
+        try:
+            async with scheduler.slot(self.model, self.priority):
+                started = time.perf_counter()
+                response = await scheduler.call(self.model, request)
+            log_usage(self.model, response.usage, started)
             return response
         except Exception as e:
             print(f"Ошибка вызова OpenAI API: {e}\n{traceback.format_exc()}")
             raise
 
-    async def chat_completion_async(
+    async def chat_completion_stream(
         self, messages: list, temperature: float = None, max_tokens: int = None
-    ) -> object:
+    ) -> AsyncIterator[str]:
         """
-        Асинхронный вариант метода chat_completion, который не блокирует событийный цикл.
-
-        :param messages: список сообщений, как в синхронном методе
-        :param temperature: температура генерации (если None, берется из настроек)
-        :param max_tokens: максимальное количество токенов (если None, берется из настроек)
-        :return: объект ответа от OpenAI API
+        Потоковый вариант chat_completion_async: отдаёт куски текста
+        по мере генерации. Слот планировщика занят, пока поток не дочитан
+        или не закрыт; повторяется только открытие потока.
         """
         temperature = (
             temperature if temperature is not None else self.temperature
         )
         max_tokens = max_tokens if max_tokens is not None else self.max_tokens
 
-        def blocking_call():
-            return self.client.chat.completions.create(
+        async def request():
+            return await self.client.chat.completions.create(
                 model=self.model,
                 messages=messages,
                 temperature=temperature,
                 max_tokens=max_tokens,
+                stream=True,
+                stream_options={"include_usage": True},
             )
 
+        scheduler = get_ai_scheduler()
         try:
-            response = await asyncio.to_thread(blocking_call)
-            return response
+            async with scheduler.slot(self.model, self.priority):
+                started = time.perf_counter()
+                first_token = None
+                stream = await scheduler.call(self.model, request)
+                async with stream:
+                    async for chunk in stream:
+                        # Последний кусок приходит без choices, с usage
+                        if chunk.usage:
+                            log_usage(
+                                self.model, chunk.usage, started, first_token
+                            )
+                        if chunk.choices and chunk.choices[0].delta.content:
+                            if first_token is None:
+                                first_token = time.perf_counter() - started
+                            yield chunk.choices[0].delta.content
         except Exception as e:
             print(f"Ошибка вызова OpenAI API: {e}\n{traceback.format_exc()}")
             raise
@@ -172,6 +224,7 @@ class OpenAIAPI:
         quality: str = "auto",
         output_format: str = "png",  # "jpeg", "png", "webp"
         output_compression: int | None = None,  # 0-100 for jpeg/webp
+        priority: Priority = Priority.ADMIN,
     ) -> str:
         """
         Генерирует изображение на основе предоставленного промпта с использованием модели gpt-image-1.
@@ -184,6 +237,7 @@ class OpenAIAPI:
         :param output_format: Формат выходного изображения. По умолчанию "png".
                               Допустимые значения согласно cookbook для gpt-image-1: "jpeg", "png", "webp".
         :param output_compression: Уровень сжатия (0-100) для форматов "jpeg" или "webp". Применяется, если output_format="jpeg" или "webp".
+        :param priority: Приоритет в планировщике запросов (по умолчанию - как у админки).
         :return: Строка с изображением в формате base64 (b64_json).
         """
         # image_model = "gpt-image-1"  # Согласно предоставленному cookbook https://cookbook.openai.com/examples/generate_images_with_gpt_image
@@ -216,12 +270,12 @@ class OpenAIAPI:
         # else:
         #     print(f"Неподдерживаемый output_format: {output_format} указан для generate_image_async. Будет проигнорирован при вызове API.")
 
-        def blocking_call():
-            # Pass the curated call_args directly
-            return self.client.images.generate(**call_args)
-
         try:
-            response = await asyncio.to_thread(blocking_call)
+            response = await get_ai_scheduler().run(
+                image_model,
+                lambda: self.client.images.generate(**call_args),
+                priority,
+            )
             if (
                 response.data
                 and len(response.data) > 0
@@ -269,14 +323,145 @@ def convert_markdown_to_html(text: str) -> str:
     return text
 
 
+class MarkdownStreamConverter:
+    """
+    Инкрементальный convert_markdown_to_html для потокового ответа.
+    Конвертируются только завершённые строки (разметка в ответе
+    построчная), незаконченный хвост ждёт следующего куска.
+    """
+
+    def __init__(self):
+        self.raw = ""
+        self.html = ""
+        self._done = 0
+
+    def feed(self, delta: str) -> bool:
+        """Добавить кусок ответа, вернуть True, если html дополнился"""
+        self.raw += delta
+        end = self.raw.rfind("\n") + 1
+        if end <= self._done:
+            return False
+        self.html += convert_markdown_to_html(self.raw[self._done : end])
+        self._done = end
+        return True
+
+    def finish(self) -> str:
+        """Итоговый html по всему ответу, как в непотоковом режиме"""
+        self.html = convert_markdown_to_html(self.raw)
+        self._done = len(self.raw)
+        return self.html
+
+
+class ResponseCache:
+    """
+    Кэш ответов на похожие вопросы по одной и той же натальной карте.
+
+    Ключ — отпечаток карты и нормализованный вопрос. Вопросы сравниваются
+    локально: нормализованный текст раскладывается на символьные
+    n-граммы, они хэшируются в вектор фиксированной длины, похожесть —
+    косинус между векторами. Записи живут ttl секунд, при переполнении
+    вытесняется давно не использованная (LRU).
+    """
+
+    def __init__(
+        self,
+        *,
+        max_size: int = 1000,
+        ttl: float = 43200,
+        threshold: float = 0.85,
+        ngram: int = 3,
+        dim: int = 4096,
+    ) -> None:
+        self.max_size = max(1, max_size)
+        self.ttl = ttl
+        self.threshold = threshold
+        self.ngram = ngram
+        self.dim = dim
+        # (отпечаток карты, вопрос) -> (вектор, ответ, истекает в)
+        self._entries: OrderedDict = OrderedDict()
+        # отпечаток карты -> вопросы по ней (для поиска похожих)
+        self._by_chart: Dict[str, Dict[str, None]] = {}
+        self.hits = 0
+        self.misses = 0
+
+    @classmethod
+    def from_config(cls, config) -> "ResponseCache":
+        return cls(
+            max_size=config.ai_cache_size,
+            ttl=config.ai_cache_ttl,
+            threshold=config.ai_cache_threshold,
+        )
+
+    @staticmethod
+    def normalize(query: str) -> str:
+        query = query.lower().replace("ё", "е")
+        return " ".join(re.findall(r"\w+", query))
+
+    def _vector(self, query: str) -> np.ndarray:
+        padded = f" {query} "
+        vector = np.zeros(self.dim, dtype=np.float32)
+        for i in range(max(1, len(padded) - self.ngram + 1)):
+            gram = padded[i : i + self.ngram].encode()
+            vector[zlib.crc32(gram) % self.dim] += 1
+        return vector / np.linalg.norm(vector)
+
+    def _remove(self, key: Tuple[str, str]) -> None:
+        self._entries.pop(key, None)
+        queries = self._by_chart.get(key[0])
+        if queries is not None:
+            queries.pop(key[1], None)
+            if not queries:
+                del self._by_chart[key[0]]
+
+    def get(self, chart: str, query: str) -> Optional[str]:
+        """Ответ на такой же или похожий вопрос по этой карте"""
+        query = self.normalize(query)
+        now = time.monotonic()
+        key = (chart, query)
+        best_key, best_score = None, self.threshold
+        if key in self._entries:
+            best_key = key
+        else:
+            vector = self._vector(query)
+            for other in list(self._by_chart.get(chart, ())):
+                other_key = (chart, other)
+                score = float(vector @ self._entries[other_key][0])
+                if score >= best_score:
+                    best_key, best_score = other_key, score
+
+        if best_key is not None and self._entries[best_key][2] <= now:
+            self._remove(best_key)
+            best_key = None
+        if best_key is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(best_key)
+        self.hits += 1
+        return self._entries[best_key][1]
+
+    def put(self, chart: str, query: str, response: str) -> None:
+        query = self.normalize(query)
+        key = (chart, query)
+        self._remove(key)
+        self._entries[key] = (
+            self._vector(query),
+            response,
+            time.monotonic() + self.ttl,
+        )
+        self._by_chart.setdefault(chart, {})[query] = None
+        while len(self._entries) > self.max_size:
+            self._remove(next(iter(self._entries)))
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
 # - Главный заголовок: `<b>Анализ твоей натальной карты 💫</b>`
-async def generate_numerology_prediction(query: str, birth_date: str) -> str:
-    """Generate a numerology-based prediction using OpenAI"""
-    config = get_config()
-    try:
-        # Initialize OpenAI API
-        today = datetime.now().strftime("%d.%m.%Y")
-        system_prompt = f"""
+PREDICTION_SYSTEM_PROMPT = """
 ## Роль и экспертиза
 Ты - высококвалифицированный астролог с многолетним опытом работы с натальными картами и предсказательной астрологией. Ты обладаешь глубокими знаниями в:
 - Интерпретации планет в знаках и домах
@@ -288,17 +473,17 @@ async def generate_numerology_prediction(query: str, birth_date: str) -> str:
 
 ## Входные данные
 Ты получишь:
-1. **Натальный JSON** с полными астрологическими данными человека, включающий:
-   - Персональные данные (имя, дата, время, место рождения)
-   - Положения всех планет (Солнце, Луна, Меркурий, Венера, Марс, Юпитер, Сатурн, Уран, Нептун, Плутон)
-   - Лунные узлы (Северный и Южный)
+1. **Сводку натальной карты** человека, включающую:
+   - Персональные данные (имя, дата, время, место рождения) и систему домов
+   - Положения планет (Солнце, Луна, Меркурий, Венера, Марс, Юпитер, Сатурн, Уран, Нептун, Плутон) в знаках и домах с точными градусами
+   - Северный лунный узел (Южный - в противоположной точке)
    - Дополнительные точки (Хирон, Черная Луна Лилит)
-   - Угловые точки (Асцендент, Десцендент, MC, IC)
-   - Система домов (Плацидус)
    - Ретроградность планет
-   - Точные градусы планет
+   - Куспиды домов (куспид 1 дома - Асцендент, 10 дома - MC)
+   - Аспекты между планетами и угловыми точками с орбисами
 
 2. **Запрос пользователя** - конкретный вопрос или тема для анализа
+3. **Текущую дату и положение планет на сегодня** - в конце запроса
 
 ## Принципы интерпретации
 
@@ -441,27 +626,194 @@ async def generate_numerology_prediction(query: str, birth_date: str) -> str:
 - Комбинируй несколько астрологических факторов для полной картины
 - Максимальный размер ответа - 8000 символов
 - Будь конкретным и практичным в советах
-- Сегодня уже {today}, поэтому если вопрос "когда...", то учитываем, что сейчас уже {today}
-        """
-        openai_api = OpenAIAPI(
-            # get_config().open_ai_client, "gpt-4o", 0.7, 3000, system_prompt
-            config.get_openai_client(),
-            "gpt-4.1",
-            0.7,
-            30000,
-            system_prompt,
-        )
+- Текущая дата указана в конце запроса, поэтому если вопрос "когда...", то учитываем, что сейчас уже эта дата
+- Положение планет на сегодня (транзиты) тоже указано в конце запроса
+"""
 
-        prediction_md = await openai_api.generate(query, birth_date)
+# Сводки радиксов по user_id: (хэш JSON карты, сводка)
+_natal_summaries: LRUCache = LRUCache(maxsize=10000)
+# Заголовок черновика из кэша, пока генерируется свежий ответ
+DRAFT_HEADER = "🌙 <i>Уточняю прогноз именно для вас...</i>\n\n"
+# Дата и транзиты на сегодня, пересчитываются раз в день
+_today_contexts: Dict[str, str] = {}
+_response_cache: ResponseCache | None = None
 
-        try:
-            prediction = convert_markdown_to_html(prediction_md)
 
-        except Exception as e:
-            print(f"Error converting markdown to HTML: {e}")
-            prediction = prediction_md
+def get_response_cache() -> ResponseCache:
+    """Общий кэш ответов (AI_CACHE_SIZE, AI_CACHE_TTL, AI_CACHE_THRESHOLD)"""
+    global _response_cache
+    if _response_cache is None:
+        _response_cache = ResponseCache.from_config(get_config())
+    return _response_cache
+
+
+def natal_fingerprint(natal_json: Any, user_id: int | None = None) -> str:
+    """
+    Отпечаток карты для кэша ответов — хэш её сводки. Имя входит в
+    сводку, поэтому чужой ответ (с обращением по имени) не попадётся
+    """
+    summary = get_natal_summary(natal_json, user_id)
+    return hashlib.sha1(summary.encode()).hexdigest()
+
+
+def _prediction_api(priority: Priority) -> OpenAIAPI:
+    """OpenAIAPI с постоянным системным промптом астролога"""
+    return OpenAIAPI(
+        # get_config().open_ai_client, "gpt-4o", 0.7, 3000, system_prompt
+        get_config().get_openai_client(),
+        "gpt-4.1",
+        0.7,
+        30000,
+        PREDICTION_SYSTEM_PROMPT,
+        priority,
+    )
 
-        return prediction
+
+def get_natal_summary(natal_json: Any, user_id: int | None = None) -> str:
+    """
+    Сводка натальной карты для промпта (вместо полного JSON).
+    Кэшируется на пользователя и пересчитывается, если карта изменилась.
+    """
+    if not natal_json:
+        return ""
+    if not isinstance(natal_json, str):
+        natal_json = json.dumps(natal_json, ensure_ascii=False, sort_keys=True)
+    digest = hashlib.sha1(natal_json.encode()).hexdigest()
+    cached = _natal_summaries.get(user_id)
+    if cached and cached[0] == digest:
+        return cached[1]
+
+    try:
+        summary = natal_summary(natal_json)
+    except Exception as e:
+        print(f"Error building natal summary: {e}")
+        return natal_json
+    if user_id is not None:
+        _natal_summaries[user_id] = (digest, summary)
+    return summary
+
+
+def _today_context() -> str:
+    today = datetime.now().strftime("%d.%m.%Y")
+    context = _today_contexts.get(today)
+    if context is not None:
+        return context
+    try:
+        sky = sky_summary()
+    except Exception as e:
+        print(f"Error building sky summary: {e}")
+        return f"Сегодня {today}. Положение планет на сегодня: нет данных"
+    context = f"Сегодня {today}. Положение планет на сегодня (транзиты): {sky}"
+    _today_contexts.clear()
+    _today_contexts[today] = context
+    return context
+
+
+def build_prediction_messages(
+    query: str, natal_json: Any, user_id: int | None = None
+) -> list:
+    """
+    Сообщения для прогноза. Порядок важен для кэша промптов на стороне
+    OpenAI: постоянный системный промпт, затем сводка карты, а дата и
+    транзиты, меняющиеся каждый день, — в самом конце.
+    """
+    parts = []
+    summary = get_natal_summary(natal_json, user_id)
+    if summary:
+        parts.append(f"Сводка моей натальной карты:\n{summary}")
+    parts.append(f"Дай мне предсказание или совет по запросу: '{query}'")
+    parts.append(_today_context())
+    return [
+        {"role": "system", "content": PREDICTION_SYSTEM_PROMPT},
+        {"role": "user", "content": "\n\n".join(parts)},
+    ]
+
+
+async def request_numerology_prediction(
+    query: str,
+    natal_json: Any,
+    user_id: int | None = None,
+    priority: Priority = Priority.FREE,
+) -> str:
+    """Прогноз целиком, ошибки пробрасываются (для очереди заданий)"""
+    cache_mode = get_config().ai_cache_mode
+    use_cache = cache_mode in ("draft", "serve")
+    if use_cache:
+        chart = natal_fingerprint(natal_json, user_id)
+        cached = get_response_cache().get(chart, query)
+        if cached is not None and cache_mode == "serve":
+            return cached
+
+    openai_api = _prediction_api(priority)
+
+    response = await openai_api.chat_completion_async(
+        build_prediction_messages(query, natal_json, user_id)
+    )
+    prediction_md = response.choices[0].message.content
+
+    try:
+        prediction = convert_markdown_to_html(prediction_md)
+
+    except Exception as e:
+        print(f"Error converting markdown to HTML: {e}")
+        prediction = prediction_md
+
+    if use_cache:
+        get_response_cache().put(chart, query, prediction)
+    return prediction
+
+
+async def generate_numerology_prediction(
+    query: str,
+    natal_json: Any,
+    user_id: int | None = None,
+    priority: Priority = Priority.FREE,
+) -> str:
+    """Generate a numerology-based prediction using OpenAI"""
+    try:
+        return await request_numerology_prediction(
+            query, natal_json, user_id, priority
+        )
     except Exception as e:
         print(f"Error generating numerology prediction: {e}")
         return "Произошла ошибка при получении предсказания. Пожалуйста, попробуйте позже."
+
+
+async def stream_numerology_prediction(
+    query: str,
+    natal_json: Any,
+    user_id: int | None = None,
+    priority: Priority = Priority.FREE,
+) -> AsyncIterator[str]:
+    """
+    Потоковый прогноз: отдаёт накопленный html после каждой завершённой
+    строки, последним — итоговый текст целиком. Ошибки не глотает,
+    их обрабатывает вызывающий код.
+
+    С кэшем ответов (AI_CACHE_MODE): в режиме serve похожий ответ
+    отдаётся сразу вместо запроса, в режиме draft — показывается
+    черновиком, пока генерируется свежий.
+    """
+    use_cache = get_config().ai_cache_mode in ("draft", "serve")
+    draft = ""
+    if use_cache:
+        chart = natal_fingerprint(natal_json, user_id)
+        cached = get_response_cache().get(chart, query)
+        if cached is not None:
+            if get_config().ai_cache_mode == "serve":
+                yield cached
+                return
+            draft = DRAFT_HEADER + cached
+            yield draft
+
+    openai_api = _prediction_api(priority)
+    converter = MarkdownStreamConverter()
+    messages = build_prediction_messages(query, natal_json, user_id)
+    async for delta in openai_api.chat_completion_stream(messages):
+        # Черновик показываем, пока свежий ответ его не догонит
+        if converter.feed(delta) and len(converter.html) >= len(draft):
+            yield converter.html
+    prediction = converter.finish()
+    if use_cache:
+        get_response_cache().put(chart, query, prediction)
+    yield prediction
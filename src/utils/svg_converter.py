@@ -1,15 +1,62 @@
+import asyncio
+import multiprocessing
 import re
 import xml.etree.ElementTree as ET
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
-from typing import Optional
+from typing import Optional, Union
 
 import resvg
 from affine import Affine
 
+# База шрифтов процесса: сканирование системных шрифтов занимает сотни
+# миллисекунд, поэтому выполняется один раз, а не на каждую карту
+_font_db = None
+
+
+def _get_font_db():
+    global _font_db
+    if _font_db is None:
+        font_db = resvg.usvg.FontDatabase.default()
+        font_db.load_system_fonts()
+        _font_db = font_db
+    return _font_db
+
+
+def _svg_scale(svg_string: str, width: int) -> float:
+    """Масштаб, при котором SVG займёт width пикселей по ширине"""
+    svg_string_no_decl = re.sub(r"^\s*<\?xml[^>]*\?>", "", svg_string).strip()
+    root = ET.fromstring(svg_string_no_decl)
+    original_width_str = root.attrib.get("width", "0")
+    original_width = float(re.sub(r"[a-zA-Z%]+$", "", original_width_str))
+
+    if original_width == 0:
+        viewbox_str = root.attrib.get("viewBox")
+        if viewbox_str:
+            _, _, vb_width, _ = [float(v) for v in viewbox_str.split()]
+            original_width = original_width or vb_width
+
+    return width / original_width if original_width > 0 else 1.0
+
 
 class SVGConverter:
     """Конвертер SVG в PNG с использованием resvg-py"""
 
+    @staticmethod
+    def render(svg: Union[bytes, str], width: int = 1200) -> bytes:
+        """SVG (строка или байты) -> PNG-байты, без файлов на диске"""
+        svg_string = svg.decode("utf-8") if isinstance(svg, bytes) else svg
+        scale = _svg_scale(svg_string, width)
+
+        options = resvg.usvg.Options.default()
+        tree = resvg.usvg.Tree.from_str(svg_string, options, _get_font_db())
+
+        transform = Affine.scale(scale)
+        # Передаем срез из 6 элементов, как требует библиотека
+        png_data = resvg.render(tree, transform=transform[0:6])
+        # resvg возвращает список байтов
+        return bytes(png_data)
+
     @staticmethod
     def convert(
         svg_path: Path,
@@ -23,39 +70,10 @@ class SVGConverter:
             if png_path is None:
                 png_path = svg_path.with_suffix(".png")
 
-            svg_string = svg_path.read_text(encoding="utf-8")
-
-            # --- XML Parsing to get size for scaling ---
-            svg_string_no_decl = re.sub(
-                r"^\s*<\?xml[^>]*\?>", "", svg_string
-            ).strip()
-            root = ET.fromstring(svg_string_no_decl)
-            original_width_str = root.attrib.get("width", "0")
-            original_width = float(
-                re.sub(r"[a-zA-Z%]+$", "", original_width_str)
+            png_path.write_bytes(
+                SVGConverter.render(svg_path.read_bytes(), width)
             )
 
-            if original_width == 0:
-                viewbox_str = root.attrib.get("viewBox")
-                if viewbox_str:
-                    _, _, vb_width, _ = [float(v) for v in viewbox_str.split()]
-                    original_width = original_width or vb_width
-
-            scale = width / original_width if original_width > 0 else 1.0
-            # --- End XML Parsing ---
-
-            font_db = resvg.usvg.FontDatabase.default()
-            font_db.load_system_fonts()
-            options = resvg.usvg.Options.default()
-            tree = resvg.usvg.Tree.from_str(svg_string, options, font_db)
-
-            transform = Affine.scale(scale)
-            # Передаем срез из 6 элементов, как требует библиотека
-            png_data = resvg.render(tree, transform=transform[0:6])
-
-            # Конвертируем список байтов в объект bytes и записываем в файл
-            png_path.write_bytes(bytes(png_data))
-
             if png_path.exists():
                 return png_path
 
@@ -65,3 +83,104 @@ class SVGConverter:
         except Exception as e:
             print(f"Error converting SVG with resvg: {e}")
             return None
+
+
+def _init_worker() -> None:
+    """Прогрев процесса пула: импорт resvg и загрузка базы шрифтов"""
+    _get_font_db()
+
+
+def _ping() -> None:
+    return None
+
+
+class RasterService:
+    """
+    Растеризация SVG -> PNG в пуле процессов.
+
+    Рендер resvg занимает процессор и не должен выполняться в event
+    loop. Каждый процесс пула один раз загружает базу шрифтов и
+    переиспользует её. На вход — SVG в памяти, на выход — PNG-байты.
+    """
+
+    def __init__(
+        self, *, workers: int = 1, timeout: float = 30, width: int = 1200
+    ) -> None:
+        self.workers = max(1, workers)
+        self.timeout = timeout
+        self.width = width
+        self._executor: ProcessPoolExecutor | None = None
+        self.in_flight = 0
+        self.completed = 0
+        self.failed = 0
+        self.timeouts = 0
+
+    @classmethod
+    def from_config(cls, config) -> "RasterService":
+        return cls(
+            workers=config.raster_workers,
+            timeout=config.raster_timeout,
+            width=config.raster_width,
+        )
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        if self._executor is None:
+            # spawn, а не fork: в родителе уже работают потоки (aiosqlite)
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_init_worker,
+            )
+        return self._executor
+
+    async def render(
+        self, svg: Union[bytes, str], width: Optional[int] = None
+    ) -> bytes:
+        """SVG -> PNG-байты в процессе пула"""
+        loop = asyncio.get_running_loop()
+        self.in_flight += 1
+        try:
+            png = await asyncio.wait_for(
+                loop.run_in_executor(
+                    self._get_executor(),
+                    SVGConverter.render,
+                    svg,
+                    width or self.width,
+                ),
+                timeout=self.timeout,
+            )
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            raise
+        except Exception:
+            self.failed += 1
+            raise
+        finally:
+            self.in_flight -= 1
+        self.completed += 1
+        return png
+
+    async def warm_up(self) -> None:
+        """Заранее запустить процессы пула и загрузить в них шрифты"""
+        loop = asyncio.get_running_loop()
+        executor = self._get_executor()
+        await asyncio.gather(
+            *(
+                loop.run_in_executor(executor, _ping)
+                for _ in range(self.workers)
+            )
+        )
+
+    def stats(self) -> dict:
+        return {
+            "workers": self.workers,
+            "in_flight": self.in_flight,
+            "completed": self.completed,
+            "failed": self.failed,
+            "timeouts": self.timeouts,
+        }
+
+    def shutdown(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
@@ -0,0 +1,544 @@
+from __future__ import annotations
+
+import json
+import os
+import threading
+from collections import OrderedDict
+from datetime import date, datetime, time, timedelta
+from pathlib import Path
+from typing import Any, Dict, List, Mapping, NamedTuple, Optional, Tuple
+
+import kerykeion
+import numpy as np
+import pytz
+import swisseph as swe
+
+# Транзитные планеты (имена как в kerykeion) и их номера в Swiss Ephemeris
+TRANSIT_POINTS: Dict[str, int] = {
+    "Sun": swe.SUN,
+    "Moon": swe.MOON,
+    "Mercury": swe.MERCURY,
+    "Venus": swe.VENUS,
+    "Mars": swe.MARS,
+    "Jupiter": swe.JUPITER,
+    "Saturn": swe.SATURN,
+    "Uranus": swe.URANUS,
+    "Neptune": swe.NEPTUNE,
+    "Pluto": swe.PLUTO,
+    "Mean_Node": swe.MEAN_NODE,
+}
+
+# Натальные точки: ключ в JSON радикса / атрибут AstrologicalSubject
+NATAL_POINTS: Dict[str, str] = {
+    "Sun": "sun",
+    "Moon": "moon",
+    "Mercury": "mercury",
+    "Venus": "venus",
+    "Mars": "mars",
+    "Jupiter": "jupiter",
+    "Saturn": "saturn",
+    "Uranus": "uranus",
+    "Neptune": "neptune",
+    "Pluto": "pluto",
+    "Mean_Node": "mean_node",
+    "Ascendant": "first_house",
+    "Medium_Coeli": "tenth_house",
+}
+
+_TRANSIT_NAMES = np.array(list(TRANSIT_POINTS))
+_NATAL_NAMES = np.array(list(NATAL_POINTS))
+
+# Аспекты и орбисы как в настройках kerykeion по умолчанию
+ASPECTS: List[Tuple[str, float, float]] = [
+    ("conjunction", 0, 10),
+    ("opposition", 180, 10),
+    ("trine", 120, 8),
+    ("square", 90, 5),
+    ("sextile", 60, 6),
+    ("quintile", 72, 1),
+]
+
+# Момент дня, для которого считаются транзиты (местное время)
+TRANSIT_TIME = time(12, 0)
+
+_SWE_FLAGS = swe.FLG_SWIEPH | swe.FLG_SPEED
+swe.set_ephe_path(str(Path(kerykeion.__file__).parent / "sweph"))
+# Глобальное состояние swisseph не потокобезопасно: таблица эфемерид
+# считается в потоке, а промахи кэша — в event loop
+_swe_lock = threading.Lock()
+
+
+def natal_positions(natal: Any) -> np.ndarray:
+    """
+    Долготы натальных точек в порядке NATAL_POINTS.
+    Принимает AstrologicalSubject, dict или JSON-строку радикса.
+    """
+    if isinstance(natal, str):
+        natal = json.loads(natal)
+    positions = []
+    for key in NATAL_POINTS.values():
+        point = (
+            natal.get(key)
+            if isinstance(natal, Mapping)
+            else getattr(natal, key, None)
+        )
+        if point is None:
+            positions.append(np.nan)
+        elif isinstance(point, Mapping):
+            positions.append(point["abs_pos"])
+        else:
+            positions.append(point.abs_pos)
+    return np.array(positions, dtype=float)
+
+
+class TransitEngine:
+    """
+    Пакетный расчёт транзитов.
+
+    Эфемериды транзитных планет (долгота и скорость) считаются через
+    swisseph один раз на день и часовой пояс и кэшируются, а аспекты ко
+    всем натальным картам находятся векторно в NumPy. Прогноз на месяц
+    для тысяч пользователей — это одна таблица эфемерид и одна операция
+    над массивами, а не тысячи наборов AstrologicalSubject.
+    """
+
+    def __init__(self, max_days: int = 4096) -> None:
+        self.max_days = max_days
+        # (день, часовой пояс) -> массив (планеты, [долгота, скорость])
+        self._days: OrderedDict[Tuple[date, str], np.ndarray] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _julian_day(day: date, tz_str: str) -> float:
+        local = pytz.timezone(tz_str).localize(
+            datetime.combine(day, TRANSIT_TIME)
+        )
+        utc = local.astimezone(pytz.utc)
+        return swe.julday(
+            utc.year,
+            utc.month,
+            utc.day,
+            utc.hour + utc.minute / 60 + utc.second / 3600,
+        )
+
+    @staticmethod
+    def _compute_day(day: date, tz_str: str) -> np.ndarray:
+        jd = TransitEngine._julian_day(day, tz_str)
+        table = np.empty((len(TRANSIT_POINTS), 2))
+        with _swe_lock:
+            for i, body in enumerate(TRANSIT_POINTS.values()):
+                values, _ = swe.calc_ut(jd, body, _SWE_FLAGS)
+                table[i] = values[0], values[3]
+        return table
+
+    def ephemeris(
+        self, start: date, days: int, tz_str: str = "Europe/Moscow"
+    ) -> Tuple[List[date], np.ndarray, np.ndarray]:
+        """Даты, долготы (дни x планеты) и скорости (дни x планеты)"""
+        dates = [start + timedelta(days=i) for i in range(days)]
+        tables = []
+        for day in dates:
+            key = (day, tz_str)
+            table = self._days.get(key)
+            if table is None:
+                self.misses += 1
+                table = self._compute_day(day, tz_str)
+                self._days[key] = table
+                if len(self._days) > self.max_days:
+                    self._days.popitem(last=False)
+            else:
+                self.hits += 1
+                self._days.move_to_end(key)
+            tables.append(table)
+        stacked = np.stack(tables) if tables else np.empty((0, 0, 2))
+        return dates, stacked[..., 0], stacked[..., 1]
+
+    @staticmethod
+    def find_aspects(
+        transit_lons: np.ndarray, natal_lons: np.ndarray
+    ) -> Dict[str, Tuple[np.ndarray, ...]]:
+        """
+        Векторный поиск аспектов.
+        transit_lons: (дни, планеты), natal_lons: (карты, точки).
+        Для каждого аспекта возвращает индексы (день, планета, карта,
+        точка) и орбис всех совпадений.
+        """
+        # Угловое расстояние 0..180 для всех сочетаний сразу
+        diff = np.abs(
+            (
+                transit_lons[:, :, None, None]
+                - natal_lons[None, None, :, :]
+                + 180
+            )
+            % 360
+            - 180
+        )
+        found = {}
+        for name, angle, orb in ASPECTS:
+            orbit = np.abs(diff - angle)
+            with np.errstate(invalid="ignore"):
+                index = np.nonzero(orbit <= orb)
+            found[name] = (*index, orbit[index])
+        return found
+
+    def transits(
+        self,
+        natals: Mapping[Any, Any],
+        start: date,
+        days: int,
+        tz_str: str = "Europe/Moscow",
+        step_days: int = 1,
+    ) -> Dict[Any, Dict[str, Any]]:
+        """
+        Транзиты за период сразу для многих натальных карт
+        (ключ -> радикс в любом виде, принятом natal_positions)
+        """
+        keys = list(natals)
+        dates, lons, speeds = self.ephemeris(start, days, tz_str)
+        dates, lons, speeds = (
+            dates[::step_days],
+            lons[::step_days],
+            speeds[::step_days],
+        )
+        natal_lons = (
+            np.stack([natal_positions(natals[key]) for key in keys])
+            if keys
+            else np.empty((0, len(NATAL_POINTS)))
+        )
+
+        # Все найденные аспекты одним набором массивов, отсортированным
+        # по карте, дню и орбису, — дальше один проход без сортировок
+        found = self.find_aspects(lons, natal_lons)
+        aspect_index = np.concatenate(
+            [np.full(len(v[0]), i) for i, v in enumerate(found.values())]
+        ).astype(int)
+        d, p, k, n, orbit = (
+            np.concatenate([v[i] for v in found.values()]) for i in range(5)
+        )
+        order = np.lexsort((orbit, d, k))
+        d, p, k, n, orbit, aspect_index = (
+            d[order],
+            p[order],
+            k[order],
+            n[order],
+            orbit[order],
+            aspect_index[order],
+        )
+        columns = zip(
+            d.tolist(),
+            k.tolist(),
+            _TRANSIT_NAMES[p].tolist(),
+            np.round(lons[d, p], 4).tolist(),
+            (speeds[d, p] < 0).tolist(),
+            _NATAL_NAMES[n].tolist(),
+            np.round(natal_lons[k, n], 4).tolist(),
+            [ASPECTS[i] for i in aspect_index.tolist()],
+            np.round(orbit, 4).tolist(),
+        )
+
+        moments = {
+            key: [{"date": day.isoformat(), "aspects": []} for day in dates]
+            for key in keys
+        }
+        for (
+            d_i,
+            k_i,
+            p1_name,
+            p1_abs_pos,
+            p1_retrograde,
+            p2_name,
+            p2_abs_pos,
+            (aspect, aspect_degrees, _),
+            orbit_i,
+        ) in columns:
+            moments[keys[k_i]][d_i]["aspects"].append(
+                {
+                    "p1_name": p1_name,
+                    "p1_abs_pos": p1_abs_pos,
+                    "p1_retrograde": p1_retrograde,
+                    "p2_name": p2_name,
+                    "p2_abs_pos": p2_abs_pos,
+                    "aspect": aspect,
+                    "aspect_degrees": aspect_degrees,
+                    "orbit": orbit_i,
+                }
+            )
+
+        return {
+            key: {
+                "dates": [day.isoformat() for day in dates],
+                "tz_str": tz_str,
+                "transits": moments[key],
+            }
+            for key in keys
+        }
+
+    def preload(
+        self,
+        dates: List[date],
+        tz_str: str,
+        lons: np.ndarray,
+        speeds: np.ndarray,
+    ) -> None:
+        """
+        Положить в кэш готовые эфемериды (таблицу эфемерид). Кэш не
+        защищён блокировкой — вызывать только из event loop
+        """
+        for i, day in enumerate(dates):
+            self._days[(day, tz_str)] = np.stack([lons[i], speeds[i]], axis=1)
+            self._days.move_to_end((day, tz_str))
+        while len(self._days) > self.max_days:
+            self._days.popitem(last=False)
+
+    def stats(self) -> dict:
+        return {
+            "days": len(self._days),
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
+transit_engine = TransitEngine()
+
+
+# ---------- Общая таблица эфемерид ----------
+SKY_TZ = "Europe/Moscow"
+
+PLANET_NAMES_RU = {
+    "Sun": "Солнце",
+    "Moon": "Луна",
+    "Mercury": "Меркурий",
+    "Venus": "Венера",
+    "Mars": "Марс",
+    "Jupiter": "Юпитер",
+    "Saturn": "Сатурн",
+    "Uranus": "Уран",
+    "Neptune": "Нептун",
+    "Pluto": "Плутон",
+    "Mean_Node": "Северный узел",
+    "Chiron": "Хирон",
+    "Mean_Lilith": "Лилит",
+    "Ascendant": "Асцендент",
+    "Medium_Coeli": "MC",
+}
+ASPECT_NAMES_RU = {
+    "conjunction": "соединение",
+    "opposition": "оппозиция",
+    "trine": "трин",
+    "square": "квадрат",
+    "sextile": "секстиль",
+    "quintile": "квинтиль",
+}
+SIGN_NAMES_RU = [
+    "Овен",
+    "Телец",
+    "Близнецы",
+    "Рак",
+    "Лев",
+    "Дева",
+    "Весы",
+    "Скорпион",
+    "Стрелец",
+    "Козерог",
+    "Водолей",
+    "Рыбы",
+]
+
+
+class EphemerisTable(NamedTuple):
+    """Эфемериды на окно дней (порядок полей — как у preload)"""
+
+    dates: List[date]
+    tz_str: str
+    lons: np.ndarray
+    speeds: np.ndarray
+
+
+def build_ephemeris_table(
+    start: date, days: int, tz_str: str = SKY_TZ
+) -> EphemerisTable:
+    """
+    Посчитать эфемериды на окно дней в обход кэша transit_engine —
+    можно вызывать из потока
+    """
+    dates = [start + timedelta(days=i) for i in range(days)]
+    stacked = np.stack(
+        [TransitEngine._compute_day(day, tz_str) for day in dates]
+    )
+    return EphemerisTable(dates, tz_str, stacked[..., 0], stacked[..., 1])
+
+
+def save_ephemeris_table(path: Path | str, table: EphemerisTable) -> None:
+    """
+    Сохранить таблицу компактным .npz (долготы, скорости, флаги
+    ретроградности)
+    """
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(path.name + ".tmp")
+    with tmp_path.open("wb") as fp:
+        np.savez(
+            fp,
+            dates=np.array([day.toordinal() for day in table.dates]),
+            tz_str=np.array(table.tz_str),
+            names=_TRANSIT_NAMES,
+            lons=table.lons,
+            speeds=table.speeds,
+            retrograde=table.speeds < 0,
+        )
+    os.replace(tmp_path, path)
+
+
+def read_ephemeris_table(path: Path | str) -> Optional[EphemerisTable]:
+    """Прочитать таблицу с диска (None — нет файла или другие планеты)"""
+    path = Path(path)
+    if not path.exists():
+        return None
+    with np.load(path) as table:
+        if table["names"].tolist() != _TRANSIT_NAMES.tolist():
+            # Таблица от другой версии списка планет — пересчитается
+            return None
+        return EphemerisTable(
+            [date.fromordinal(int(day)) for day in table["dates"]],
+            str(table["tz_str"]),
+            table["lons"],
+            table["speeds"],
+        )
+
+
+def load_ephemeris_table(path: Path | str) -> int:
+    """
+    Загрузить таблицу в кэш transit_engine, вернуть число дней.
+    Вызывается при старте, до первого sky_summary
+    """
+    table = read_ephemeris_table(path)
+    if table is None:
+        return 0
+    transit_engine.preload(*table)
+    return len(table.dates)
+
+
+def update_ephemeris_table(
+    path: Path | str, days: int
+) -> Optional[EphemerisTable]:
+    """
+    Сдвинуть окно таблицы: со вчерашнего дня на days дней вперёд.
+    Выполняется в потоке и не трогает кэш: новую таблицу в
+    transit_engine кладёт вызывающий (в event loop). None — таблица на
+    диске уже покрывает окно
+    """
+    start = date.today() - timedelta(days=1)
+    current = read_ephemeris_table(path)
+    if (
+        current is not None
+        and current.dates[0] <= start
+        and current.dates[-1] >= start + timedelta(days=days)
+    ):
+        return None
+    table = build_ephemeris_table(start, days + 1)
+    save_ephemeris_table(path, table)
+    return table
+
+
+def _format_position(lon: float) -> str:
+    degrees = lon % 30
+    minutes = int(round((degrees - int(degrees)) * 60))
+    if minutes == 60:
+        degrees, minutes = degrees + 1, 0
+    return (
+        f"{int(degrees)}°{minutes:02d}' {SIGN_NAMES_RU[int(lon // 30) % 12]}"
+    )
+
+
+def sky_summary(day: date | None = None, tz_str: str = SKY_TZ) -> str:
+    """Положение планет на день: «Солнце 25°12' Весы; ... (ретро)»"""
+    day = day or date.today()
+    _, lons, speeds = transit_engine.ephemeris(day, 1, tz_str)
+    parts = []
+    for i, name in enumerate(TRANSIT_POINTS):
+        part = f"{PLANET_NAMES_RU[name]} {_format_position(lons[0, i])}"
+        if speeds[0, i] < 0 and name != "Mean_Node":
+            part += " (ретро)"
+        parts.append(part)
+    return "; ".join(parts)
+
+
+# ---------- Сводка натальной карты для промпта ----------
+HOUSE_KEYS = [
+    "first_house",
+    "second_house",
+    "third_house",
+    "fourth_house",
+    "fifth_house",
+    "sixth_house",
+    "seventh_house",
+    "eighth_house",
+    "ninth_house",
+    "tenth_house",
+    "eleventh_house",
+    "twelfth_house",
+]
+# Точки сводки: планеты радикса, Хирон и Лилит
+SUMMARY_POINTS = [
+    *(key for key in NATAL_POINTS.values() if not key.endswith("_house")),
+    "chiron",
+    "mean_lilith",
+]
+
+
+def natal_summary(natal: Any) -> str:
+    """
+    Компактная текстовая сводка радикса вместо полного JSON:
+    планеты (знак, градус, дом, ретроградность), куспиды домов и
+    аспекты между натальными точками с орбисами
+    """
+    if isinstance(natal, str):
+        natal = json.loads(natal)
+
+    lines = [
+        f"{natal['name']}, {natal['iso_formatted_local_datetime'][:16]} "
+        f"({natal['tz_str']}), {natal['city']}, {natal['nation']}; "
+        f"дома: {natal['houses_system_name']}"
+    ]
+
+    planets = []
+    for key in SUMMARY_POINTS:
+        point = natal.get(key)
+        if not point:
+            continue
+        part = (
+            f"{PLANET_NAMES_RU[point['name']]} "
+            f"{_format_position(point['abs_pos'])}"
+        )
+        if point.get("house"):
+            part += f", {HOUSE_KEYS.index(point['house'].lower()) + 1} дом"
+        if point.get("retrograde") and point["name"] != "Mean_Node":
+            part += " (ретро)"
+        planets.append(part)
+    lines.append("Планеты: " + "; ".join(planets))
+
+    lines.append(
+        "Куспиды домов: "
+        + "; ".join(
+            f"{i} {_format_position(natal[key]['abs_pos'])}"
+            for i, key in enumerate(HOUSE_KEYS, start=1)
+        )
+    )
+
+    # Аспекты радикса той же векторной функцией, что и транзиты
+    lons = natal_positions(natal)
+    found = []
+    for name, (_, p1, _, p2, orbit) in TransitEngine.find_aspects(
+        lons[None, :], lons[None, :]
+    ).items():
+        for i, j, orb in zip(p1, p2, orbit):
+            if i < j:
+                found.append((orb, name, i, j))
+    aspects = [
+        f"{PLANET_NAMES_RU[_NATAL_NAMES[i]]} {ASPECT_NAMES_RU[name]} "
+        f"{PLANET_NAMES_RU[_NATAL_NAMES[j]]} ({orb:.1f}°)"
+        for orb, name, i, j in sorted(found)
+    ]
+    lines.append("Аспекты: " + ("; ".join(aspects) or "нет"))
+    return "\n".join(lines)